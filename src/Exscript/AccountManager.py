@@ -16,6 +16,7 @@
 Manages user accounts.
 """
 from Exscript.AccountPool import AccountPool
+from Exscript.util.event import Event
 
 class AccountManager(object):
     """
@@ -26,17 +27,28 @@ class AccountManager(object):
     def __init__(self):
         """
         Constructor.
+
+        The account_released_event is sent with the account as its
+        argument whenever an account of any of the pools was released.
         """
-        self.default_pool = None
-        self.pools        = None
+        self.default_pool           = None
+        self.pools                  = None
+        self.account_released_event = Event()
         self.reset()
 
+    def _watch_pool(self, pool):
+        # Passes releases in the given pool on to account_released_event.
+        event = pool.account_released_event
+        if not event.is_connected(self.account_released_event):
+            event.connect(self.account_released_event)
+
     def reset(self):
         """
         Removes all account pools.
         """
         self.default_pool = AccountPool()
         self.pools        = []
+        self._watch_pool(self.default_pool)
 
     def add_pool(self, pool, match = None):
         """
@@ -96,6 +108,7 @@ class AccountManager(object):
         @type  match: callable
         @param match: A callback to check if the pool should be used.
         """
+        self._watch_pool(pool)
         if match is None:
             self.default_pool = pool
         else:
@@ -125,51 +138,85 @@ class AccountManager(object):
                 return account
         return self.default_pool.get_account_from_hash(account_hash)
 
-    def acquire_account(self, account = None, owner = None):
+    def acquire_account(self, account = None, owner = None, blocking = True):
         """
         Acquires the given account. If no account is given, one is chosen
         from the default pool.
+        If blocking is False and the account is not available, None is
+        returned instead of waiting. Accounts that are not in any pool
+        are always waited for.
 
         @type  account: Account
         @param account: The account that is added.
         @type  owner: object
         @param owner: An optional descriptor for the owner.
+        @type  blocking: bool
+        @param blocking: Whether to wait until an account is available.
         @rtype:  L{Account}
         @return: The account that was acquired.
         """
         if account is not None:
             for _, pool in self.pools:
                 if pool.has_account(account):
-                    return pool.acquire_account(account, owner)
+                    return pool.acquire_account(account, owner, blocking)
 
             if not self.default_pool.has_account(account):
                 # The account is not in any pool.
                 account.acquire()
                 return account
 
-        return self.default_pool.acquire_account(account, owner)
+        return self.default_pool.acquire_account(account, owner, blocking)
+
+    def get_account_pool_for(self, host):
+        """
+        Returns the account pool that acquire_account_for() takes an
+        account from for the given host.
+
+        @type  host: L{Host}
+        @param host: The host.
+        @rtype:  L{AccountPool}
+        @return: The matching account pool.
+        """
+        for match, pool in self.pools:
+            if match(host) is True:
+                return pool
+        return self.default_pool
 
-    def acquire_account_for(self, host, owner = None):
+    def acquire_account_for(self, host, owner = None, blocking = True):
         """
         Acquires an account for the given host and returns it.
         The host is passed to each of the match functions that were
         passed in when adding the pool. The first pool for which the
         match function returns True is chosen to assign an account.
+        If blocking is False and no account is available, None is
+        returned instead of waiting.
 
         @type  host: L{Host}
         @param host: The host for which an account is acquired.
         @type  owner: object
         @param owner: An optional descriptor for the owner.
+        @type  blocking: bool
+        @param blocking: Whether to wait until an account is available.
         @rtype:  L{Account}
         @return: The account that was acquired.
         """
-        # Check whether a matching account pool exists.
-        for match, pool in self.pools:
-            if match(host) is True:
-                return pool.acquire_account(owner = owner)
+        pool = self.get_account_pool_for(host)
+        return pool.acquire_account(owner = owner, blocking = blocking)
+
+    def transfer_account(self, account, owner):
+        """
+        Passes an acquired account on to the given owner, without
+        unlocking it in between; see L{AccountPool.transfer_account()}.
 
-        # Else, choose an account from the default account pool.
-        return self.default_pool.acquire_account(owner = owner)
+        @type  account: Account
+        @param account: The acquired account.
+        @type  owner: object
+        @param owner: The new owner descriptor.
+        """
+        for _, pool in self.pools:
+            if pool.has_account(account):
+                return pool.transfer_account(account, owner)
+        self.default_pool.transfer_account(account, owner)
 
     def release_accounts(self, owner):
         """
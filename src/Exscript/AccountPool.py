@@ -18,6 +18,7 @@ A collection of user accounts.
 import threading
 from collections import deque, defaultdict
 from Exscript.util.cast import to_list
+from Exscript.util.event import Event
 
 class AccountPool(object):
     """
@@ -28,6 +29,9 @@ class AccountPool(object):
         """
         Constructor.
 
+        The account_released_event is sent with the account as its
+        argument whenever an account of the pool was released.
+
         @type  accounts: Account|list[Account]
         @param accounts: Passed to add_account()
         """
@@ -36,6 +40,7 @@ class AccountPool(object):
         self.owner2account     = defaultdict(list)
         self.account2owner     = dict()
         self.unlock_cond       = threading.Condition(threading.RLock())
+        self.account_released_event = Event()
         if accounts:
             self.add_account(accounts)
 
@@ -63,6 +68,7 @@ class AccountPool(object):
                 self.account2owner.pop(account)
                 self.owner2account[owner].remove(account)
             self.unlock_cond.notify_all()
+        self.account_released_event(account)
         return account
 
     def get_account_from_hash(self, account_hash):
@@ -144,15 +150,25 @@ class AccountPool(object):
         """
         return len(self.accounts)
 
-    def acquire_account(self, account = None, owner = None):
+    def n_unlocked(self):
+        """
+        Returns the number of accounts that are currently not locked.
+        """
+        return len(self.unlocked_accounts)
+
+    def acquire_account(self, account = None, owner = None, blocking = True):
         """
         Waits until an account becomes available, then locks and returns it.
         If an account is not passed, the next available account is returned.
+        If blocking is False and no matching account is available, None
+        is returned immediately.
 
         @type  account: Account
         @param account: The account to be acquired, or None.
         @type  owner: object
         @param owner: An optional descriptor for the owner.
+        @type  blocking: bool
+        @param blocking: Whether to wait until an account is available.
         @rtype:  L{Account}
         @return: The account that was acquired.
         """
@@ -163,11 +179,15 @@ class AccountPool(object):
             if account:
                 # Specific account requested.
                 while account not in self.unlocked_accounts:
+                    if not blocking:
+                        return None
                     self.unlock_cond.wait()
                 self.unlocked_accounts.remove(account)
             else:
                 # Else take the next available one.
                 while len(self.unlocked_accounts) == 0:
+                    if not blocking:
+                        return None
                     self.unlock_cond.wait()
                 account = self.unlocked_accounts.popleft()
 
@@ -178,6 +198,30 @@ class AccountPool(object):
             self.unlock_cond.notify_all()
             return account
 
+    def transfer_account(self, account, owner):
+        """
+        Passes an acquired account on to the given owner, without
+        unlocking it in between.
+
+        @type  account: Account
+        @param account: The acquired account.
+        @type  owner: object
+        @param owner: The new owner descriptor.
+        """
+        with self.unlock_cond:
+            if account not in self.accounts:
+                msg = 'attempt to transfer unknown account %s' % account
+                raise Exception(msg)
+            if account in self.unlocked_accounts:
+                raise Exception('account %s should be locked' % account)
+            old_owner = self.account2owner.pop(account, None)
+            if old_owner is not None:
+                self.owner2account[old_owner].remove(account)
+                if not self.owner2account[old_owner]:
+                    del self.owner2account[old_owner]
+            self.owner2account[owner].append(account)
+            self.account2owner[account] = owner
+
     def release_accounts(self, owner):
         """
         Releases all accounts that were acquired by the given owner.
@@ -186,9 +230,11 @@ class AccountPool(object):
         @param owner: The owner descriptor as passed to acquire_account().
         """
         with self.unlock_cond:
-            for account in self.owner2account[owner]:
+            released = self.owner2account.pop(owner, [])
+            for account in released:
                 self.account2owner.pop(account)
                 account.release(False)
                 self.unlocked_accounts.append(account)
-            self.owner2account.pop(owner)
             self.unlock_cond.notify_all()
+        for account in released:
+            self.account_released_event(account)
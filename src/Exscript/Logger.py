@@ -77,7 +77,7 @@ class Logger(object):
 
     def log(self, job_id, message):
         # This method is called whenever a sub thread sends a log message
-        # via a pipe. (See LoggerProxy and Queue.PipeHandler)
+        # via a pipe. (See LoggerProxy and Queue._PipeBroker)
         log = self._get_log(job_id)
         log.write(message)
 
@@ -18,29 +18,38 @@ The heart of Exscript.
 import sys
 import os
 import gc
+import time
 import select
 import threading
-import weakref
+from collections import deque
 from functools import partial
+from itertools import islice, count
 from multiprocessing import Pipe
 from Exscript.Logger import logger_registry
 from Exscript.LoggerProxy import LoggerProxy
-from Exscript.util.cast import to_hosts
+from Exscript.util.cast import to_list, to_hosts
+from Exscript.util.event import Event
 from Exscript.util.tty import get_terminal_size
 from Exscript.util.impl import format_exception, serializeable_sys_exc_info
 from Exscript.util.decorator import get_label
+from Exscript.util.coroutine import Return, blocking, is_coroutine_function
 from Exscript.AccountManager import AccountManager
 from Exscript.workqueue import WorkQueue, Task
+from Exscript.workqueue.Job import Job
+from Exscript.workqueue.Reactor import Reactor
 from Exscript.AccountProxy import AccountProxy
 from Exscript.protocols import prepare
 
-def _account_factory(accm, host, account):
+def _account_factory(accm, host, reserved, account):
     if account is None:
         account = host.get_account()
 
-    # Specific account requested?
+    # Specific account requested? If not, claim the account that was
+    # reserved when the job was started, if any.
     if account:
         acquired = AccountProxy.for_account_hash(accm, account.__hash__())
+    elif reserved is not None:
+        acquired = AccountProxy.for_account_hash(accm, reserved)
     else:
         acquired = AccountProxy.for_host(accm, host)
 
@@ -50,49 +59,292 @@ def _account_factory(accm, host, account):
     account.acquire()
     return account
 
-def _prepare_connection(func):
-    """
-    A decorator that unpacks the host and connection from the job argument
-    and passes them as separate arguments to the wrapped function.
-    """
-    def _wrapped(job, *args, **kwargs):
-        job_id    = id(job)
-        to_parent = job.data['pipe']
-        host      = job.data['host']
-
-        # Create a protocol adapter.
-        mkaccount = partial(_account_factory, to_parent, host)
-        pargs     = {'account_factory': mkaccount,
-                     'stdout':          job.data['stdout']}
+def _close_connection(conn):
+    try:
+        conn.close(force = True)
+    except Exception:
+        pass # The connection is not open yet, or already closed.
+
+def _cancel_connection(conn):
+    # Called from the reactor thread if the job exceeded its deadline,
+    # so it must not block. Cancelling the expect() wakes the job up at
+    # once; closing may block on the network, so it is done in a thread
+    # of its own.
+    try:
+        conn.cancel_expect()
+    except Exception:
+        pass
+    closer = threading.Thread(target = _close_connection, args = (conn,))
+    closer.daemon = True
+    closer.start()
+
+def _get_session_key(host, account_name):
+    return (host.get_protocol(),
+            host.get_address(),
+            host.get_tcp_port(),
+            account_name)
+
+def _get_job_account_name(job):
+    # Returns the name of the account that the given job is going to
+    # log in with, or None if it is not known before the job runs.
+    account = job.data['host'].get_account()
+    if account is not None:
+        return account.get_name()
+    return job.data.get('reserved_account_name')
+
+def _prepare_protocol(job):
+    # Creates the protocol adapter for the host of the given job, or
+    # takes a session that is already logged in from the session pool.
+    # Returns the adapter, and whether it is connected.
+    host      = job.data['host']
+    reserved  = job.data.get('reserved_account')
+    mkaccount = partial(_account_factory, job.data['pipe'], host, reserved)
+    pool      = job.data.get('session_pool')
+    conn      = None
+    name      = _get_job_account_name(job)
+    if pool is not None and name is not None:
+        conn = pool.checkout(_get_session_key(host, name))
+    if conn is None:
+        pargs = {'account_factory': mkaccount,
+                 'stdout':          job.data['stdout']}
         pargs.update(host.get_options())
         conn = prepare(host, **pargs)
+        connected = False
+        if pool is not None:
+            pool.register(conn)
+    else:
+        conn.account_factory = mkaccount
+        conn.stdout          = job.data['stdout']
+        connected            = True
+    job.cancel_event.connect(_cancel_connection, conn)
+    return conn, connected
+
+def _release_protocol(job, conn):
+    # Returns the connection of a job that succeeded to the session
+    # pool, if any.
+    # The session is stored under the account that it is logged in
+    # with, which for accounts from an account pool is only known now.
+    pool    = job.data.get('session_pool')
+    account = conn.last_account
+    if pool is None or account is None:
+        conn.close(force = True)
+        return
+    job.cancel_event.disconnect(_cancel_connection)
+    key = _get_session_key(job.data['host'], account.get_name())
+    pool.checkin(key, conn)
+
+def _call_function(func, job, conn, connect, *args, **kwargs):
+    # Calls connect() and the function. If the function was decorated
+    # with log_to(), both are logged, so that connection errors end up
+    # in the log as well.
+    host        = job.data['host']
+    log_options = get_label(func, 'log_to')
+    if log_options is None:
+        connect()
+        return func(job, host, conn, *args, **kwargs)
+
+    job_id = id(job)
+    proxy  = LoggerProxy(job.data['pipe'], log_options['logger_id'])
+    log_cb = partial(proxy.log, job_id)
+    proxy.add_log(job_id, job.name, job.failures + 1)
+    conn.data_received_event.listen(log_cb)
+    try:
+        connect()
+        result = func(job, host, conn, *args, **kwargs)
+    except:
+        proxy.log_aborted(job_id, serializeable_sys_exc_info())
+        raise
+    else:
+        proxy.log_succeeded(job_id)
+    finally:
+        conn.data_received_event.disconnect(log_cb)
+    return result
+
+def _call_function_async(func, job, conn, connected, *args, **kwargs):
+    # Like _call_function(), but for functions that are coroutines. The
+    # blocking parts are run in a thread.
+    host        = job.data['host']
+    log_options = get_label(func, 'log_to')
+    if log_options is None:
+        if not connected:
+            yield blocking(_connect, job, conn, connected)
+        result = yield func(job, host, conn, *args, **kwargs)
+        raise Return(result)
+
+    job_id = id(job)
+    proxy  = LoggerProxy(job.data['pipe'], log_options['logger_id'])
+    log_cb = partial(proxy.log, job_id)
+    yield blocking(proxy.add_log, job_id, job.name, job.failures + 1)
+    conn.data_received_event.listen(log_cb)
+    try:
+        if not connected:
+            yield blocking(_connect, job, conn, connected)
+        result = yield func(job, host, conn, *args, **kwargs)
+    except Exception:
+        proxy.log_aborted(job_id, serializeable_sys_exc_info())
+        raise
+    else:
+        proxy.log_succeeded(job_id)
+    finally:
+        conn.data_received_event.disconnect(log_cb)
+    raise Return(result)
+
+def _connect(job, conn, connected):
+    if connected:
+        return
+    host  = job.data['host']
+    start = time.time()
+    conn.connect(host.get_address(), host.get_tcp_port())
+    connected.append(True)
+
+    # The time it takes to connect is a hint for the autotuner.
+    job.data['pipe'].send(('connect-latency', time.time() - start))
+
+def _run_connected(func, job, *args, **kwargs):
+    conn, connected = _prepare_protocol(job)
+    connected       = connected and [True] or []
+    connect         = partial(_connect, job, conn, connected)
+    try:
+        result = _call_function(func, job, conn, connect, *args, **kwargs)
+    except:
+        conn.close(force = True)
+        raise
+    _release_protocol(job, conn)
+    return result
+
+def _run_connected_async(func, job, *args, **kwargs):
+    # Like _run_connected(), but for functions that are coroutines.
+    conn, connected = _prepare_protocol(job)
+    connected       = connected and [True] or []
+    try:
+        result = yield _call_function_async(func,
+                                            job,
+                                            conn,
+                                            connected,
+                                            *args,
+                                            **kwargs)
+    except Exception:
+        yield blocking(conn.close, force = True)
+        raise
+    yield blocking(_release_protocol, job, conn)
+    raise Return(result)
+
+class _SessionError(Exception):
+    """
+    Raised by a L{_Session} if any of its functions failed. Holds the
+    outcome of every function as a (key, exc_info, result) tuple, where
+    exc_info is None if the function succeeded.
+    """
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        messages      = [str(exc_info[1]) for exc_info in self.get_errors()]
+        Exception.__init__(self, '; '.join(messages))
+
+    def __reduce__(self):
+        # The outcomes must survive being passed from a worker process.
+        return _SessionError, (self.outcomes,)
+
+    def get_errors(self):
+        return [exc_info for key, exc_info, result in self.outcomes
+                if exc_info is not None]
 
-        # Connect and run the function.
-        log_options = get_label(func, 'log_to')
-        if log_options is not None:
-            # Enable logging.
-            proxy  = LoggerProxy(to_parent, log_options['logger_id'])
-            log_cb = partial(proxy.log, job_id)
-            proxy.add_log(job_id, job.name, job.failures + 1)
-            conn.data_received_event.listen(log_cb)
+class _Session(object):
+    """
+    Connects to a host once, and calls a list of functions on the shared
+    connection in turn; see the coalesce argument of L{Queue}.
+    Every function is logged separately. If a function fails, the
+    remaining functions are still called, and a _SessionError with the
+    outcome of every function is raised at the end. A retry only calls
+    the functions that did not succeed before; their outcome is passed
+    in job.data['session_outcomes'], see Queue._on_job_error().
+
+    Each function comes with the key of the task that added it, so that
+    every task is passed only the outcome of its own functions.
+    """
+    def __init__(self, functions):
+        self.functions = list(functions) # (key, function) tuples.
+
+    def __call__(self, job):
+        previous = job.data.get('session_outcomes')
+        if previous is None:
+            previous = [None] * len(self.functions)
+        conn, connected = _prepare_protocol(job)
+        connected       = connected and [True] or []
+        connect         = partial(_connect, job, conn, connected)
+        outcomes        = []
+        failed          = False
+        for (key, func), outcome in zip(self.functions, previous):
+            if outcome is not None and outcome[1] is None:
+                outcomes.append(outcome) # Succeeded in an earlier attempt.
+                continue
             try:
-                conn.connect(host.get_address(), host.get_tcp_port())
-                result = func(job, host, conn, *args, **kwargs)
-                conn.close(force = True)
+                result = _call_function(func, job, conn, connect)
             except:
-                proxy.log_aborted(job_id, serializeable_sys_exc_info())
-                raise
+                if not connected:
+                    raise # Failed to connect.
+                outcomes.append((key, serializeable_sys_exc_info(), None))
+                failed = True
             else:
-                proxy.log_succeeded(job_id)
-            finally:
-                conn.data_received_event.disconnect(log_cb)
-        else:
-            conn.connect(host.get_address(), host.get_tcp_port())
-            result = func(job, host, conn, *args, **kwargs)
+                outcomes.append((key, None, result))
+        if failed:
             conn.close(force = True)
-        return result
+            raise _SessionError(outcomes)
+        _release_protocol(job, conn)
+        return outcomes
+
+class _SessionTask(Task):
+    """
+    The task of a call to run() in coalescing mode. Its jobs may be
+    shared with other tasks, so only the results of the functions that
+    it added are collected. If a job is aborted, the functions that did
+    succeed still count.
+    """
+    def __init__(self, workqueue, max_results, key):
+        Task.__init__(self, workqueue, max_results)
+        self.key = key
 
-    return _wrapped
+    def _add_outcomes(self, job, outcomes):
+        with self.lock:
+            for key, exc_info, result in outcomes:
+                if key == self.key and exc_info is None:
+                    self._add_result(job.name, result)
+
+    def _on_job_succeeded(self, job):
+        if job.id not in self.job_ids:
+            return
+        self._add_outcomes(job, job.result)
+        self._on_job_done(job)
+
+    def _on_job_aborted(self, job):
+        if job.id in self.job_ids:
+            self._add_outcomes(job, job.data.get('session_outcomes', ()))
+        Task._on_job_aborted(self, job)
+
+def _prepare_connection(func):
+    """
+    A decorator that unpacks the host and connection from the job argument
+    and passes them as separate arguments to the wrapped function.
+    The returned callable can be pickled if func can be pickled, so that
+    it may be passed to the workers of a process pool.
+    If func is a coroutine, so is the returned callable.
+    """
+    if is_coroutine_function(func):
+        return partial(_run_connected_async, func)
+    return partial(_run_connected, func)
+
+def _is_iterator(hosts):
+    # Lists are fully materialized, but iterators and generators are
+    # consumed lazily.
+    return hasattr(hosts, '__iter__') and iter(hosts) is hosts
+
+def _get_host_groups(function, job):
+    # Jobs that were not created by run() have no host.
+    if job.data is None:
+        return ()
+    groups = function(job.data['host'])
+    if groups is None:
+        return ()
+    return to_list(groups)
 
 def _is_recoverable_error(cls):
     # Hack: We can't use isinstance(), because the classes may
@@ -106,69 +358,252 @@ def _call_logger(funcname, logger_id, *args):
         return
     return getattr(logger, funcname)(*args)
 
-class _PipeHandler(threading.Thread):
+class _PipeBroker(Reactor):
     """
-    Each PipeHandler holds an open pipe to a subprocess, to allow the
-    sub-process to access the accounts and communicate status information.
+    Serves the pipes of all subprocesses in a single thread, to allow the
+    sub-processes to access the accounts and communicate status information.
+    Requests for accounts that are currently locked are parked until an
+    account is released, so that a waiting child does not stall the others.
+    Parked requests are indexed by the account or account pool that they
+    wait for, so that a release only retries the requests that the
+    released account could satisfy.
+    Accounts may also be reserved for a job before it is started; the
+    first child that asks for a reserved account by its hash takes it over.
+
+    The account_released_event is sent in the broker thread whenever an
+    account of the account manager was released, after the parked
+    requests were retried. The connect_latency_event is sent with the
+    number of seconds it took a child to connect to a host.
     """
     def __init__(self, account_manager):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.accm   = account_manager
-        self.to_child, self.to_parent = Pipe()
+        Reactor.__init__(self)
+        self.accm                   = account_manager
+        self.parked                 = {} # Maps resources to deques.
+        self.parked_seq             = count()
+        self.waiting                = {} # Maps pipes to parked requests.
+        self.released               = [] # Accounts not yet handled.
+        self.pipe_cond              = threading.Condition(threading.Lock())
+        self.n_pipes                = 0
+        self.reserved               = {} # Maps account hashes to owners.
+        self.reserve_lock           = threading.Lock()
+        self.release_lock           = threading.Lock()
+        self.release_pending        = False
+        self.account_released_event = Event()
+        self.connect_latency_event  = Event()
+        self.accm.account_released_event.listen(self._on_account_released)
+
+    def create_pipe(self, wait = True):
+        """
+        Creates a new pipe and returns the child end of the connection.
+        The pipe is served until the child end is closed; any accounts
+        that are still held by the child are then released.
+
+        @type  wait: bool
+        @param wait: Whether wait_for_pipes() waits for this pipe.
+        @rtype:  multiprocessing.Connection
+        @return: The child end of the pipe.
+        """
+        to_child, to_parent = Pipe()
+        if wait:
+            with self.pipe_cond:
+                self.n_pipes += 1
+        self.add(to_child, partial(self._on_request, to_child, wait))
+        return to_parent
+
+    def wait_for_pipes(self):
+        """
+        Waits until all pipes that were created with wait = True are
+        closed, and all of their requests were processed.
+        """
+        with self.pipe_cond:
+            while self.n_pipes > 0:
+                self.pipe_cond.wait()
+
+    def add_reservation(self, account, owner):
+        """
+        Registers an account that was acquired on behalf of the given
+        owner, such that it is passed on to the first child that asks
+        for it by its hash, instead of waiting until it is released.
+
+        @type  account: Account
+        @param account: The acquired account.
+        @type  owner: object
+        @param owner: The owner as passed to acquire_account().
+        """
+        with self.reserve_lock:
+            self.reserved[account.__hash__()] = owner
+
+    def release_reservations(self, owner):
+        """
+        Releases the accounts that were reserved for the given owner, and
+        that were not yet taken over by a child.
 
-    def _send_account(self, account):
+        @type  owner: object
+        @param owner: The owner as passed to add_reservation().
+        """
+        with self.reserve_lock:
+            for account_hash, reserved_for in self.reserved.items():
+                if reserved_for == owner:
+                    del self.reserved[account_hash]
+            self.accm.release_accounts(owner)
+
+    def _on_account_released(self, account):
+        # Called in whatever thread released the account. Parked requests
+        # are retried in the broker thread, once for any number of
+        # releases that happen in the meantime.
+        with self.release_lock:
+            self.released.append(account)
+            if self.release_pending:
+                return
+            self.release_pending = True
+        self.call_later(0, self._account_released)
+
+    def _account_released(self):
+        with self.release_lock:
+            self.release_pending = False
+            released             = self.released
+            self.released        = []
+        resources = set()
+        for account in released:
+            resources.add(account.__hash__())
+            resources.add(self._get_pool_of(account))
+        self._retry_parked(resources)
+        self.account_released_event()
+
+    def _get_pool_of(self, account):
+        for _, pool in self.accm.pools:
+            if pool.has_account(account):
+                return pool
+        return self.accm.default_pool
+
+    def _get_resource(self, request):
+        # Returns the account hash or the account pool that the given
+        # request waits for.
+        command, arg = request
+        if command == 'acquire-account-for-host':
+            return self.accm.get_account_pool_for(arg)
+        elif command == 'acquire-account-from-hash':
+            return arg
+        return self.accm.default_pool
+
+    def _claim_reservation(self, pipe, account):
+        # Passes a reserved account on to the child on the given pipe.
+        with self.reserve_lock:
+            if self.reserved.pop(account.__hash__(), None) is None:
+                return False
+            self.accm.transfer_account(account, pipe)
+            return True
+
+    def _send_error(self, pipe, exc):
+        try:
+            pipe.send(exc)
+        except IOError:
+            pass # The child is gone; the pipe is closed by _on_request().
+
+    def _send_account(self, pipe, account):
         if account is None:
-            self.to_child.send(account)
+            pipe.send(account)
             return
         response = (account.__hash__(),
                     account.get_name(),
                     account.get_password(),
                     account.get_authorization_password(),
                     account.get_key())
-        self.to_child.send(response)
-
-    def _handle_request(self, request):
+        pipe.send(response)
+
+    def _acquire(self, pipe, request):
+        # Returns False if no account is available yet.
+        command, arg = request
+        if command == 'acquire-account-for-host':
+            account = self.accm.acquire_account_for(arg, pipe, False)
+        elif command == 'acquire-account-from-hash':
+            account = self.accm.get_account_from_hash(arg)
+            if account is None:
+                self._send_account(pipe, None)
+                return True
+            if self._claim_reservation(pipe, account):
+                self._send_account(pipe, account)
+                return True
+            account = self.accm.acquire_account(account, pipe, False)
+        else:
+            account = self.accm.acquire_account(owner    = pipe,
+                                                blocking = False)
+        if account is None:
+            return False
+        self._send_account(pipe, account)
+        return True
+
+    def _park(self, pipe, request):
+        resource = self._get_resource(request)
+        parked   = [self.parked_seq.next(), pipe, request]
+        self.parked.setdefault(resource, deque()).append(parked)
+        self.waiting[pipe] = parked
+        self._retry_parked([resource])
+
+    def _retry_parked(self, resources):
+        # All requests in a deque wait for the same resource, so the
+        # first one that can not be served ends the deque. Requests of
+        # different deques are served in the order of their arrival.
+        queues = [self.parked[r] for r in resources if r in self.parked]
+        while queues:
+            queue = min(queues, key = lambda q: q[0][0])
+            seq, pipe, request = queue[0]
+            if pipe is not None:
+                try:
+                    if not self._acquire(pipe, request):
+                        queues.remove(queue)
+                        continue
+                except Exception, e:
+                    self._send_error(pipe, e)
+                del self.waiting[pipe]
+            queue.popleft()
+            if not queue:
+                queues.remove(queue)
+        for resource in resources:
+            if not self.parked.get(resource, True):
+                del self.parked[resource]
+
+    def _handle_request(self, pipe, request):
         try:
             command, arg = request
-            if command == 'acquire-account-for-host':
-                account = self.accm.acquire_account_for(arg, self)
-                self._send_account(account)
-            elif command == 'acquire-account-from-hash':
-                account = self.accm.get_account_from_hash(arg)
-                if account is not None:
-                    account = self.accm.acquire_account(account, self)
-                self._send_account(account)
-            elif command == 'acquire-account':
-                account = self.accm.acquire_account(owner = self)
-                self._send_account(account)
+            if command.startswith('acquire-account'):
+                self._park(pipe, request)
             elif command == 'release-account':
                 account = self.accm.get_account_from_hash(arg)
                 account.release()
-                self.to_child.send('ok')
+                pipe.send('ok')
             elif command == 'log-add':
                 log = _call_logger('add_log', *arg)
-                self.to_child.send(log)
+                pipe.send(log)
             elif command == 'log-message':
                 _call_logger('log', *arg)
             elif command == 'log-aborted':
                 _call_logger('log_aborted', *arg)
             elif command == 'log-succeeded':
                 _call_logger('log_succeeded', *arg)
+            elif command == 'connect-latency':
+                self.connect_latency_event(arg)
             else:
                 raise Exception('invalid command on pipe: ' + repr(command))
         except Exception, e:
-            self.to_child.send(e)
-            raise
+            self._send_error(pipe, e)
 
-    def run(self):
-        while True:
-            try:
-                request = self.to_child.recv()
-            except (EOFError, IOError):
-                self.accm.release_accounts(self)
-                break
-            self._handle_request(request)
+    def _on_request(self, pipe, wait, request):
+        if request is not None:
+            self._handle_request(pipe, request)
+            return
+
+        # The child end of the pipe was closed. Its parked request, if
+        # any, is dropped when it reaches the front of its deque.
+        parked = self.waiting.pop(pipe, None)
+        if parked is not None:
+            parked[1] = None
+        self.accm.release_accounts(pipe)
+        pipe.close()
+        if wait:
+            with self.pipe_cond:
+                self.n_pipes -= 1
+                self.pipe_cond.notify_all()
 
 class Queue(object):
     """
@@ -182,7 +617,14 @@ class Queue(object):
                  max_threads = 1,
                  host_driver = None,
                  stdout      = sys.stdout,
-                 stderr      = sys.stderr):
+                 stderr      = sys.stderr,
+                 stack_size  = None,
+                 coalesce    = False,
+                 max_results = None,
+                 threads_per_process = 1,
+                 session_pool = None,
+                 collection  = None,
+                 blocking_threads = 8):
         """
         Constructor. All arguments should be passed as keyword arguments.
         Depending on the verbosity level, the following types
@@ -210,7 +652,16 @@ class Queue(object):
         @type  verbose: int
         @param verbose: The verbosity level.
         @type  mode: str
-        @param mode: 'multiprocessing' or 'threading'
+        @param mode: 'threading', 'multiprocessing', 'threadpool',
+            'processpool', 'hybrid' or 'async'. In 'processpool' and
+            'hybrid' mode, the functions and hosts that are passed to
+            run() are pickled, so they must not reference objects that
+            can only be shared by inheritance. In 'async' mode, functions
+            that are coroutines (see L{Exscript.util.coroutine}) all run
+            in a single thread, so max_threads may be in the thousands;
+            they should use the *_async() methods of the connection.
+            Other functions are called in one of blocking_threads
+            threads.
         @type  max_threads: int
         @param max_threads: The maximum number of concurrent threads.
         @type  host_driver: str
@@ -219,15 +670,68 @@ class Queue(object):
         @param stdout: The output channel, defaults to sys.stdout.
         @type  stderr: file
         @param stderr: The error channel, defaults to sys.stderr.
+        @type  stack_size: int
+        @param stack_size: In 'threadpool', 'hybrid' and 'async' mode,
+            the stack size of the worker threads in bytes. A small stack, e.g.
+            256 KiB, allows for running thousands of I/O-bound connections
+            concurrently. Other modes raise a TypeError if it is given.
+        @type  coalesce: bool
+        @param coalesce: If True, functions that are passed to run() for
+            a host that is still waiting in the queue are added to the
+            waiting job, instead of creating a new one. The job then
+            connects only once, and calls the functions in turn on the
+            same connection. The job keeps the attempts, priority, and
+            other options of the run() call that created it. A retry
+            only calls the functions that failed, and every task only
+            collects the results of its own functions.
+        @type  max_results: int
+        @param max_results: The maximum number of return values that each
+            task keeps in memory; beyond that, they are written to a
+            temporary file. See L{Task.results()}.
+        @type  threads_per_process: int
+        @param threads_per_process: In 'hybrid' mode, the number of
+            threads in each worker process. The queue starts as many
+            processes as are needed for max_threads connections, so
+            that account and log traffic of every thread is still routed
+            through a pipe of its own.
+        @type  session_pool: L{Exscript.protocols.SessionPool}
+        @param session_pool: If given, the connection of a job that
+            succeeded is kept open in the pool, and the next job for the
+            same host and account takes it over instead of connecting
+            and logging in again. Functions should therefore log in
+            using L{Exscript.util.decorator.autologin()}, which skips the
+            login on such a connection. In 'processpool' and 'hybrid'
+            mode, every worker process keeps a pool of its own; in
+            'multiprocessing' mode, connections are not reused.
+        @type  collection: L{Exscript.workqueue.DBPipeline.DBPipeline}
+        @param collection: If given, the jobs are kept in this collection
+            instead of in memory, so that they can be restored after a
+            restart; see set_dump_function() and recover(). The hosts
+            must be picklable.
+        @type  blocking_threads: int
+        @param blocking_threads: In 'async' mode, the number of threads
+            for functions that are not coroutines, and for the blocking
+            calls of coroutines, such as connecting and logging in.
         """
-        self.workqueue         = WorkQueue(mode = mode)
+        if coalesce and mode == 'async':
+            raise TypeError('coalesce is not supported in async mode')
+        tpp                    = threads_per_process
+        self.workqueue         = WorkQueue(mode                = mode,
+                                           stack_size          = stack_size,
+                                           threads_per_process = tpp,
+                                           blocking_threads    = blocking_threads,
+                                           collection          = collection)
         self.account_manager   = AccountManager()
-        self.pipe_handlers     = weakref.WeakValueDictionary()
+        self.broker            = _PipeBroker(self.account_manager)
         self.domain            = domain
         self.verbose           = verbose
         self.stdout            = stdout
         self.stderr            = stderr
         self.host_driver       = host_driver
+        self.coalesce          = coalesce
+        self.max_results       = max_results
+        self.session_pool      = session_pool
+        self.dump_function     = None
         self.devnull           = open(os.devnull, 'w')
         self.channel_map       = {'fatal_errors': self.stderr,
                                   'debug':        self.stdout}
@@ -235,9 +739,23 @@ class Queue(object):
         self.total             = 0
         self.failed            = 0
         self.status_bar_length = 0
+        self.feeders           = []
+        self.session_keys      = count()
         self.set_max_threads(max_threads)
+        self.broker.start()
+
+        # Functions can not be pickled, so a persistent collection only
+        # keeps a reference to them; see recover().
+        if collection is not None:
+            collection.set_dump_function(self._dump_job)
+
+        # Jobs are not started before an account is available for them.
+        self.workqueue.set_reserve_function(self._reserve_account)
+        self.broker.account_released_event.listen(self._check_accounts)
+        self.broker.connect_latency_event.listen(self._on_connect_latency)
 
         # Listen to what the workqueue is doing.
+        self.workqueue.worker_init_event.listen(self._on_worker_init)
         self.workqueue.job_init_event.listen(self._on_job_init)
         self.workqueue.job_started_event.listen(self._on_job_started)
         self.workqueue.job_error_event.listen(self._on_job_error)
@@ -301,10 +819,7 @@ class Queue(object):
 
             pipe.close()
         """
-        child = _PipeHandler(self.account_manager)
-        self.pipe_handlers[id(child)] = child
-        child.start()
-        return child.to_parent
+        return self.broker.create_pipe()
 
     def _del_status_bar(self):
         if self.status_bar_length == 0:
@@ -358,29 +873,91 @@ class Queue(object):
             return
         self._print('debug', msg)
 
+    def _on_worker_init(self, worker):
+        # Workers outlive the jobs, so join() must not wait for their
+        # pipe to be closed.
+        worker.context['pipe']   = self.broker.create_pipe(False)
+        worker.context['stdout'] = self.channel_map['connection']
+
     def _on_job_init(self, job):
         if job.data is None:
             job.data = {}
+        if self.session_pool is not None:
+            job.data['session_pool'] = self.session_pool
+        if self.workqueue.pool is not None and self.workqueue.mode != 'async':
+            return # The worker provides the pipe, see _on_worker_init().
         job.data['pipe']   = self._create_pipe()
         job.data['stdout'] = self.channel_map['connection']
 
     def _on_job_destroy(self, job):
-        job.data['pipe'].close()
+        pipe = job.data.get('pipe')
+        if pipe is not None:
+            pipe.close()
+
+    def _reserve_account(self, job):
+        # Called with the workqueue locked, before the job is started.
+        # Returns the account pool that the job waits for, or None if
+        # the job may start. Accounts that are attached to a host are
+        # acquired by the job itself, as before.
+        if not job.data or job.data.get('host') is None:
+            return None
+        host = job.data['host']
+        if host.get_account() is not None:
+            return None
+        pool = self.account_manager.get_account_pool_for(host)
+        if pool.n_accounts() == 0:
+            return None
+        account = pool.acquire_account(owner = job.id, blocking = False)
+        if account is None:
+            return pool
+        self.broker.add_reservation(account, job.id)
+        job.data['reserved_account']      = account.__hash__()
+        job.data['reserved_account_name'] = account.get_name()
+        return None
+
+    def _check_accounts(self):
+        # Called by the broker whenever an account was released. Lets as
+        # many waiting jobs try again as there are free accounts.
+        collection = self.workqueue.collection
+        pools      = [p for m, p in self.account_manager.pools]
+        pools.append(self.account_manager.default_pool)
+        for pool in pools:
+            collection.unblock(pool, pool.n_unlocked())
+
+    def _release_reservation(self, job):
+        # Releases the account that was reserved for the job, unless the
+        # job took it over.
+        if not job.data or job.data.pop('reserved_account', None) is None:
+            return
+        job.data.pop('reserved_account_name', None)
+        self.broker.release_reservations(job.id)
 
     def _on_job_started(self, job):
         self._del_status_bar()
         self._print_status_bar()
 
     def _on_job_error(self, job, exc_info):
-        msg   = job.name + ' error: ' + str(exc_info[1])
-        trace = ''.join(format_exception(*exc_info))
-        self._print('errors', msg)
-        if _is_recoverable_error(exc_info[0]):
-            self._print('tracebacks', trace)
+        self._release_reservation(job)
+
+        # The outcome of a session is kept with the job, because in a
+        # worker process, the session is only a copy; see _Session.
+        if isinstance(exc_info[1], _SessionError):
+            job.data['session_outcomes'] = exc_info[1].outcomes
+            errors = exc_info[1].get_errors()
         else:
-            self._print('fatal_errors', trace)
+            errors = [exc_info]
+
+        for exc_info in errors:
+            msg   = job.name + ' error: ' + str(exc_info[1])
+            trace = ''.join(format_exception(*exc_info))
+            self._print('errors', msg)
+            if _is_recoverable_error(exc_info[0]):
+                self._print('tracebacks', trace)
+            else:
+                self._print('fatal_errors', trace)
 
     def _on_job_succeeded(self, job):
+        self._release_reservation(job)
         self._on_job_destroy(job)
         self.completed += 1
         self._print('status_bar', job.name + ' succeeded.')
@@ -415,6 +992,75 @@ class Queue(object):
         """
         return self.workqueue.get_max_threads()
 
+    def enable_autotune(self, min_threads, max_threads):
+        """
+        Instead of using a fixed number of concurrent connections, finds
+        the best number at runtime: The number of connections grows for
+        as long as jobs succeed, and shrinks when connections or jobs
+        time out, or when connecting becomes much slower.
+
+        @type  min_threads: int
+        @param min_threads: The lowest number of connections.
+        @type  max_threads: int
+        @param max_threads: The highest number of connections.
+        """
+        self.workqueue.enable_autotune(min_threads, max_threads)
+        autotuner = self.workqueue.autotuner
+        autotuner.threads_changed_event.listen(self._on_threads_changed)
+        self._update_verbosity()
+
+    def _on_threads_changed(self, threads):
+        # Output depends on whether more than one thread is running.
+        self._update_verbosity()
+
+    def _on_connect_latency(self, seconds):
+        autotuner = self.workqueue.autotuner
+        if autotuner is not None:
+            autotuner.add_latency(seconds)
+
+    def disable_autotune(self):
+        """
+        Stops adjusting the number of concurrent connections; the current
+        number is kept.
+        """
+        self.workqueue.disable_autotune()
+
+    def set_group_function(self, function):
+        """
+        Defines the concurrency groups of the hosts that are passed to
+        run() later. The given function is called with a L{Host}, and
+        returns the name of a group, a list of group names, or None.
+        Combined with L{set_group_limit()}, this allows for protecting
+        fragile devices (such as terminal servers or slow links) while
+        still running many other connections in parallel.
+
+        Example usage::
+
+            def get_site(host):
+                return host.get_name().split('-')[0]
+
+            queue = Queue(max_threads = 100)
+            queue.set_group_function(get_site)
+            queue.set_group_limit('lon', 5)
+
+        @type  function: callable
+        @param function: Returns the groups of a host.
+        """
+        self.workqueue.set_group_function(partial(_get_host_groups,
+                                                  function))
+
+    def set_group_limit(self, group, limit):
+        """
+        Sets the maximum number of concurrent connections to hosts of the
+        given group (see L{set_group_function()}).
+
+        @type  group: object
+        @param group: The name of the group.
+        @type  limit: int
+        @param limit: The maximum number of connections, or None.
+        """
+        self.workqueue.set_group_limit(group, limit)
+
     def add_account_pool(self, pool, match = None):
         """
         Adds a new account pool. If the given match argument is
@@ -442,6 +1088,11 @@ class Queue(object):
             # Finally, if all that fails and the default account pool
             contains no accounts, an error is raised.
 
+        If a host has no account attached, the account is reserved
+        before the job is started. While all accounts of the pool are
+        locked, the job waits in the queue, so that it does not occupy
+        a thread that jobs for other pools could use.
+
         Example usage::
 
             def do_nothing(conn):
@@ -493,6 +1144,9 @@ class Queue(object):
         @rtype:  bool
         @return: Whether all tasks are completed.
         """
+        for feeder in self.feeders:
+            if feeder.is_alive():
+                return False
         return self.workqueue.get_length() == 0
 
     def join(self):
@@ -500,9 +1154,10 @@ class Queue(object):
         Waits until all jobs are completed.
         """
         self._dbg(2, 'Waiting for the queue to finish.')
+        for feeder in self.feeders:
+            feeder.join()
         self.workqueue.wait_until_done()
-        for child in self.pipe_handlers.values():
-            child.join()
+        self.broker.wait_for_pipes()
         self._del_status_bar()
         self._print_status_bar()
         gc.collect()
@@ -542,6 +1197,9 @@ class Queue(object):
         finally:
             self._dbg(2, 'Destroying queue...')
             self.workqueue.destroy()
+            self.broker.stop()
+            if self.session_pool is not None:
+                self.session_pool.close()
             self.account_manager.reset()
             self.completed         = 0
             self.total             = 0
@@ -564,21 +1222,145 @@ class Queue(object):
         self._dbg(2, 'Queue reset.')
         self._del_status_bar()
 
-    def _run(self, hosts, callback, queue_function, *args):
+    def _dump_job(self, job):
+        # Called by a persistent collection to get what it stores for
+        # the given job.
+        host      = job.data and job.data.get('host')
+        reference = None
+        if self.dump_function is not None:
+            reference = self.dump_function(host)
+        retry_delay = job.retry_delay
+        if callable(retry_delay):
+            retry_delay = None
+        return reference, job.name, job.times, host, retry_delay, job.deadline
+
+    def _load_job(self, function, stored):
+        # Rebuilds a job from what _dump_job() returned.
+        reference, name, times, host, retry_delay, deadline = stored
+        callback = function(reference, host)
+        if callback is None:
+            return None
+        self.total += 1
+        if host is None:
+            return Job(callback, name, times, None, retry_delay, deadline)
+        return Job(_prepare_connection(callback),
+                   name,
+                   times,
+                   {'host': host},
+                   retry_delay,
+                   deadline)
+
+    def set_dump_function(self, function):
+        """
+        Defines what the persistent collection of the queue stores
+        instead of the functions of the jobs that are added later,
+        because functions can not be pickled. The stored object is
+        passed to the function that is given to recover().
+
+        @type  function: callable
+        @param function: Called with the host of a job (or None if the
+            job has no host), returns a picklable object.
+        """
+        self.dump_function = function
+
+    def recover(self, function):
+        """
+        Restores the jobs that the persistent collection of the queue
+        kept from an earlier run, e.g. before the process was restarted;
+        see L{Exscript.workqueue.WorkQueue.recover()}. The restored jobs
+        keep their ids.
+
+        @type  function: callable
+        @param function: Called with the object that the dump function
+            returned for a job and with its host (or None), returns the
+            function to call, as passed to run() or enqueue(), or None
+            to drop the job.
+        @rtype:  list[int]
+        @return: The ids of the restored jobs.
+        """
+        return self.workqueue.recover(partial(self._load_job, function))
+
+    def _enqueue(self, task, queue_function, *args, **kwargs):
+        # The queue is locked until the job id was added to the task, so
+        # that the job can not complete before the task knows about it.
+        def enqueue(collection):
+            job_id = queue_function(*args, **kwargs)
+            if job_id is not None:
+                task.add_job_id(job_id)
+            return job_id
+        return self.workqueue.collection.with_lock(enqueue)
+
+    def _enqueue_many(self, task, queue_function, *args, **kwargs):
+        # Like _enqueue(), but for functions that enqueue a list of jobs.
+        def enqueue(collection):
+            job_ids = queue_function(*args, **kwargs)
+            for job_id in job_ids:
+                if job_id is not None:
+                    task.add_job_id(job_id)
+            return job_ids
+        return self.workqueue.collection.with_lock(enqueue)
+
+    def _enqueue_hosts(self, task, hosts, callback, queue_function, *args):
         hosts       = to_hosts(hosts, default_domain = self.domain)
         self.total += len(hosts)
-        callback    = _prepare_connection(callback)
-        task        = Task(self.workqueue)
+        jobs        = []
         for host in hosts:
-            name   = host.get_name()
-            data   = {'host': host}
-            job_id = queue_function(callback, name, *args, data = data)
-            if job_id is not None:
-                task.add_job_id(job_id)
-
             if self.host_driver is not None:
                 host.set_option('driver', self.host_driver)
+            jobs.append((host.get_name(), {'host': host}))
+        self._enqueue_many(task, queue_function, callback, jobs, *args)
 
+    def _feed(self, task, hosts, callback, queue_function, *args):
+        # Pulls hosts from the iterator whenever the number of pending
+        # jobs drops below twice the number of threads.
+        collection = self.workqueue.collection
+        try:
+            while True:
+                room  = collection.wait_for_room(2 * self.get_max_threads())
+                batch = list(islice(hosts, room))
+                if not batch:
+                    break
+                self._enqueue_hosts(task,
+                                    batch,
+                                    callback,
+                                    queue_function,
+                                    *args)
+        finally:
+            task.close()
+            self._dbg(2, 'All jobs enqueued.')
+
+    def _merge_session(self, job, session):
+        # Called with the queue locked to add the functions of the given
+        # session to a job that was not started yet.
+        if not isinstance(job.func, _Session):
+            return False
+        job.func    = _Session(job.func.functions + session.functions)
+        self.total -= 1 # No new job was added for the host.
+        return True
+
+    def _run(self, hosts, callback, queue_function, *args):
+        if is_coroutine_function(callback) and self.workqueue.mode != 'async':
+            raise TypeError('coroutines are only supported in async mode')
+        if isinstance(callback, _Session):
+            key  = callback.functions[0][0]
+            task = _SessionTask(self.workqueue, self.max_results, key)
+        else:
+            callback = _prepare_connection(callback)
+            task     = Task(self.workqueue, self.max_results)
+        if _is_iterator(hosts):
+            task.open()
+            feeder = threading.Thread(target = self._feed,
+                                      args   = (task,
+                                                hosts,
+                                                callback,
+                                                queue_function) + args)
+            feeder.daemon = True
+            self.feeders  = [f for f in self.feeders if f.is_alive()]
+            self.feeders.append(feeder)
+            feeder.start()
+            return task
+
+        self._enqueue_hosts(task, hosts, callback, queue_function, *args)
         if task.is_completed():
             self._dbg(2, 'No jobs enqueued.')
             return None
@@ -586,7 +1368,13 @@ class Queue(object):
         self._dbg(2, 'All jobs enqueued.')
         return task
 
-    def run(self, hosts, function, attempts = 1):
+    def run(self,
+            hosts,
+            function,
+            attempts    = 1,
+            priority    = 0,
+            retry_delay = None,
+            deadline    = None):
         """
         Add the given function to a queue, and call it once for each host
         according to the threading options.
@@ -596,18 +1384,77 @@ class Queue(object):
         Returns an object that represents the queued task, and that may be
         passed to is_completed() to check the status.
 
-        @type  hosts: string|list(string)|Host|list(Host)
+        If hosts is an iterator (or a generator), the hosts are not all
+        enqueued up front. Instead, they are pulled from the iterator in
+        the background, such that no more than twice max_threads jobs
+        are waiting in the queue at any time. The same applies to the
+        other run methods.
+
+        By default, a host is retried immediately after a failed attempt.
+        If a retry_delay is given, the host is retried after that many
+        seconds instead, and the delay is doubled with every failed
+        attempt (with some random variation). Alternatively, retry_delay
+        may be a function that is called with the number of failed
+        attempts and returns the delay in seconds. While a host waits to
+        be retried, it does not count against max_threads.
+
+        If a deadline is given, an attempt that takes longer than that
+        many seconds is aborted: the connection is closed, the error is
+        reported as a JobTimeoutException, and the thread is released.
+
+        If the queue was created with coalesce = True, and a host is
+        still waiting in the queue from an earlier call to run(), the
+        function is added to the waiting job (see L{Queue}).
+
+        The return values of the function are collected in the returned
+        task, and may be read using L{Task.results()}, even in
+        multiprocessing mode::
+
+            task = queue.run(hosts, get_version)
+            task.wait()
+            for hostname, version in task.results():
+                print hostname, version
+
+        @type  hosts: string|list(string)|Host|list(Host)|iterator
         @param hosts: A hostname or Host object, or a list of them.
         @type  function: function
         @param function: The function to execute.
         @type  attempts: int
         @param attempts: The number of attempts on failure.
+        @type  priority: int
+        @param priority: Tasks with a higher priority are started first.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed host is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  object
         @return: An object representing the task.
         """
-        return self._run(hosts, function, self.workqueue.enqueue, attempts)
-
-    def run_or_ignore(self, hosts, function, attempts = 1):
+        if self.coalesce:
+            merge = self._merge_session
+            def enqueue(function, jobs, times):
+                return self.workqueue.enqueue_many_or_merge(function,
+                                                            jobs,
+                                                            merge,
+                                                            times,
+                                                            priority,
+                                                            retry_delay,
+                                                            deadline)
+            session = _Session([(self.session_keys.next(), function)])
+            return self._run(hosts, session, enqueue, attempts)
+        enqueue = partial(self.workqueue.enqueue_many,
+                          priority    = priority,
+                          retry_delay = retry_delay,
+                          deadline    = deadline)
+        return self._run(hosts, function, enqueue, attempts)
+
+    def run_or_ignore(self,
+                      hosts,
+                      function,
+                      attempts    = 1,
+                      priority    = 0,
+                      retry_delay = None,
+                      deadline    = None):
         """
         Like run(), but only appends hosts that are not already in the
         queue.
@@ -618,15 +1465,27 @@ class Queue(object):
         @param function: The function to execute.
         @type  attempts: int
         @param attempts: The number of attempts on failure.
+        @type  priority: int
+        @param priority: Tasks with a higher priority are started first.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed host is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  object
         @return: A task object, or None if all hosts were duplicates.
         """
-        return self._run(hosts,
-                         function,
-                         self.workqueue.enqueue_or_ignore,
-                         attempts)
-
-    def priority_run(self, hosts, function, attempts = 1):
+        enqueue = partial(self.workqueue.enqueue_many_or_ignore,
+                          priority    = priority,
+                          retry_delay = retry_delay,
+                          deadline    = deadline)
+        return self._run(hosts, function, enqueue, attempts)
+
+    def priority_run(self,
+                     hosts,
+                     function,
+                     attempts    = 1,
+                     retry_delay = None,
+                     deadline    = None):
         """
         Like run(), but adds the task to the front of the queue.
 
@@ -636,16 +1495,24 @@ class Queue(object):
         @param function: The function to execute.
         @type  attempts: int
         @param attempts: The number of attempts on failure.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed host is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  object
         @return: An object representing the task.
         """
-        return self._run(hosts,
-                         function,
-                         self.workqueue.priority_enqueue,
-                         False,
-                         attempts)
-
-    def priority_run_or_raise(self, hosts, function, attempts = 1):
+        enqueue = partial(self.workqueue.priority_enqueue_many,
+                          retry_delay = retry_delay,
+                          deadline    = deadline)
+        return self._run(hosts, function, enqueue, False, attempts)
+
+    def priority_run_or_raise(self,
+                              hosts,
+                              function,
+                              attempts    = 1,
+                              retry_delay = None,
+                              deadline    = None):
         """
         Like priority_run(), but if a host is already in the queue, the
         existing host is moved to the top of the queue instead of enqueuing
@@ -657,16 +1524,32 @@ class Queue(object):
         @param function: The function to execute.
         @type  attempts: int
         @param attempts: The number of attempts on failure.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed host is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  object
         @return: A task object, or None if all hosts were duplicates.
         """
-        return self._run(hosts,
-                         function,
-                         self.workqueue.priority_enqueue_or_raise,
-                         False,
-                         attempts)
-
-    def force_run(self, hosts, function, attempts = 1):
+        def enqueue(function, jobs, force_start, times):
+            # Every host may move an existing job, so there is no bulk
+            # variant of priority_enqueue_or_raise().
+            return [self.workqueue.priority_enqueue_or_raise(function,
+                                                             name,
+                                                             force_start,
+                                                             times,
+                                                             data,
+                                                             retry_delay,
+                                                             deadline)
+                    for name, data in jobs]
+        return self._run(hosts, function, enqueue, False, attempts)
+
+    def force_run(self,
+                  hosts,
+                  function,
+                  attempts    = 1,
+                  retry_delay = None,
+                  deadline    = None):
         """
         Like priority_run(), but starts the task immediately even if that
         max_threads is exceeded.
@@ -677,16 +1560,25 @@ class Queue(object):
         @param function: The function to execute.
         @type  attempts: int
         @param attempts: The number of attempts on failure.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed host is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  object
         @return: An object representing the task.
         """
-        return self._run(hosts,
-                         function,
-                         self.workqueue.priority_enqueue,
-                         True,
-                         attempts)
-
-    def enqueue(self, function, name = None, attempts = 1):
+        enqueue = partial(self.workqueue.priority_enqueue_many,
+                          retry_delay = retry_delay,
+                          deadline    = deadline)
+        return self._run(hosts, function, enqueue, True, attempts)
+
+    def enqueue(self,
+                function,
+                name        = None,
+                attempts    = 1,
+                priority    = 0,
+                retry_delay = None,
+                deadline    = None):
         """
         Places the given function in the queue and calls it as soon
         as a thread is available. To pass additional arguments to the
@@ -698,13 +1590,24 @@ class Queue(object):
         @param name: A name for the task.
         @type  attempts: int
         @param attempts: The number of attempts on failure.
+        @type  priority: int
+        @param priority: Tasks with a higher priority are started first.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed attempt is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  object
         @return: An object representing the task.
         """
         self.total += 1
-        task   = Task(self.workqueue)
-        job_id = self.workqueue.enqueue(function, name, attempts)
-        if job_id is not None:
-            task.add_job_id(job_id)
+        task = Task(self.workqueue, self.max_results)
+        self._enqueue(task,
+                      self.workqueue.enqueue,
+                      function,
+                      name,
+                      attempts,
+                      priority    = priority,
+                      retry_delay = retry_delay,
+                      deadline    = deadline)
         self._dbg(2, 'Function enqueued.')
         return task
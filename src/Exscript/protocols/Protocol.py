@@ -29,10 +29,12 @@ from Exscript.util.crypt import otp
 from Exscript.util.event import Event
 from Exscript.util.cast import to_regexs
 from Exscript.util.tty import get_terminal_size
+from Exscript.util.coroutine import Return, readable, blocking
 from Exscript.protocols.drivers import driver_map, Driver
 from Exscript.protocols.OsGuesser import OsGuesser
 from Exscript.protocols.Exception import InvalidCommandException, \
                                          LoginFailure, \
+                                         ProtocolException, \
                                          TimeoutException, \
                                          DriverReplacedException, \
                                          ExpectCancelledException
@@ -587,6 +589,19 @@ class Protocol(object):
             self.host = hostname
         return self._connect_hook(self.host, port)
 
+    def connect_async(self, hostname = None, port = None):
+        """
+        Like connect(), but returns a coroutine; see
+        L{Exscript.util.coroutine}. The connection is opened in a thread.
+
+        @type  hostname: string
+        @param hostname: The remote host or IP address.
+        @type  port: int
+        @param port: The remote TCP port number.
+        """
+        result = yield blocking(self.connect, hostname, port)
+        raise Return(result)
+
     def _get_account(self, account):
         if isinstance(account, Context) or isinstance(account, _Context):
             return account.context()
@@ -629,6 +644,21 @@ class Protocol(object):
                 self.expect_prompt()
             self.auto_app_authorize(app_account, flush = flush)
 
+    def login_async(self, account = None, app_account = None, flush = True):
+        """
+        Like login(), but returns a coroutine; see
+        L{Exscript.util.coroutine}. Since acquiring the account may
+        block, the login is performed in a thread.
+
+        @type  account: Account
+        @param account: The account for protocol level authentication.
+        @type  app_account: Account
+        @param app_account: The account for app level authentication.
+        @type  flush: bool
+        @param flush: Whether to flush the last prompt from the buffer.
+        """
+        yield blocking(self.login, account, app_account, flush)
+
     def authenticate(self, account = None, app_account = None, flush = True):
         """
         Like login(), but skips the authorization procedure.
@@ -920,12 +950,94 @@ class Protocol(object):
         self.send(command + '\r')
         return self.expect_prompt()
 
+    def execute_async(self, command):
+        """
+        Like execute(), but returns a coroutine; see
+        L{Exscript.util.coroutine}.
+
+        @type  command: string
+        @param command: The data that is sent to the remote host.
+        """
+        self.send(command + '\r')
+        result = yield self.expect_prompt_async()
+        raise Return(result)
+
     def _domatch(self, prompt, flush):
         """
         Should be overwritten.
         """
         raise NotImplementedError()
 
+    def _get_fileobj(self):
+        """
+        May be overwritten to return an object with a fileno() method
+        that is readable when _read_available() has data to read. If None
+        is returned, _domatch() is assumed not to block.
+        """
+        return None
+
+    def _read_available(self):
+        """
+        Should be overwritten if _get_fileobj() is. Reads the data that
+        can be read without blocking into the buffer. Returns True if
+        data was read, False on EOF, and None if nothing is available.
+        """
+        raise NotImplementedError()
+
+    def _clear_cancel(self):
+        """
+        May be overwritten to reset what cancel_expect() did.
+        """
+        pass
+
+    def _domatch_async(self, prompt, flush):
+        fileobj = self._get_fileobj()
+        if fileobj is None:
+            raise Return(self._domatch(prompt, flush))
+
+        search_window_size = 150
+        window_size        = search_window_size
+        while True:
+            # A driver that is replaced while data is received also
+            # replaces the prompts that are searched for.
+            if self.driver_replaced:
+                self.driver_replaced = False
+                self._clear_cancel()
+                raise DriverReplacedException()
+
+            # Everything that arrived since the last check is searched,
+            # plus the end of the data before it, in case the prompt
+            # spans both.
+            driver        = self.get_driver()
+            search_window = self.buffer.tail(window_size)
+            search_window, incomplete_tail = driver.clean_response_for_re_match(search_window)
+            match         = None
+            for n, regex in enumerate(prompt):
+                match = regex.search(search_window)
+                if match is not None:
+                    break
+
+            if match is not None:
+                end = self.buffer.size() - len(search_window) + match.end()
+                if flush:
+                    self.response = self.buffer.pop(end)
+                else:
+                    self.response = self.buffer.head(end)
+                raise Return((n, match))
+
+            size      = self.buffer.size()
+            available = self._read_available()
+            if available is None:
+                if not (yield readable(fileobj, self.timeout)):
+                    error = 'Timeout while waiting for response from device'
+                    raise TimeoutException(error)
+                window_size = search_window_size
+                continue
+            if not available:
+                error = 'EOF while waiting for response from device'
+                raise ProtocolException(error)
+            window_size = self.buffer.size() - size + search_window_size
+
     def _waitfor(self, prompt):
         re_list  = to_regexs(prompt)
         patterns = [p.pattern for p in re_list]
@@ -973,6 +1085,23 @@ class Protocol(object):
                 continue # retry
             return result
 
+    def waitfor_async(self, prompt):
+        """
+        Like waitfor(), but returns a coroutine; see
+        L{Exscript.util.coroutine}. Instead of blocking a thread, the
+        coroutine waits in the event loop until data is received.
+
+        @type  prompt: str|re.RegexObject|list(str|re.RegexObject)
+        @param prompt: One or more regular expressions.
+        """
+        re_list = to_regexs(prompt)
+        while True:
+            try:
+                result = yield self._domatch_async(re_list, False)
+            except DriverReplacedException:
+                continue # retry
+            raise Return(result)
+
     def _expect(self, prompt):
         result = self._domatch(to_regexs(prompt), True)
         return result
@@ -1003,6 +1132,22 @@ class Protocol(object):
                 continue # retry
             return result
 
+    def expect_async(self, prompt):
+        """
+        Like expect(), but returns a coroutine; see
+        L{Exscript.util.coroutine}.
+
+        @type  prompt: str|re.RegexObject|list(str|re.RegexObject)
+        @param prompt: One or more regular expressions.
+        """
+        re_list = to_regexs(prompt)
+        while True:
+            try:
+                result = yield self._domatch_async(re_list, True)
+            except DriverReplacedException:
+                continue # retry
+            raise Return(result)
+
     def expect_prompt(self):
         """
         Monitors the data received from the remote host and waits for a
@@ -1018,7 +1163,19 @@ class Protocol(object):
           and the match object.
         """
         result = self.expect(self.get_prompt())
+        self._check_response()
+        return result
+
+    def expect_prompt_async(self):
+        """
+        Like expect_prompt(), but returns a coroutine; see
+        L{Exscript.util.coroutine}.
+        """
+        result = yield self.expect_async(self.get_prompt())
+        self._check_response()
+        raise Return(result)
 
+    def _check_response(self):
         # We skip the first line because it contains the echo of the command
         # sent.
         self._dbg(5, "Checking %s for errors" % repr(self.response))
@@ -1030,8 +1187,6 @@ class Protocol(object):
                 self._dbg(5, "error prompt (%s) matches %s" % args)
                 raise InvalidCommandException('Device said:\n' + self.response)
 
-        return result
-
     def add_monitor(self, pattern, callback, limit = 80):
         """
         Calls the given function whenever the given pattern matches the
@@ -1048,8 +1203,9 @@ class Protocol(object):
         @type  callback: callable
         @param callback: The function that is called.
         @type  limit: int
-        @param limit: The maximum size of the tail of the buffer
-                      that is searched, in number of bytes.
+        @param limit: The number of bytes before newly received data
+                      that are searched as well, so that matches which
+                      span several chunks of data are found.
         """
         self.buffer.add_monitor(pattern, partial(callback, self), limit)
 
@@ -17,7 +17,6 @@ SSH version 2 support, based on paramiko.
 """
 import os
 import time
-import select
 import socket
 import paramiko
 import Crypto
@@ -28,6 +27,7 @@ from paramiko.ssh_exception import SSHException, \
                                    AuthenticationException, \
                                    BadHostKeyException
 from Exscript.util.tty            import get_terminal_size
+from Exscript.util.wakeup         import WakeupPipe
 from Exscript.PrivateKey          import PrivateKey
 from Exscript.protocols.Protocol  import Protocol
 from Exscript.protocols.Exception import ProtocolException, \
@@ -49,12 +49,14 @@ class SSH2(Protocol):
     The secure shell protocol version 2 adapter, based on Paramiko.
     """
     KEEPALIVE_INTERVAL = 2.5 * 60    # Two and a half minutes
+    READ_SIZE          = 64 * 1024   # Maximum number of bytes per read
 
     def __init__(self, **kwargs):
         Protocol.__init__(self, **kwargs)
         self.client = None
         self.shell  = None
         self.cancel = False
+        self.wakeup = WakeupPipe()
 
         # Since each protocol may be created in it's own thread, we must
         # re-initialize the random number generator to make sure that
@@ -258,6 +260,8 @@ class SSH2(Protocol):
     def _connect_hook(self, hostname, port):
         self.host   = hostname
         self.port   = port or 22
+        if self.wakeup.reader is None:
+            self.wakeup = WakeupPipe() # Closed by a previous close().
         self.client = self._paramiko_connect()
         self._load_system_host_keys()
         return True
@@ -288,22 +292,29 @@ class SSH2(Protocol):
         self.shell.sendall(data)
 
     def _wait_for_data(self):
+        # Returns True if data is available or the expect was cancelled,
+        # False if the timeout passed.
+        if self.shell.recv_ready():
+            return True
         end = time.time() + self.timeout
-        while True:
-            readable, writeable, excp = select.select([self.shell], [], [], 1)
-            if readable:
+        while not self.cancel:
+            if self.wakeup.wait(self.shell, end):
                 return True
-            if time.time() > end:
+            if time.time() >= end:
                 return False
+        return True
 
     def _fill_buffer(self):
         # Wait for a response of the device.
         if not self._wait_for_data():
             error = 'Timeout while waiting for response from device'
             raise TimeoutException(error)
+        if self.cancel:
+            return True
 
-        # Read the response.
-        data = self.shell.recv(200)
+        # Read whatever the channel has buffered, and process it as one
+        # chunk.
+        data = self.shell.recv(self.READ_SIZE)
         if not data:
             return False
         self._receive_cb(data)
@@ -314,10 +325,14 @@ class SSH2(Protocol):
         self._dbg(1, "Expecting a prompt")
         self._dbg(2, "Expected pattern: " + repr(p.pattern for p in prompt))
         search_window_size = 150
+        window_size        = search_window_size
         while not self.cancel:
-            # Check whether what's buffered matches the prompt.
+            # Check whether what's buffered matches the prompt. A chunk may
+            # hold more than the search window, so everything that arrived
+            # since the last check is searched, plus the end of the data
+            # before it, in case the prompt spans both.
             driver        = self.get_driver()
-            search_window = self.buffer.tail(search_window_size)
+            search_window = self.buffer.tail(window_size)
             search_window, incomplete_tail = driver.clean_response_for_re_match(search_window)
             match         = None
             for n, regex in enumerate(prompt):
@@ -326,9 +341,11 @@ class SSH2(Protocol):
                     break
 
             if not match:
+                size = self.buffer.size()
                 if not self._fill_buffer():
                     error = 'EOF while waiting for response from device'
                     raise ProtocolException(error)
+                window_size = self.buffer.size() - size + search_window_size
                 continue
 
             end = self.buffer.size() - len(search_window) + match.end()
@@ -345,8 +362,29 @@ class SSH2(Protocol):
             raise DriverReplacedException()
         raise ExpectCancelledException()
 
+    def _get_fileobj(self):
+        return self.shell
+
+    def _read_available(self):
+        # recv() only blocks if the channel is neither ready nor closed.
+        shell = self.shell
+        if not shell.recv_ready() \
+           and not shell.eof_received \
+           and not shell.closed:
+            return None
+        data = shell.recv(self.READ_SIZE)
+        if not data:
+            return False
+        self._receive_cb(data)
+        self.buffer.append(data)
+        return True
+
+    def _clear_cancel(self):
+        self.cancel = False
+
     def cancel_expect(self):
         self.cancel = True
+        self.wakeup.wake()
 
     def _set_terminal_size(self, rows, cols):
         self.shell.resize_pty(cols, rows)
@@ -363,4 +401,5 @@ class SSH2(Protocol):
         self.shell = None
         self.client.close()
         self.client = None
+        self.wakeup.close()
         self.buffer.clear()
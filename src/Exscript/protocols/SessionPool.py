@@ -0,0 +1,267 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Keeps authenticated connections open between jobs.
+"""
+import os
+import time
+import threading
+from itertools import count
+from weakref import WeakKeyDictionary
+
+# Maps pool ids to the pool of this process; see SessionPool.__reduce__().
+_pools      = {}
+_pools_lock = threading.Lock()
+_pool_ids   = count(1)
+
+def _get_pool(pool_id, *args):
+    with _pools_lock:
+        pool = _pools.get(pool_id)
+    if pool is not None:
+        return pool
+    pool = SessionPool(*args)
+    with _pools_lock:
+        del _pools[pool.id]
+        pool.id = pool_id
+        return _pools.setdefault(pool_id, pool)
+
+# The attributes of a protocol adapter that a job may change, and that
+# are restored before the session is passed to the next job.
+_settings = ('manual_driver',
+             'manual_user_re',
+             'manual_password_re',
+             'manual_prompt_re',
+             'manual_error_re',
+             'manual_login_error_re',
+             'timeout',
+             'connect_timeout')
+
+def _close(conn):
+    try:
+        conn.close(force = True)
+    except Exception:
+        pass # The connection is dead already.
+
+class SessionPool(object):
+    """
+    Keeps connections that are logged in open after use, so that the
+    next job for the same host does not have to connect and log in
+    again. Sessions are stored under a key, such as a (protocol,
+    address, port, account name) tuple, so that a session is only
+    reused for the same host and account.
+
+    Before a session is handed out again, it is probed by sending a
+    newline and waiting for the prompt; sessions that fail the probe
+    are closed and dropped. Idle sessions are also closed after the
+    given number of seconds, and no more than max_per_host idle
+    sessions are kept for any host.
+
+    Whatever a job attached to a session, such as event listeners and
+    buffer monitors, is removed when it is checked in. The driver,
+    prompts, and timeouts of a session that was passed to register()
+    are reset to what they were at that time; other sessions are
+    only pooled if no driver or prompt was set on them.
+
+    A pool may be passed to other processes (e.g. in the data of a job
+    in 'processpool' mode); every process then uses a pool of its own
+    with the same settings, because connections can not be shared.
+    """
+
+    def __init__(self, max_idle = 300, max_per_host = 1, probe_timeout = 5):
+        """
+        Constructor.
+
+        @type  max_idle: int
+        @param max_idle: The number of seconds after which an idle
+            session is closed.
+        @type  max_per_host: int
+        @param max_per_host: The maximum number of idle sessions per host.
+        @type  probe_timeout: int
+        @param probe_timeout: The number of seconds to wait for the prompt
+            when probing a session, or None to hand out sessions without
+            probing them.
+        """
+        self.id            = '%d-%d' % (os.getpid(), _pool_ids.next())
+        self.max_idle      = max_idle
+        self.max_per_host  = max_per_host
+        self.probe_timeout = probe_timeout
+        self.lock          = threading.Lock()
+        self.idle          = {} # Maps keys to a list of (time, session).
+        self.settings      = WeakKeyDictionary() # See register().
+        self.timer         = None
+
+        with _pools_lock:
+            _pools[self.id] = self
+
+    def __reduce__(self):
+        args = self.max_idle, self.max_per_host, self.probe_timeout
+        return _get_pool, (self.id,) + args
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(sessions) for sessions in self.idle.itervalues())
+
+    def _count_host(self, host):
+        return sum(len(sessions)
+                   for key, sessions in self.idle.iteritems()
+                   if key[1] == host)
+
+    def _take_expired(self):
+        # Removes the expired sessions from the pool, and returns them.
+        expired = []
+        limit   = time.time() - self.max_idle
+        for key, sessions in self.idle.items():
+            while sessions and sessions[0][0] < limit:
+                expired.append(sessions.pop(0)[1])
+            if not sessions:
+                del self.idle[key]
+        return expired
+
+    def _schedule(self):
+        # Called with the lock acquired. Arms the timer that closes the
+        # session that expires first, if it is not armed already.
+        if self.timer is not None or not self.idle:
+            return
+        oldest = min(sessions[0][0] for sessions in self.idle.itervalues())
+        delay  = max(0, oldest + self.max_idle - time.time()) + .01
+        self.timer = threading.Timer(delay, self._on_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _on_timer(self):
+        with self.lock:
+            self.timer = None
+            expired    = self._take_expired()
+            self._schedule()
+        for conn in expired:
+            _close(conn)
+
+    def _reset(self, conn):
+        # Returns False if the session can not be restored to a state
+        # that is safe to pass to another job.
+        conn.data_received_event.disconnect_all()
+        conn.otp_requested_event.disconnect_all()
+        del conn.buffer.monitors[:]
+        settings = self.settings.get(conn)
+        if settings is None:
+            return all(getattr(conn, name) is None
+                       for name in _settings
+                       if name.startswith('manual_'))
+        for name, value in zip(_settings, settings):
+            setattr(conn, name, value)
+        return True
+
+    def _probe(self, conn):
+        if self.probe_timeout is None:
+            return True
+        timeout = conn.get_timeout()
+        conn.set_timeout(self.probe_timeout)
+        try:
+            conn.execute('')
+        except Exception:
+            return False
+        finally:
+            conn.set_timeout(timeout)
+        return True
+
+    def expire(self):
+        """
+        Closes all sessions that were idle for longer than max_idle.
+        """
+        with self.lock:
+            expired = self._take_expired()
+        for conn in expired:
+            _close(conn)
+
+    def register(self, conn):
+        """
+        Remembers the driver, prompts, and timeouts of the given session,
+        so that they are restored whenever it is checked in. This should
+        be called before the session is used by a job.
+
+        @type  conn: Protocol
+        @param conn: A new protocol adapter.
+        """
+        self.settings[conn] = tuple(getattr(conn, name) for name in _settings)
+
+    def checkout(self, key):
+        """
+        Removes a live session with the given key from the pool, and
+        returns it. The caller owns the session until it is passed to
+        checkin().
+
+        @type  key: tuple
+        @param key: The key; the second item is the address of the host.
+        @rtype:  Protocol
+        @return: A connected and logged in protocol adapter, or None.
+        """
+        while True:
+            with self.lock:
+                expired  = self._take_expired()
+                sessions = self.idle.get(key)
+                conn     = None
+                if sessions:
+                    conn = sessions.pop()[1]
+                    if not sessions:
+                        del self.idle[key]
+            for dead in expired:
+                _close(dead)
+            if conn is None:
+                return None
+            if self._probe(conn):
+                return conn
+            _close(conn)
+
+    def checkin(self, key, conn):
+        """
+        Returns the given session into the pool, or closes it if the
+        host already has max_per_host idle sessions, if the session is
+        not logged in, or if a driver or prompt was set on it and it was
+        not passed to register().
+
+        @type  key: tuple
+        @param key: The key; the second item is the address of the host.
+        @type  conn: Protocol
+        @param conn: A connected protocol adapter.
+        """
+        if not conn.is_app_authenticated() or not self._reset(conn):
+            _close(conn)
+            return
+        with self.lock:
+            expired = self._take_expired()
+            if self._count_host(key[1]) >= self.max_per_host:
+                expired.append(conn)
+            else:
+                self.idle.setdefault(key, []).append((time.time(), conn))
+                self._schedule()
+        for dead in expired:
+            _close(dead)
+
+    def close(self):
+        """
+        Closes all idle sessions, and removes the pool from the registry
+        of this process.
+        """
+        with _pools_lock:
+            _pools.pop(self.id, None)
+        with self.lock:
+            sessions  = [conn for idle in self.idle.itervalues()
+                         for idle_since, conn in idle]
+            self.idle = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        for conn in sessions:
+            _close(conn)
@@ -16,6 +16,7 @@
 The Telnet protocol.
 """
 from Exscript.util.tty            import get_terminal_size
+from Exscript.util.coroutine      import Return
 from Exscript.protocols           import telnetlib
 from Exscript.protocols.Protocol  import Protocol
 from Exscript.protocols.Exception import ProtocolException, \
@@ -95,8 +96,41 @@ class Telnet(Protocol):
 
         return result, match
 
+    def _get_fileobj(self):
+        return self.tn
+
+    def _read_available(self):
+        # process_rawq() passes the data to _telnetlib_received(). A
+        # telnet command sequence that was only partially received is
+        # kept in the raw queue until the rest of it arrives, because
+        # reading it here would block the reactor.
+        if self.tn.eof:
+            return False
+        if not self.tn.sock_avail():
+            return None
+        size = self.buffer.size()
+        self.tn.fill_rawq()
+        self.tn.process_rawq(block = False)
+        if self.tn.eof:
+            return False
+        if self.buffer.size() == size:
+            return None
+        return True
+
+    def _clear_cancel(self):
+        self.tn.cancel_expect = False
+
+    def _domatch_async(self, prompt, flush):
+        result = yield Protocol._domatch_async(self, prompt, flush)
+
+        # telnetlib keeps its own copy of the data that was not yet
+        # matched, which the synchronous expect() searches.
+        if flush:
+            self.tn.cookedq_skip(len(self.response))
+        raise Return(result)
+
     def cancel_expect(self):
-        self.tn.cancel_expect = True
+        self.tn.cancel()
 
     def _set_terminal_size(self, rows, cols):
         self.tn.set_window_size(rows, cols)
@@ -19,6 +19,7 @@ from Exscript.protocols.Protocol import Protocol
 from Exscript.protocols.Telnet import Telnet
 from Exscript.protocols.SSH2 import SSH2
 from Exscript.protocols.Dummy import Dummy
+from Exscript.protocols.SessionPool import SessionPool
 
 protocol_map = {'dummy':  Dummy,
                 'pseudo': Dummy,
@@ -43,11 +43,13 @@ import socket
 import select
 import struct
 from cStringIO import StringIO
+from Exscript.util.wakeup import WakeupPipe
 
 __all__ = ["Telnet"]
 
 # Tunable parameters
 DEBUGLEVEL = 0
+READ_SIZE  = 64 * 1024 # Maximum number of bytes per recv()
 
 # Telnet protocol defaults
 TELNET_PORT = 23
@@ -125,6 +127,11 @@ EXOPL = chr(255) # Extended-Options-List
 
 SEND_TTYPE = chr(1)
 
+class _IncompleteSequence(Exception):
+    """Raised if the raw queue ends in the middle of an IAC sequence,
+    and more data may not be read without blocking."""
+    pass
+
 class Telnet:
     """Telnet interface class.
 
@@ -178,6 +185,7 @@ class Telnet:
         self.port = port
         self.sock = None
         self.cancel_expect = False
+        self.wakeup = WakeupPipe()
         self.rawq = ''
         self.irawq = 0
         self.cookedq = StringIO()
@@ -251,6 +259,12 @@ class Telnet:
             self.sock.close()
         self.sock = 0
         self.eof = 1
+        self.wakeup.close()
+
+    def cancel(self):
+        """Make a waitfor() or expect() in another thread return -2."""
+        self.cancel_expect = True
+        self.wakeup.wake()
 
     def get_socket(self):
         """Return the socket object used internally."""
@@ -370,113 +384,137 @@ class Telnet:
         size = struct.pack('!HH', cols, rows)
         self.sock.send(IAC + SB + NAWS + size + IAC + SE)
 
-    def process_rawq(self):
+    def process_rawq(self, block=True):
         """Transfer from raw queue to cooked queue.
 
         Set self.eof when connection is closed.  Don't block unless in
-        the midst of an IAC sequence.
+        the midst of an IAC sequence.  If block is False, an incomplete
+        IAC sequence at the end of the raw queue is left there, to be
+        processed once the rest of it was received.
         """
-        buf = ''
+        buf = []
         try:
             while self.rawq:
-                # Handle non-IAC first (normal data).
-                char = self.rawq_getchar()
-                if char != IAC:
-                    buf = buf + char
-                    continue
-
-                # Interpret the command byte that follows after the IAC code.
-                command = self.rawq_getchar()
-                if command == theNULL:
-                    self.msg('IAC NOP')
-                    continue
-                elif command == IAC:
-                    self.msg('IAC DATA')
-                    buf = buf + command
-                    continue
+                # Copy the normal data up to the next IAC in one slice.
+                pos = self.rawq.find(IAC, self.irawq)
+                if pos < 0:
+                    buf.append(self.rawq[self.irawq:])
+                    self.rawq  = ''
+                    self.irawq = 0
+                    break
+                if pos > self.irawq:
+                    buf.append(self.rawq[self.irawq:pos])
+                    self.irawq = pos
 
-                # DO: Indicates the request that the other party perform,
-                # or confirmation that you are expecting the other party
-                # to perform, the indicated option.
-                elif command == DO:
-                    opt = self.rawq_getchar()
-                    self.msg('IAC DO %s', ord(opt))
-                    if opt == TTYPE:
-                        self.sock.send(IAC + WILL + opt)
-                    elif opt == NAWS:
-                        self.sock.send(IAC + WILL + opt)
-                        self.can_naws = True
-                        if self.window_size:
-                            self.set_window_size(*self.window_size)
-                    else:
-                        self.sock.send(IAC + WONT + opt)
-
-                # DON'T: Indicates the demand that the other party stop
-                # performing, or confirmation that you are no longer
-                # expecting the other party to perform, the indicated
-                # option.
-                elif command == DONT:
-                    opt = self.rawq_getchar()
-                    self.msg('IAC DONT %s', ord(opt))
-                    self.sock.send(IAC + WONT + opt)
-
-                # SB: Indicates that what follows is subnegotiation of the
-                # indicated option.
-                elif command == SB:
-                    opt = self.rawq_getchar()
-                    self.msg('IAC SUBCOMMAND %d', ord(opt))
-
-                    # We only handle the TTYPE command, so skip all other
-                    # commands.
-                    if opt != TTYPE:
-                        while self.rawq_getchar() != SE:
-                            pass
-                        continue
-
-                    # We also only handle the SEND_TTYPE option of TTYPE,
-                    # so skip everything else.
-                    subopt = self.rawq_getchar()
-                    if subopt != SEND_TTYPE:
-                        while self.rawq_getchar() != SE:
-                            pass
-                        continue
-
-                    # Mandatory end of the IAC subcommand.
-                    iac = self.rawq_getchar()
-                    end = self.rawq_getchar()
-                    if (iac, end) != (IAC, SE):
-                        # whoops, that's an unexpected response...
-                        self.msg('expected IAC SE, but got %d %d', ord(iac), ord(end))
-                    self.msg('IAC SUBCOMMAND_END')
-
-                    # Send the next supported terminal.
-                    ttype = self.termtype
-                    self.msg('indicating support for terminal type %s', ttype)
-                    self.sock.send(IAC + SB + TTYPE + theNULL + ttype + IAC + SE)
-                elif command in (WILL, WONT):
-                    opt = self.rawq_getchar()
-                    self.msg('IAC %s %d',
-                             command == WILL and 'WILL' or 'WONT', ord(opt))
-                    if opt == ECHO:
-                        self.sock.send(IAC + DO + opt)
-                    else:
-                        self.sock.send(IAC + DONT + opt)
-                else:
-                    self.msg('IAC %d not recognized' % ord(command))
+                # No reply is sent before a sequence was fully read, so an
+                # incomplete one can be parsed again from the start.
+                rawq, irawq = self.rawq, self.irawq
+                try:
+                    self._process_iac(buf, block)
+                except _IncompleteSequence:
+                    self.rawq  = rawq
+                    self.irawq = irawq
+                    break
         except EOFError: # raised by self.rawq_getchar()
             pass
+        buf = ''.join(buf)
         self.cookedq.write(buf)
         if self.data_callback is not None:
             self.data_callback(buf, **self.data_callback_kwargs)
 
-    def rawq_getchar(self):
+    def _process_iac(self, buf, block):
+        # Processes the IAC sequence at the start of the raw queue.
+        # Data that it contains is appended to buf.
+        self.rawq_getchar(block) # The IAC itself.
+
+        # Interpret the command byte that follows after the IAC code.
+        command = self.rawq_getchar(block)
+        if command == theNULL:
+            self.msg('IAC NOP')
+            return
+        elif command == IAC:
+            self.msg('IAC DATA')
+            buf.append(command)
+            return
+
+        # DO: Indicates the request that the other party perform,
+        # or confirmation that you are expecting the other party
+        # to perform, the indicated option.
+        elif command == DO:
+            opt = self.rawq_getchar(block)
+            self.msg('IAC DO %s', ord(opt))
+            if opt == TTYPE:
+                self.sock.send(IAC + WILL + opt)
+            elif opt == NAWS:
+                self.sock.send(IAC + WILL + opt)
+                self.can_naws = True
+                if self.window_size:
+                    self.set_window_size(*self.window_size)
+            else:
+                self.sock.send(IAC + WONT + opt)
+
+        # DON'T: Indicates the demand that the other party stop
+        # performing, or confirmation that you are no longer
+        # expecting the other party to perform, the indicated
+        # option.
+        elif command == DONT:
+            opt = self.rawq_getchar(block)
+            self.msg('IAC DONT %s', ord(opt))
+            self.sock.send(IAC + WONT + opt)
+
+        # SB: Indicates that what follows is subnegotiation of the
+        # indicated option.
+        elif command == SB:
+            opt = self.rawq_getchar(block)
+            self.msg('IAC SUBCOMMAND %d', ord(opt))
+
+            # We only handle the TTYPE command, so skip all other
+            # commands.
+            if opt != TTYPE:
+                self.rawq_skip_to(SE, block)
+                return
+
+            # We also only handle the SEND_TTYPE option of TTYPE,
+            # so skip everything else.
+            subopt = self.rawq_getchar(block)
+            if subopt != SEND_TTYPE:
+                self.rawq_skip_to(SE, block)
+                return
+
+            # Mandatory end of the IAC subcommand.
+            iac = self.rawq_getchar(block)
+            end = self.rawq_getchar(block)
+            if (iac, end) != (IAC, SE):
+                # whoops, that's an unexpected response...
+                self.msg('expected IAC SE, but got %d %d', ord(iac), ord(end))
+            self.msg('IAC SUBCOMMAND_END')
+
+            # Send the next supported terminal.
+            ttype = self.termtype
+            self.msg('indicating support for terminal type %s', ttype)
+            self.sock.send(IAC + SB + TTYPE + theNULL + ttype + IAC + SE)
+        elif command in (WILL, WONT):
+            opt = self.rawq_getchar(block)
+            self.msg('IAC %s %d',
+                     command == WILL and 'WILL' or 'WONT', ord(opt))
+            if opt == ECHO:
+                self.sock.send(IAC + DO + opt)
+            else:
+                self.sock.send(IAC + DONT + opt)
+        else:
+            self.msg('IAC %d not recognized' % ord(command))
+
+    def rawq_getchar(self, block=True):
         """Get next char from raw queue.
 
         Block if no data is immediately available.  Raise EOFError
-        when connection is closed.
+        when connection is closed.  If block is False, raise
+        _IncompleteSequence instead of blocking.
 
         """
         if not self.rawq:
+            if not block:
+                raise _IncompleteSequence()
             self.fill_rawq()
             if self.eof:
                 raise EOFError
@@ -487,6 +525,29 @@ class Telnet:
             self.irawq = 0
         return c
 
+    def rawq_skip_to(self, char, block=True):
+        """Drop everything up to and including the given char from the
+        raw queue.
+
+        Block if the char was not yet received.  Raise EOFError when
+        connection is closed.  If block is False, raise
+        _IncompleteSequence instead of blocking.
+
+        """
+        while True:
+            pos = self.rawq.find(char, self.irawq)
+            if pos >= 0:
+                self.irawq = pos
+                self.rawq_getchar()
+                return
+            if not block:
+                raise _IncompleteSequence()
+            self.rawq = ''
+            self.irawq = 0
+            self.fill_rawq()
+            if self.eof:
+                raise EOFError
+
     def fill_rawq(self):
         """Fill raw queue from exactly one recv() system call.
 
@@ -497,13 +558,24 @@ class Telnet:
         if self.irawq >= len(self.rawq):
             self.rawq = ''
             self.irawq = 0
-        # The buffer size should be fairly small so as to avoid quadratic
-        # behavior in process_rawq() above.
-        buf = self.sock.recv(64)
-        self.msg("recv %s", `buf`)
+        # process_rawq() copies the data between IAC sequences in slices,
+        # so large reads are cheap.
+        buf = self.sock.recv(READ_SIZE)
+        self.msg("recv %r", buf)
         self.eof = (not buf)
         self.rawq = self.rawq + buf
 
+    def cookedq_skip(self, size):
+        """Drop the given number of bytes from the start of the cooked
+        queue.
+
+        """
+        self.cookedq.seek(size)
+        rest = self.cookedq.read()
+        self.cookedq.seek(0)
+        self.cookedq.truncate()
+        self.cookedq.write(rest)
+
     def sock_avail(self):
         """Test whether data is available on the socket."""
         return select.select([self], [], [], 0) == ([self], [], [])
@@ -555,12 +627,12 @@ class Telnet:
 
     def _wait_for_data(self, timeout):
         end = time.time() + timeout
-        while True:
-            readable, writeable, excp = select.select([self.sock], [], [], 1)
-            if readable:
+        while not self.cancel_expect:
+            if self.wakeup.wait(self.sock, end):
                 return True
-            if time.time() > end:
+            if time.time() >= end:
                 return False
+        return True
 
     def _waitfor(self, list, timeout=None, flush=False, cleanup=None):
         re = None
@@ -575,32 +647,37 @@ class Telnet:
         self.msg("Expecting %s" % [l.pattern for l in list])
         incomplete_tail = ''
         clean_sw_size = search_window_size
+        checked = None
         while 1:
             self.process_rawq()
             if self.cancel_expect:
                 self.cancel_expect = False
                 self.msg('cancelling expect()')
                 return -2, None, ''
+            # A single read may cook much more than the search window, so
+            # everything that arrived since the last check is searched,
+            # plus the end of the data before it, in case the match spans
+            # both.
             qlen = self.cookedq.tell()
+            if checked is None:
+                checked = qlen
             if cleanup:
                 while 1:
-                    self.cookedq.seek(qlen - clean_sw_size - len(incomplete_tail) - head_loockback_size)
+                    self.cookedq.seek(max(checked - clean_sw_size - len(incomplete_tail) - head_loockback_size, 0))
                     search_window = self.cookedq.read()
                     search_window, incomplete_tail = cleanup(search_window)
-                    if clean_sw_size > qlen or len(search_window) >= search_window_size:
-                        search_window = search_window[-search_window_size:]
-                        if len(search_window) > search_window_size:
-                            clean_sw_size = clean_sw_size - search_window_size
+                    if clean_sw_size > checked or len(search_window) >= search_window_size:
                         break
                     else:
                         clean_sw_size = clean_sw_size + search_window_size
             else:
-                self.cookedq.seek(qlen - search_window_size)
+                self.cookedq.seek(max(checked - search_window_size, 0))
                 search_window = self.cookedq.read()
+            checked = qlen
             for i in indices:
                 m = list[i].search(search_window)
                 if m is not None:
-                    e    = len(m.group())
+                    e    = len(search_window) - m.start()
                     e    = qlen - e + 1
                     self.cookedq.seek(0)
                     text = self.cookedq.read(e)
@@ -622,6 +699,8 @@ class Telnet:
                 #r, w, x = select.select([self.sock], [], [], timeout)
                 #if not r:
                 #    break
+                if self.cancel_expect:
+                    continue
             self.fill_rawq()
         text = self.read_very_lazy()
         if not text and self.eof:
@@ -116,6 +116,16 @@ class SSHd(Server):
         self.buf = '\n'.join(lines[1:])
         return lines[0] + '\n'
 
+    def _send(self, data):
+        # The channel timeout is short so that _recvline() can poll for a
+        # shutdown; sending a long response may need to wait for the
+        # client for longer than that.
+        self.channel.settimeout(30)
+        try:
+            self.channel.sendall(data)
+        finally:
+            self.channel.settimeout(self.timeout)
+
     def _shutdown_notify(self, conn):
         if self.channel:
             self.channel.send('Server is shutting down.\n')
@@ -147,7 +157,7 @@ class SSHd(Server):
             return
 
         # send the banner
-        self.channel.send(self.device.init())
+        self._send(self.device.init())
 
         # accept commands
         while self.running:
@@ -156,7 +166,7 @@ class SSHd(Server):
                 continue
             response = self.device.do(line)
             if response:
-                self.channel.send(response)
+                self._send(response)
         # closing transport closes channel
         self.channel = None
         t.close()
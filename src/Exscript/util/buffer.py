@@ -15,28 +15,35 @@
 """
 A buffer object.
 """
-from StringIO           import StringIO
+import warnings
 from Exscript.util.cast import to_regexs
 
 class MonitoredBuffer(object):
     """
     A specialized string buffer that allows for monitoring
     the content using regular expression-triggered callbacks.
+
+    The data is kept in a bytearray. Data that is removed from the head
+    of the buffer is not moved out of the array right away; instead, the
+    start of the buffer moves forward, and the array is compacted once
+    the removed data takes up more than half of it.
     """
+    COMPACT_SIZE = 64 * 1024 # Never compact for less than this many bytes.
 
     def __init__(self, io = None):
         """
         Constructor.
-        The data is stored in the given file-like object. If no object is
-        given, or the io argument is None, a new StringIO is used.
 
         @type  io: file-like object
-        @param io: A file-like object that is used for storing the data.
-        """
-        if io is None:
-            self.io = StringIO('')
-        else:
-            self.io = io
+        @param io: Deprecated and ignored, the data is always kept in
+            memory. Passing anything but None results in a warning.
+        """
+        if io is not None:
+            warnings.warn('the io argument of MonitoredBuffer is ignored',
+                          category   = DeprecationWarning,
+                          stacklevel = 2)
+        self.data     = bytearray()
+        self.start    = 0 # The offset of the first byte in the buffer.
         self.monitors = []
         self.clear()
 
@@ -44,7 +51,23 @@ class MonitoredBuffer(object):
         """
         Returns the content of the buffer.
         """
-        return self.io.getvalue()
+        return self._slice(self.start, len(self.data))
+
+    def _slice(self, start, end):
+        # Copies the given range of the array into a string. The view is
+        # released right away, so it does not prevent resizing the array.
+        return memoryview(self.data)[start:end].tobytes()
+
+    def _compact(self):
+        # Drops the removed data from the array, but only if that frees
+        # at least as much memory as the number of bytes that are moved.
+        if self.start < self.COMPACT_SIZE \
+          or self.start * 2 < len(self.data):
+            return
+        del self.data[:self.start]
+        for item in self.monitors:
+            item[2] = max(item[2] - self.start, 0)
+        self.start = 0
 
     def size(self):
         """
@@ -53,7 +76,7 @@ class MonitoredBuffer(object):
         @rtype: int
         @return: The size of the buffer in bytes.
         """
-        return self.io.tell()
+        return len(self.data) - self.start
 
     def head(self, bytes):
         """
@@ -63,11 +86,8 @@ class MonitoredBuffer(object):
         @type  bytes: int
         @param bytes: The number of bytes to return.
         """
-        oldpos = self.io.tell()
-        self.io.seek(0)
-        head = self.io.read(bytes)
-        self.io.seek(oldpos)
-        return head
+        end = self.start + min(max(bytes, 0), self.size())
+        return self._slice(self.start, end)
 
     def tail(self, bytes):
         """
@@ -77,8 +97,10 @@ class MonitoredBuffer(object):
         @type  bytes: int
         @param bytes: The number of bytes to return.
         """
-        self.io.seek(self.size() - bytes)
-        return self.io.read()
+        if bytes <= 0:
+            return ''
+        start = max(self.start, len(self.data) - bytes)
+        return self._slice(start, len(self.data))
 
     def pop(self, bytes):
         """
@@ -87,12 +109,12 @@ class MonitoredBuffer(object):
         @type  bytes: int
         @param bytes: The number of bytes to return and remove.
         """
-        self.io.seek(0)
-        head = self.io.read(bytes)
-        tail = self.io.read()
-        self.io.seek(0)
-        self.io.write(tail)
-        self.io.truncate()
+        head        = self.head(bytes)
+        self.start += len(head)
+        if self.start == len(self.data):
+            self.clear()
+        else:
+            self._compact()
         return head
 
     def append(self, data):
@@ -100,33 +122,51 @@ class MonitoredBuffer(object):
         Appends the given data to the buffer, and triggers all connected
         monitors, if any of them match the buffer content.
 
-        @type  data: str
-        @param data: The data that is appended.
+        @type  data: str|unicode
+        @param data: The data that is appended; unicode is stored UTF-8
+            encoded.
         """
-        self.io.write(data)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        end = len(self.data)
+        self.data.extend(data)
         if not self.monitors:
             return
 
         # Check whether any of the monitoring regular expressions matches.
         # If it does, we need to disable that monitor until the matching
         # data is no longer in the buffer. We accomplish this by keeping
-        # track of the position of the last matching byte.
-        buf = str(self)
+        # track of the position of the last matching byte. Only the new
+        # data is searched, plus the given number of bytes before it,
+        # but anchors and lookbehinds see the whole buffer.
+        start = self.start
+        view  = buffer(self.data, start) # Not a copy.
+        text  = None
         for item in self.monitors:
             regex_list, callback, bytepos, limit = item
-            bytepos = max(bytepos, len(buf) - limit)
+            pos = max(bytepos, start, end - limit) - start
             for i, regex in enumerate(regex_list):
-                match = regex.search(buf, bytepos)
+                if text is not None:
+                    match = regex.search(text, pos)
+                else:
+                    match = regex.search(view, pos)
+                    if match is not None:
+                        # A match in the view changes with the buffer, so
+                        # the callback gets a match in a copy instead.
+                        # The copy is made once, and nothing before the
+                        # first match needs to be searched again.
+                        text  = str(view)
+                        match = regex.search(text, match.start())
                 if match is not None:
-                    item[2] = match.end()
+                    item[2] = start + match.end()
                     callback(i, match)
 
     def clear(self):
         """
         Removes all data from the buffer.
         """
-        self.io.seek(0)
-        self.io.truncate()
+        del self.data[:]
+        self.start = 0
         for item in self.monitors:
             item[2] = 0
 
@@ -136,14 +176,16 @@ class MonitoredBuffer(object):
         buffer.
 
         Arguments passed to the callback are the index of the match, and
-        the match object of the regular expression.
+        the match object of the regular expression. The positions in the
+        match object are relative to the start of the buffer.
 
         @type  pattern: str|re.RegexObject|list(str|re.RegexObject)
         @param pattern: One or more regular expressions.
         @type  callback: callable
         @param callback: The function that is called.
         @type  limit: int
-        @param limit: The maximum size of the tail of the buffer
-                      that is searched, in number of bytes.
+        @param limit: The number of bytes before newly appended data
+                      that are searched as well, so that matches which
+                      span several appends are found.
         """
         self.monitors.append([to_regexs(pattern), callback, 0, limit])
@@ -0,0 +1,134 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Primitives for functions that run as coroutines, e.g. in a
+L{Exscript.workqueue.WorkQueue} in 'async' mode.
+
+A coroutine is a generator. Instead of blocking, it yields what it waits
+for, and is resumed by the event loop as soon as that is done:
+
+  - readable(): Waits until a file or socket can be read.
+  - sleep(): Waits for the given number of seconds.
+  - blocking(): Calls a blocking function in a thread, and returns its
+  return value (or raises its exception).
+  - Another generator: Runs it as a nested coroutine, and returns its
+  return value (or raises its exception).
+
+Since a generator can not return a value in Python 2, a coroutine
+raises Return instead::
+
+    def get_version(job, host, conn):
+        yield conn.connect_async(host.get_address())
+        yield conn.login_async()
+        yield conn.execute_async('show version')
+        raise Return(conn.response)
+"""
+from functools import partial
+from inspect import isgeneratorfunction
+
+class Return(Exception):
+    """
+    Raised by a coroutine to return the given value.
+    """
+    def __init__(self, value = None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Readable(object):
+    """
+    Yielded by a coroutine to wait until a file is readable; see readable().
+    """
+    __slots__ = 'fileobj', 'timeout'
+
+    def __init__(self, fileobj, timeout):
+        self.fileobj = fileobj
+        self.timeout = timeout
+
+class Sleep(object):
+    """
+    Yielded by a coroutine to wait for a while; see sleep().
+    """
+    __slots__ = 'seconds',
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Blocking(object):
+    """
+    Yielded by a coroutine to call a blocking function; see blocking().
+    """
+    __slots__ = 'function', 'args', 'kwargs'
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args     = args
+        self.kwargs   = kwargs
+
+def readable(fileobj, timeout = None):
+    """
+    Returns what a coroutine yields to wait until the given file or
+    socket is readable. The coroutine is resumed with True if it is, or
+    with False if the timeout passed first.
+
+    @type  fileobj: object
+    @param fileobj: An object that has a fileno() method.
+    @type  timeout: float
+    @param timeout: The maximum number of seconds to wait, or None.
+    @rtype:  Readable
+    @return: The object to yield.
+    """
+    return Readable(fileobj, timeout)
+
+def sleep(seconds):
+    """
+    Returns what a coroutine yields to wait for the given number of
+    seconds.
+
+    @type  seconds: float
+    @param seconds: The number of seconds to wait.
+    @rtype:  Sleep
+    @return: The object to yield.
+    """
+    return Sleep(seconds)
+
+def blocking(function, *args, **kwargs):
+    """
+    Returns what a coroutine yields to call the given function with the
+    given arguments in a thread, so that it does not block the event
+    loop. The coroutine is resumed with the return value of the
+    function, or the exception of the function is raised in it. If the
+    function returns a generator, it is run as a coroutine, and its
+    return value is used instead.
+
+    @type  function: callable
+    @param function: The function to call.
+    @rtype:  Blocking
+    @return: The object to yield.
+    """
+    return Blocking(function, args, kwargs)
+
+def is_coroutine_function(function):
+    """
+    Returns True if the given function is a generator function, or a
+    partial of one.
+
+    @type  function: callable
+    @param function: The function to check.
+    @rtype:  bool
+    @return: Whether calling the function returns a generator.
+    """
+    while isinstance(function, partial):
+        function = function.func
+    return isgeneratorfunction(function)
@@ -16,6 +16,7 @@
 Decorators for callbacks passed to Queue.run().
 """
 from impl import add_label, get_label, copy_labels
+from Exscript.util.coroutine import Return, is_coroutine_function
 from Exscript.protocols.Exception import LoginFailure
 
 def bind(function, *args, **kwargs):
@@ -30,11 +31,18 @@ def bind(function, *args, **kwargs):
     @type  kwargs: dict
     @param kwargs: Passed on to the called function.
     @rtype:  function
-    @return: The wrapped function.
+    @return: The wrapped function. If the given function is a coroutine
+        (see L{Exscript.util.coroutine}), so is the wrapper.
     """
-    def decorated(*inner_args, **inner_kwargs):
-        kwargs.update(inner_kwargs)
-        return function(*(inner_args + args), **kwargs)
+    if is_coroutine_function(function):
+        def decorated(*inner_args, **inner_kwargs):
+            kwargs.update(inner_kwargs)
+            result = yield function(*(inner_args + args), **kwargs)
+            raise Return(result)
+    else:
+        def decorated(*inner_args, **inner_kwargs):
+            kwargs.update(inner_kwargs)
+            return function(*(inner_args + args), **kwargs)
     copy_labels(function, decorated)
     return decorated
 
@@ -78,10 +86,18 @@ def os_function_mapper(map):
         return func(job, host, conn, *args, **kwargs)
     return decorated
 
+def _is_logged_in(conn, only_authenticate):
+    if only_authenticate:
+        return conn.is_app_authenticated()
+    return conn.is_app_authorized()
+
 def _decorate(flush = True, attempts = 1, only_authenticate = False):
     """
     Wraps the given function such that conn.login() or conn.authenticate() is
-    executed.
+    executed, unless the connection is already logged in, e.g. because
+    it was taken from a L{Exscript.protocols.SessionPool}. A session
+    that was only authenticated before is authorized if login() was
+    requested.
     Doing the real work for autologin and autoauthenticate to minimize code
     duplication.
 
@@ -97,10 +113,12 @@ def _decorate(flush = True, attempts = 1, only_authenticate = False):
     def decorator(function):
         def decorated(job, host, conn, *args, **kwargs):
             failed = 0
-            while True:
+            while not _is_logged_in(conn, only_authenticate):
                 try:
                     if only_authenticate:
                         conn.authenticate(flush = flush)
+                    elif conn.is_app_authenticated():
+                        conn.auto_app_authorize(flush = flush)
                     else:
                         conn.login(flush = flush)
                 except LoginFailure, e:
@@ -0,0 +1,137 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Waiting for incoming data in a way that another thread can interrupt.
+"""
+import os
+import sys
+import time
+import errno
+import select
+
+# On Windows, select() only accepts sockets, so a pipe can not interrupt
+# it; waits are then done in slices of this many seconds instead.
+_SLICE = 1
+
+class WakeupPipe(object):
+    """
+    Waits until a file object is readable, or until a deadline passed,
+    or until wake() is called from another thread, whichever comes
+    first. A wait takes a single poll() (or select()) system call, so
+    idle connections do not cause any wakeups.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.reader = None
+        self.writer = None
+        if sys.platform != 'win32':
+            import fcntl
+            rfd, wfd = os.pipe()
+            for fd in rfd, wfd:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.reader = os.fdopen(rfd, 'rb', 0)
+            self.writer = os.fdopen(wfd, 'wb', 0)
+
+    def _drain(self, reader):
+        try:
+            while reader.read(4096):
+                pass
+        except ValueError:
+            pass # The pipe was closed by another thread.
+        except (IOError, OSError), e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _poll(self, fileobj, reader, timeout):
+        poll = select.poll()
+        poll.register(fileobj, select.POLLIN | select.POLLPRI)
+        poll.register(reader, select.POLLIN)
+        events = poll.poll(int(timeout * 1000) + 1)
+        return [fd for fd, event in events]
+
+    def _select(self, fileobj, reader, timeout):
+        fds = [fileobj]
+        if reader is not None:
+            fds.append(reader)
+        else:
+            timeout = min(timeout, _SLICE)
+        readable, writeable, excp = select.select(fds, [], [], timeout)
+        return readable
+
+    def wake(self):
+        """
+        Interrupts a wait() that is currently in progress, or, if there
+        is none, the next one.
+        """
+        if self.writer is None:
+            return
+        try:
+            self.writer.write('\0')
+        except (IOError, OSError), e:
+            # The pipe is full, so the reader will wake up anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, fileobj, deadline):
+        """
+        Blocks until the given file object is readable, the given
+        deadline passed, or wake() is called.
+
+        @type  fileobj: object
+        @param fileobj: An object with a fileno() method, e.g. a socket.
+        @type  deadline: float
+        @param deadline: The latest time to return, as in time.time().
+        @rtype:  bool
+        @return: True if the file object is readable, False otherwise.
+        """
+        # close() may be called from another thread at any time, so the
+        # pipe is only used through a local reference, and a pipe that
+        # was closed in the meantime ends the wait.
+        reader  = self.reader
+        timeout = max(deadline - time.time(), 0)
+        try:
+            if reader is not None and hasattr(select, 'poll'):
+                ready = self._poll(fileobj, reader, timeout)
+                fds   = fileobj.fileno(), reader.fileno()
+            else:
+                ready = self._select(fileobj, reader, timeout)
+                fds   = fileobj, reader
+        except ValueError:
+            return False # The pipe was closed by another thread.
+        except (select.error, IOError, OSError), e:
+            if e.args[0] == errno.EBADF and self.reader is None:
+                return False
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if reader is not None and fds[1] in ready:
+            self._drain(reader)
+        return fds[0] in ready
+
+    def close(self):
+        """
+        Closes the pipe.
+        """
+        if self.reader is None:
+            return
+        self.wake() # Ends a wait() in another thread.
+        self.reader.close()
+        self.writer.close()
+        self.reader = None
+        self.writer = None
@@ -0,0 +1,171 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Adjusts the number of threads of a workqueue at runtime.
+"""
+import threading
+from Exscript.util.event import Event
+
+class Autotuner(object):
+    """
+    Controls the maximum number of threads of a L{WorkQueue} using
+    additive increase, multiplicative decrease (AIMD):
+
+      - Whenever as many jobs succeeded in a row as there are threads,
+        the number of threads is increased by one.
+      - When a job fails with an error that indicates an overloaded
+        network or server (a timeout, by default), or when connecting
+        takes much longer than it used to (see add_latency()), the
+        number of threads is multiplied with the given decrease factor.
+        To avoid reacting to the same overload more than once, the
+        number of threads is not decreased again until as many jobs
+        completed as there are threads.
+
+    The number of threads always stays between min_threads and
+    max_threads. The current number is read from the workqueue, so
+    changing it using L{WorkQueue.set_max_threads()} is respected.
+    The threads_changed_event is sent with the new number of threads
+    whenever the autotuner changed it.
+    """
+    # Compared by name, because the exception classes may have been
+    # created by another process.
+    congestion_errors = 'TimeoutException', 'JobTimeoutException', 'timeout'
+
+    # The connect latency indicates congestion if its moving average
+    # exceeds the lowest average by this factor, and by at least
+    # latency_slack seconds.
+    latency_factor = 2.0
+    latency_slack  = .1
+
+    def __init__(self, workqueue, min_threads, max_threads, decrease = .5):
+        """
+        Constructor.
+
+        @type  workqueue: WorkQueue
+        @param workqueue: The workqueue that is controlled.
+        @type  min_threads: int
+        @param min_threads: The lowest number of threads.
+        @type  max_threads: int
+        @param max_threads: The highest number of threads.
+        @type  decrease: float
+        @param decrease: The factor that is applied on congestion.
+        """
+        if min_threads < 1 or max_threads < min_threads:
+            raise ValueError('invalid thread limits: %d, %d' % (min_threads,
+                                                                max_threads))
+        self.workqueue   = workqueue
+        self.min_threads = int(min_threads)
+        self.max_threads = int(max_threads)
+        self.decrease    = float(decrease)
+        self.workqueue.set_max_threads(self._clamp(self.get_threads()))
+        self.lock        = threading.Lock()
+        self.successes   = 0    # Successful jobs since the last change.
+        self.completed   = self.get_threads() # Jobs since the last decrease.
+        self.latency     = None # The moving average of the latency.
+        self.baseline    = None # The lowest average of the latency.
+        self.threads_changed_event = Event()
+        self.workqueue.job_succeeded_event.connect(self._on_job_succeeded)
+        self.workqueue.job_error_event.connect(self._on_job_error)
+
+    def _clamp(self, threads):
+        return max(self.min_threads, min(self.max_threads, int(threads)))
+
+    def _set_threads(self, threads):
+        # Called with the lock acquired.
+        threads = self._clamp(threads)
+        if threads == self.get_threads():
+            return
+        self.workqueue.set_max_threads(threads)
+        self.threads_changed_event(threads)
+
+    def _congested(self):
+        # Called with the lock acquired.
+        self.successes = 0
+        threads        = self.get_threads()
+        if self.completed < threads:
+            return
+        self.completed = 0
+        self._set_threads(threads * self.decrease)
+
+    def _on_job_succeeded(self, job):
+        with self.lock:
+            self.completed += 1
+            self.successes += 1
+            threads         = self.get_threads()
+            if self.successes < threads:
+                return
+            self.successes = 0
+            self._set_threads(threads + 1)
+
+    def _on_job_error(self, job, exc_info):
+        with self.lock:
+            self.completed += 1
+            self.successes  = 0
+            if self.is_congestion(exc_info):
+                self._congested()
+
+    def add_latency(self, seconds):
+        """
+        Reports how long it took to connect to a host. If connecting
+        takes much longer than it used to, the network or the hosts are
+        considered to be overloaded, as if a job had timed out.
+
+        @type  seconds: float
+        @param seconds: The time it took to connect.
+        """
+        with self.lock:
+            if self.latency is None:
+                self.latency = float(seconds)
+            else:
+                self.latency += (seconds - self.latency) * .2
+            if self.baseline is None or self.latency < self.baseline:
+                self.baseline = self.latency
+            limit = max(self.baseline * self.latency_factor,
+                        self.baseline + self.latency_slack)
+            if self.latency <= limit:
+                return
+            # A network that is just slower than it used to be would
+            # otherwise shrink the number of threads to the minimum.
+            self.baseline = self.latency
+            self._congested()
+
+    def is_congestion(self, exc_info):
+        """
+        Returns True if the given error indicates that too many jobs are
+        running at the same time.
+
+        @type  exc_info: tuple
+        @param exc_info: The error, as passed to job_error_event.
+        @rtype:  bool
+        @return: Whether the number of threads should be decreased.
+        """
+        return exc_info[0].__name__ in self.congestion_errors
+
+    def get_threads(self):
+        """
+        Returns the number of threads that is currently chosen.
+
+        @rtype:  int
+        @return: The number of threads.
+        """
+        return self.workqueue.get_max_threads()
+
+    def stop(self):
+        """
+        Stops adjusting the number of threads. The current number of
+        threads is kept.
+        """
+        self.workqueue.job_succeeded_event.disconnect(self._on_job_succeeded)
+        self.workqueue.job_error_event.disconnect(self._on_job_error)
@@ -0,0 +1,370 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Runs jobs as coroutines in the reactor thread.
+"""
+import sys
+import threading
+import traceback
+from types import GeneratorType
+from functools import partial
+from itertools import count
+from collections import deque
+from Exscript.util.event import Event
+from Exscript.util.impl import serializeable_sys_exc_info
+from Exscript.util.coroutine import Return, Readable, Sleep, Blocking, \
+                                    is_coroutine_function
+from Exscript.workqueue.Job import Job
+from Exscript.workqueue.WorkerPool import WorkerPool
+
+def _call(function, args, kwargs, worker):
+    # Runs in a thread of the executor; the worker is not needed.
+    return function(*args, **kwargs)
+
+class _Coroutine(object):
+    """
+    Stands in for the worker of a job: it is passed to the function of
+    the job, and holds the generators that are being run for it.
+    """
+    def __init__(self, job, on_complete):
+        self.job          = job
+        self.id           = job.id
+        self.name         = job.name
+        self.failures     = job.failures
+        self.data         = job.data
+        self.context      = {}
+        self.cancel_event = Event()
+        self.on_complete  = on_complete
+        self.stack        = [] # The generator on top is running.
+        self.wait         = None # Identifies the current wait.
+        self.cancel_wait  = None # Cancels the current wait.
+        self.thrown       = None # The exc_info that was raised in it.
+        self.thread       = False # Whether the job itself runs in a thread.
+        self.done         = False
+
+class CoroutinePool(object):
+    """
+    Executes jobs whose function is a generator as coroutines, all in the
+    thread of the reactor; see L{Exscript.util.coroutine}. Since waiting
+    costs no thread, the number of jobs that run at the same time is only
+    limited by the pipeline.
+
+    Blocking calls that a coroutine yields are passed to a small pool of
+    threads, as are jobs whose function is not a generator function;
+    those are executed just like in a L{WorkerPool}. No more than the
+    given number of such calls run at the same time; the others wait in
+    line.
+    """
+    def __init__(self, reactor, size = 1, threads = 8, stack_size = None):
+        """
+        Constructor.
+
+        @type  reactor: Reactor
+        @param reactor: Runs the coroutines.
+        @type  size: int
+        @param size: The number of jobs that are expected to run at once.
+        @type  threads: int
+        @param threads: The number of threads for blocking calls.
+        @type  stack_size: int
+        @param stack_size: The stack size of these threads in bytes, or
+            None for the system default.
+        """
+        self.reactor  = reactor
+        self.size     = int(size)
+        self.threads  = int(threads)
+        self.executor = WorkerPool('threading',
+                                   self.threads,
+                                   stack_size = stack_size)
+        self.lock     = threading.Lock()
+        self.running  = {} # Maps (job id, failures) to _Coroutine.
+        self.busy     = 0  # The number of blocking calls in progress.
+        self.backlog  = deque() # Blocking calls that wait for a thread.
+        self.call_ids = count()
+
+        # Coroutines are not run by workers, so this is never sent.
+        self.worker_init_event = Event()
+
+    def _submit(self, job, on_complete):
+        # Passes the job to the executor as soon as a thread is free.
+        with self.lock:
+            if self.busy >= self.threads:
+                self.backlog.append((job, on_complete))
+                return
+            self.busy += 1
+        self.executor.start(job, partial(self._on_executed, on_complete))
+
+    def _on_executed(self, on_complete, job, exc_info):
+        # Called in a thread of the executor.
+        with self.lock:
+            if self.backlog:
+                next_job, next_on_complete = self.backlog.popleft()
+            else:
+                next_job = None
+                self.busy -= 1
+        if next_job is not None:
+            self.executor.start(next_job,
+                                partial(self._on_executed, next_on_complete))
+        on_complete(job, exc_info)
+
+    def _withdraw(self, job):
+        # Removes a job that was passed to _submit() from the backlog.
+        # Returns False if it already runs. Called with the lock held.
+        for item in self.backlog:
+            if item[0] is job:
+                self.backlog.remove(item)
+                return True
+        return False
+
+    def _execute(self, function, args, kwargs, callback):
+        # Calls the function in the executor, and then the callback with
+        # the exception info and the return value in the reactor thread.
+        # The ids of these calls must not clash with those of jobs.
+        job    = Job(partial(_call, function, args, kwargs),
+                     'blocking call',
+                     1,
+                     None)
+        job.id = 'call', self.call_ids.next()
+        def on_complete(job, exc_info):
+            self.reactor.call_later(0, partial(callback,
+                                               exc_info,
+                                               job.result))
+        self._submit(job, on_complete)
+
+    def _on_job_executed(self, coro, job, exc_info):
+        # Called in a thread of the executor.
+        self._finish(coro, job.result, exc_info)
+
+    def _begin(self, coro):
+        if coro.done:
+            return # Cancelled before it was started.
+        job = coro.job
+        if not is_coroutine_function(job.func):
+            # cancel() needs to know whether it may still stop the job.
+            with self.lock:
+                if coro.done:
+                    return
+                coro.thread = True
+            self._submit(job, partial(self._on_job_executed, coro))
+            return
+        try:
+            coro.stack.append(job.func(coro))
+        except Exception:
+            self._finish(coro, None, serializeable_sys_exc_info())
+            return
+        self._resume(coro)
+
+    def _get_exc_info(self, coro):
+        # If an exception that was thrown into the coroutine was not
+        # handled, its original traceback is kept.
+        thrown      = coro.thrown
+        coro.thrown = None
+        if thrown is not None and sys.exc_info()[1] is thrown[1]:
+            return thrown
+        return serializeable_sys_exc_info()
+
+    def _resume(self, coro, value = None, exc_info = None):
+        # Runs the coroutine until it waits for something, or until it
+        # is done. Called in the reactor thread only.
+        coro.wait        = None
+        coro.cancel_wait = None
+        if exc_info is None and isinstance(value, GeneratorType):
+            coro.stack.append(value)
+            value = None
+        while coro.stack:
+            generator = coro.stack[-1]
+            try:
+                if exc_info is None:
+                    request = generator.send(value)
+                else:
+                    coro.thrown = exc_info
+                    request     = generator.throw(exc_info[0], exc_info[1])
+            except StopIteration:
+                coro.stack.pop()
+                value, exc_info = None, None
+                continue
+            except Return, e:
+                coro.stack.pop()
+                value, exc_info = e.value, None
+                continue
+            except Exception:
+                coro.stack.pop()
+                value, exc_info = None, self._get_exc_info(coro)
+                continue
+            coro.thrown     = None
+            value, exc_info = None, None
+            if isinstance(request, GeneratorType):
+                coro.stack.append(request)
+                continue
+            try:
+                self._wait(coro, request)
+            except TypeError:
+                exc_info = serializeable_sys_exc_info()
+                continue
+            return
+        self._finish(coro, value, exc_info)
+
+    def _wait(self, coro, request):
+        # Arranges for the coroutine to be resumed when the request is
+        # done. Callbacks of a wait that was cancelled are ignored.
+        token     = object()
+        coro.wait = token
+        def resume(value = None, exc_info = None):
+            if coro.wait is token:
+                self._resume(coro, value, exc_info)
+
+        if isinstance(request, Readable):
+            fileobj = request.fileobj
+            timer   = None
+            def on_readable():
+                if timer is not None:
+                    self.reactor.cancel_call(timer)
+                resume(True)
+            def on_timeout():
+                self.reactor.remove_reader(fileobj)
+                resume(False)
+            def cancel():
+                self.reactor.remove_reader(fileobj)
+                if timer is not None:
+                    self.reactor.cancel_call(timer)
+            if request.timeout is not None:
+                timer = self.reactor.call_later(request.timeout, on_timeout)
+            self.reactor.add_reader(fileobj, on_readable)
+            coro.cancel_wait = cancel
+        elif isinstance(request, Sleep):
+            timer = self.reactor.call_later(request.seconds, resume)
+            coro.cancel_wait = partial(self.reactor.cancel_call, timer)
+        elif isinstance(request, Blocking):
+            def on_done(exc_info, result):
+                resume(result, exc_info)
+            self._execute(request.function,
+                          request.args,
+                          request.kwargs,
+                          on_done)
+        else:
+            coro.wait = None
+            raise TypeError('a coroutine yielded ' + repr(request))
+
+    def _forget(self, coro):
+        # Returns False if the coroutine was already done.
+        job = coro.job
+        with self.lock:
+            if coro.done:
+                return False
+            coro.done = True
+            key       = job.id, coro.failures
+            if self.running.get(key) is coro:
+                del self.running[key]
+        return True
+
+    def _finish(self, coro, result, exc_info):
+        if not self._forget(coro):
+            return
+        coro.job.result = result
+        coro.on_complete(coro.job, exc_info)
+
+    def _cancel(self, coro):
+        # Called in the reactor thread, after cancel() forgot the
+        # coroutine.
+        if coro.cancel_wait is not None:
+            coro.cancel_wait()
+        coro.wait        = None
+        coro.cancel_wait = None
+        while coro.stack:
+            try:
+                coro.stack.pop().close()
+            except Exception:
+                traceback.print_exc()
+        coro.cancel_event()
+
+    def start(self, job, on_complete):
+        """
+        Starts the given job. When it is completed, on_complete is called
+        with the job and the exception info, or None on success. The
+        return value of the function is stored in job.result.
+
+        @type  job: Job
+        @param job: The job that is executed.
+        @type  on_complete: callable
+        @param on_complete: Called when the job is completed.
+        """
+        coro      = _Coroutine(job, on_complete)
+        job.child = job
+        with self.lock:
+            self.running[job.id, job.failures] = coro
+        self.reactor.call_later(0, partial(self._begin, coro))
+
+    def cancel(self, job):
+        """
+        Stops the coroutine of the given job: the generators are closed,
+        and the cancel_event of the object that was passed to the
+        function is sent. A blocking call that is in progress can not be
+        interrupted; its result is ignored. Does nothing if the job is
+        not running.
+
+        A job whose function is not a generator function can not be
+        stopped once it runs in a thread; it is only asked to stop, like
+        in a L{WorkerPool}, and completed as usual when the thread
+        returns.
+
+        @type  job: Job
+        @param job: The job that is cancelled.
+        @rtype:  bool
+        @return: False if the job runs in a thread and was not stopped.
+        """
+        key = job.id, job.failures
+        with self.lock:
+            coro    = self.running.get(key)
+            running = coro is not None \
+                      and coro.thread \
+                      and not self._withdraw(job)
+            if coro is not None and not running:
+                coro.done = True
+                del self.running[key]
+        if coro is None:
+            return True
+        if running:
+            self.executor.cancel(job)
+            return False
+        self.reactor.call_later(0, partial(self._cancel, coro))
+        return True
+
+    def set_size(self, size):
+        """
+        Changes the number of jobs that are expected to run at once. The
+        number of threads for blocking calls is not affected.
+
+        @type  size: int
+        @param size: The number of jobs.
+        """
+        self.size = int(size)
+
+    def get_size(self):
+        """
+        Returns the number of jobs that are expected to run at once.
+
+        @rtype:  int
+        @return: The number of jobs.
+        """
+        return self.size
+
+    def stop(self, join = True):
+        """
+        Stops the threads for blocking calls. Calls that are currently
+        in progress are completed first.
+
+        @type  join: bool
+        @param join: Whether to wait until all threads have terminated.
+        """
+        self.executor.stop(join)
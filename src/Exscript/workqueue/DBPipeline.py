@@ -13,38 +13,66 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 import sqlalchemy as sa
-from multiprocessing import Condition, RLock
-
-def _transaction(function, *args, **kwargs):
-    def wrapper(self, *args, **kwargs):
-        with self.engine.contextual_connect(close_with_result = True).begin():
-            return function(*args, **kwargs)
-    wrapper.__name__ = function.__name__
-    wrapper.__dict__ = function.__dict__
-    wrapper.__doc__  = function.__doc__
-    return wrapper
-
-class DBPipeline(object):
+from contextlib import contextmanager
+from Exscript.workqueue.Pipeline import Pipeline
+
+class DBPipeline(Pipeline):
     """
-    Like L{Exscript.workqueue.Pipeline}, but keeps all queued objects
-    in a database, instead of using in-memory data structures.
+    Like L{Exscript.workqueue.Pipeline}, but also keeps every queued and
+    working item in a database, so that the queue can be restored after
+    the process was restarted; see recover(). Items must therefore be
+    picklable. The id of an item is the id of its row in the database,
+    so it is the same in the restored queue.
+
+    The order in which items are returned is still decided by the
+    in-memory structures of the Pipeline; the database only records the
+    state of every item. Items that can not be pickled may be written
+    in another form using set_dump_function(), and rebuilt when they
+    are recovered. Appended items are written before append()
+    returns, in one transaction per call; if the transaction fails, the
+    items are not added to the pipeline either. Starting an item claims
+    its row in a transaction that changes its status from 'queued' to
+    'working'. If the row is no longer queued, e.g. because another
+    process claimed it, the item is dropped from the pipeline instead
+    of being started. Items that are done or deferred are only remembered, and
+    written in the same transaction as the next claim, once
+    batch_size items are waiting to be written, or when no item is
+    working anymore, whichever comes first. If the process dies before
+    that, such items are restored as if they had been interrupted, and
+    run again.
     """
-    def __init__(self, engine, max_working = 1):
-        self.condition     = Condition(RLock())
+    def __init__(self, engine, max_working = 1, aging = 1000, batch_size = 100):
+        """
+        Constructor.
+
+        @type  engine: Engine
+        @param engine: An sqlalchemy engine.
+        @type  max_working: int
+        @param max_working: The maximum number of items that are working.
+        @type  aging: int
+        @param aging: The number of appended items per priority level.
+        @type  batch_size: int
+        @param batch_size: The maximum number of state changes that are
+            kept in memory before they are written.
+        """
         self.engine        = engine
-        self.max_working   = max_working
-        self.running       = False
-        self.paused        = False
+        self.batch_size    = int(batch_size)
         self.metadata      = sa.MetaData(self.engine)
+        self.pending       = dict() # Maps row ids to their new status.
+        self.position      = 0      # The last position at the front.
+        self.conn          = None   # The connection of the transaction.
+        self.row           = None   # Column values of inserted rows.
+        self.inserted      = None   # Items inserted in the transaction.
+        self.dump          = None   # Returns what is stored for an item.
         self._table_prefix = 'exscript_pipeline_'
         self._table_map    = {}
         self.__update_table_names()
-        self.clear()
+        Pipeline.__init__(self, max_working, aging)
 
     def __add_table(self, table):
         """
         Adds a new table to the internal table list.
-        
+
         @type  table: Table
         @param table: An sqlalchemy table.
         """
@@ -57,37 +85,40 @@ class DBPipeline(object):
         """
         pfx = self._table_prefix
         self.__add_table(sa.Table(pfx + 'job', self.metadata,
-            sa.Column('id',     sa.Integer, primary_key = True),
-            sa.Column('name',   sa.String(150), index = True),
-            sa.Column('status', sa.String(50), index = True),
-            sa.Column('job',    sa.PickleType()),
+            sa.Column('id',       sa.Integer, primary_key = True),
+            sa.Column('name',     sa.String(150), index = True),
+            sa.Column('status',   sa.String(50), index = True),
+            sa.Column('priority', sa.Integer),
+            sa.Column('position', sa.Integer),
+            sa.Column('job',      sa.PickleType()),
             mysql_engine = 'INNODB'
         ))
 
-    @synchronized
     def install(self):
         """
         Installs (or upgrades) database tables.
         """
-        self.metadata.create_all()
+        with self.condition:
+            self.metadata.create_all()
 
-    @synchronized
     def uninstall(self):
         """
         Drops all tables from the database. Use with care.
         """
-        self.metadata.drop_all()
+        with self.condition:
+            self.metadata.drop_all()
 
-    @synchronized
     def clear_database(self):
         """
         Drops the content of any database table used by this library.
         Use with care.
 
-        Wipes out everything, including types, actions, resources and acls.
+        Wipes out everything, including items that were not recovered.
         """
-        delete = self._table_map['job'].delete()
-        delete.execute()
+        with self.condition:
+            self.pending = dict()
+            delete       = self._table_map['job'].delete()
+            delete.execute()
 
     def debug(self, debug = True):
         """
@@ -111,209 +142,279 @@ class DBPipeline(object):
     def get_table_prefix(self):
         """
         Returns the current database table prefix.
-        
+
         @rtype:  string
         @return: The current prefix.
         """
         return self._table_prefix
 
-    def __len__(self):
-        return self._table_map['job'].count().execute().fetchone()[0]
-
-    def __contains__(self, item):
-        return self.has_id(id(item))
-
-    def get_from_name(self, name):
-        """
-        Returns the item with the given name, or None if no such item
-        is known.
+    def set_dump_function(self, function):
         """
-        with self.condition:
-            tbl_j = self._table_map['job']
-            query = tbl_j.select(tbl_j.c.name == name)
-            row   = query.execute().fetchone()
-            if row is None:
-                return None
-            return row.job
+        Defines what is written to the database for items that are
+        added later, e.g. for items that can not be pickled. The
+        written objects are passed to the function that is given to
+        recover().
 
-    def has_id(self, item_id):
+        @type  function: callable
+        @param function: Called with an item, returns a picklable object.
         """
-        Returns True if the queue contains an item with the given id.
-        """
-        tbl_j = self._table_map['job']
-        query = tbl_j.select(tbl_j.c.id == item_id).count()
-        return query.execute().fetchone()[0] > 0
-
-    def task_done(self, item):
         with self.condition:
-            self.working.remove(item)
-            self.all.remove(id(item))
-            self.condition.notify_all()
-
-    def append(self, item):
-        with self.condition:
-            self.queue.append(item)
-            self.all.add(id(item))
-            self.condition.notify_all()
-
-    def appendleft(self, item, force = False):
+            self.dump = function
+
+    @contextmanager
+    def _transaction(self, **row):
+        # Locks the pipeline and runs the block in a transaction. Rows
+        # that are inserted in the meantime get the given column values.
+        # If the transaction is rolled back, the items that were
+        # registered in the meantime are forgotten again, as their ids
+        # may be assigned to other rows later.
         with self.condition:
-            if force:
-                self.force.append(item)
-            else:
-                self.queue.appendleft(item)
-            self.all.add(id(item))
+            conn          = self.engine.contextual_connect()
+            self.inserted = []
+            try:
+                with conn.begin():
+                    self.conn = conn
+                    self.row  = row
+                    try:
+                        yield conn
+                    finally:
+                        self.conn = None
+                        self.row  = None
+            except:
+                for item in self.inserted:
+                    if item in self.records:
+                        self._unregister_item(item)
+                raise
+            finally:
+                self.inserted = None
+                conn.close()
+
+    def _next_position(self):
+        # Items at the front of the queue have no priority; the item that
+        # was moved there last has the highest position.
+        self.position += 1
+        return self.position
+
+    def _new_id(self, name, item):
+        # Items that are recovered keep the id of their row.
+        self.inserted.append(item)
+        if 'id' in self.row:
+            return self.row['id']
+        priority = self.row.get('priority')
+        position = None
+        if priority is None:
+            position = self._next_position()
+        if self.dump is not None:
+            item = self.dump(item)
+        insert = self._table_map['job'].insert()
+        result = self.conn.execute(insert,
+                                   name     = name,
+                                   status   = 'queued',
+                                   priority = priority,
+                                   position = position,
+                                   job      = item)
+        return result.inserted_primary_key[0]
+
+    def _write_pending(self, conn):
+        tbl_j   = self._table_map['job']
+        done    = [i for i, s in self.pending.iteritems() if s is None]
+        delayed = [i for i, s in self.pending.iteritems() if s is not None]
+        if done:
+            conn.execute(tbl_j.delete(tbl_j.c.id.in_(done)))
+        for item_id in delayed:
+            # Deferred items return to the front of the queue.
+            conn.execute(tbl_j.update(tbl_j.c.id == item_id),
+                         status   = 'queued',
+                         priority = None,
+                         position = self._next_position())
+
+    def _flush(self):
+        if not self.pending:
+            return
+        with self._transaction() as conn:
+            self._write_pending(conn)
+        self.pending = dict()
+
+    def _changed(self, item_id, status):
+        self.pending[item_id] = status
+        if not self.working or len(self.pending) >= self.batch_size:
+            self._flush()
+
+    def _start(self, item):
+        tbl_j = self._table_map['job']
+        where = (tbl_j.c.id == self.records[item].id) \
+              & (tbl_j.c.status == 'queued')
+        with self._transaction() as conn:
+            self._write_pending(conn)
+            result = conn.execute(tbl_j.update(where), status = 'working')
+        self.pending = dict()
+        if result.rowcount != 1:
+            # The row was claimed or removed by someone else.
+            self._unregister_item(item)
             self.condition.notify_all()
+            return False
+        return Pipeline._start(self, item)
 
-    def prioritize(self, item, force = False):
+    def flush(self):
         """
-        Moves the item to the very left of the queue.
+        Writes the state changes that were not yet written to the
+        database.
         """
         with self.condition:
-            # If the job is already running (or about to be forced),
-            # there is nothing to be done.
-            if item in self.working or item in self.force:
-                return
-            self.queue.remove(item)
-            self.appendleft(item, force)
-            self.condition.notify_all()
+            self._flush()
 
-    def clear(self):
+    def task_done(self, item):
         with self.condition:
-            self.queue    = deque()
-            self.force    = deque()
-            self.sleeping = set()
-            self.working  = set()
-            self.all      = set()
-            self.condition.notify_all()
+            record = self.records.get(item)
+            Pipeline.task_done(self, item)
+            if record is not None and item not in self.records:
+                self._changed(record.id, None)
 
-    def stop(self):
+    def defer(self, item, delay):
         """
-        Force the next() method to return while in another thread.
-        The return value of next() will be None.
+        Like L{Exscript.workqueue.Pipeline.defer()}. If the process is
+        restarted before the item is due, the recovered item is queued
+        again without a delay.
+
+        @type  item: object
+        @param item: The working item.
+        @type  delay: float
+        @param delay: The number of seconds to wait.
         """
         with self.condition:
-            self.running = False
-            self.condition.notify_all()
+            working = item in self.working
+            Pipeline.defer(self, item, delay)
+            if working:
+                self._changed(self.records[item].id, 'queued')
 
-    def pause(self):
-        with self.condition:
-            self.paused = True
-            self.condition.notify_all()
-
-    def unpause(self):
-        with self.condition:
-            self.paused = False
-            self.condition.notify_all()
-
-    def sleep(self, item):
-        assert id(item) in self.all
-        with self.condition:
-            self.sleeping.add(item)
-            self.condition.notify_all()
+    def append(self, item, name = None, priority = 0):
+        """
+        Like L{Exscript.workqueue.Pipeline.append()}, but also writes
+        the item to the database.
+
+        @type  item: object
+        @param item: The item that is added.
+        @type  name: str
+        @param name: An optional name of the item; names must be unique.
+        @type  priority: int
+        @param priority: Items with a higher priority are returned first.
+        """
+        with self._transaction(priority = int(priority)):
+            return Pipeline.append(self, item, name, priority)
 
-    def wake(self, item):
-        assert id(item) in self.all
-        assert item in self.sleeping
-        with self.condition:
-            self.sleeping.remove(item)
-            self.condition.notify_all()
+    def append_many(self, items, priority = 0):
+        """
+        Like L{Exscript.workqueue.Pipeline.append_many()}; all items are
+        written to the database in a single transaction.
+
+        @type  items: list[(object, str)]
+        @param items: A list of (item, name) tuples; the name may be None.
+        @type  priority: int
+        @param priority: Items with a higher priority are returned first.
+        @rtype:  list[int]
+        @return: The ids of the items, in the given order.
+        """
+        with self._transaction(priority = int(priority)):
+            return Pipeline.append_many(self, items, priority)
 
-    def wait_for_id(self, item_id):
-        with self.condition:
-            while self.has_id(item_id):
-                self.condition.wait()
+    def appendleft(self, item, name = None, force = False):
+        with self._transaction(priority = None):
+            return Pipeline.appendleft(self, item, name, force)
 
-    def wait(self):
+    def appendleft_many(self, items, force = False):
         """
-        Waits for all currently running tasks to complete.
+        Like append_many(), but calls appendleft() for each item.
+
+        @type  items: list[(object, str)]
+        @param items: A list of (item, name) tuples; the name may be None.
+        @type  force: bool
+        @param force: Whether to start the items regardless of max_working.
+        @rtype:  list[int]
+        @return: The ids of the items, in the given order.
         """
-        with self.condition:
-            while self.working:
-                self.condition.wait()
+        with self._transaction(priority = None):
+            return Pipeline.appendleft_many(self, items, force)
 
-    def wait_all(self):
+    def prioritize(self, item, force = False):
         """
-        Waits for all queued and running tasks to complete.
+        Moves the item to the very left of the queue.
         """
         with self.condition:
-            while len(self) > 0:
-                self.condition.wait()
-
-    def with_lock(self, function, *args, **kwargs):
-        with self.condition:
-            return function(self, *args, **kwargs)
+            Pipeline.prioritize(self, item, force)
+            record = self.records.get(item)
+            if record is None or item in self.working:
+                return
+            tbl_j = self._table_map['job']
+            with self._transaction() as conn:
+                conn.execute(tbl_j.update(tbl_j.c.id == record.id),
+                             priority = None,
+                             position = self._next_position())
 
-    def set_max_working(self, max_working):
+    def clear(self):
+        """
+        Removes all items from the pipeline, but not from the database,
+        so that they may be restored using recover().
+        """
         with self.condition:
-            self.max_working = int(max_working)
-            self.condition.notify_all()
-
-    def get_max_working(self):
-        return self.max_working
+            if self._table_map:
+                self._flush()
+            Pipeline.clear(self)
 
-    def get_working(self):
-        return list(self.working)
-
-    def _popleft_sleeping(self):
-        sleeping = []
-        while True:
-            try:
-                node = self.queue[0]
-            except IndexError:
-                break
-            if node not in self.sleeping:
-                break
-            sleeping.append(node)
-            self.queue.popleft()
-        return sleeping
-
-    def _get_next(self):
-        # We need to leave sleeping items in the queue because else we
-        # would not know their original position after they wake up.
-        # So we need to temporarily remove sleeping items from the top of
-        # the queue here.
-        sleeping = self._popleft_sleeping()
-
-        # Get the first non-sleeping item from the queue.
-        try:
-            next = self.queue.popleft()
-        except IndexError:
-            next = None
-
-        # Re-insert sleeping items.
-        self.queue.extendleft(sleeping)
-        return next
-
-    def next(self):
-        with self.condition:
-            self.running = True
-            while self.running:
-                if self.paused:
-                    self.condition.wait()
-                    continue
-
-                # Wait until enough slots are available.
-                if len(self.working) - \
-                   len(self.sleeping) - \
-                   len(self.force) >= self.max_working:
-                    self.condition.wait()
-                    continue
-
-                # Forced items are returned regardless of how many tasks
-                # are already working.
-                try:
-                    next = self.force.popleft()
-                except IndexError:
-                    pass
-                else:
-                    self.working.add(next)
-                    return next
-
-                # Return the first non-sleeping task.
-                next = self._get_next()
-                if next is None:
-                    self.condition.wait()
-                    continue
-                self.working.add(next)
-                return next
+    def recover(self, load = None):
+        """
+        Restores the items that are in the database, but not in the
+        pipeline, such as the items that were queued or working when the
+        process was last stopped. Working items were interrupted, so
+        they are queued again at the very front of the queue, followed
+        by the items that were appended using appendleft() or that
+        were prioritized. All other items are appended with their
+        original priority, in the order in which they were appended.
+        Forced items are not forced again.
+
+        If items were written using a dump function (see
+        set_dump_function()), the given load function must rebuild them.
+        Items that it returns None for are deleted from the database.
+
+        @type  load: callable
+        @param load: Called with a stored object, returns the item.
+        @rtype:  list[(int, object)]
+        @return: The id and the item of every restored item.
+        """
+        tbl_j = self._table_map['job']
+        with self._transaction() as conn:
+            # The item is unpickled whenever the column is read.
+            query   = tbl_j.select().order_by(tbl_j.c.id)
+            rows    = [(row, row.job) for row in conn.execute(query)
+                       if row.id not in self.id2record]
+            if load is not None:
+                rows   = [(row, load(item)) for row, item in rows]
+                broken = [row.id for row, item in rows if item is None]
+                rows   = [(row, item) for row, item in rows
+                          if item is not None]
+                if broken:
+                    conn.execute(tbl_j.delete(tbl_j.c.id.in_(broken)))
+            working = [r for r in rows if r[0].status == 'working']
+            front   = [r for r in rows if r[0].status != 'working'
+                       and r[0].priority is None]
+            back    = [r for r in rows if r[0].status != 'working'
+                       and r[0].priority is not None]
+            front.sort(key = lambda r: r[0].position)
+            for row, item in rows:
+                self.position = max(self.position, row.position or 0)
+
+            # appendleft() adds in front of all other items, so the
+            # front of the queue is restored back to front.
+            for row, item in back:
+                self.row['id'] = row.id
+                Pipeline.append(self, item, row.name, row.priority)
+            for row, item in front:
+                self.row['id'] = row.id
+                Pipeline.appendleft(self, item, row.name)
+            for row, item in reversed(working):
+                self.row['id'] = row.id
+                Pipeline.appendleft(self, item, row.name)
+                conn.execute(tbl_j.update(tbl_j.c.id == row.id),
+                             status   = 'queued',
+                             priority = None,
+                             position = self._next_position())
+        return [(row.id, item) for row, item in rows]
@@ -0,0 +1,30 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Error types raised by the workqueue.
+"""
+
+class WorkQueueException(Exception):
+    """
+    Default exception that is raised by the workqueue.
+    """
+    pass
+
+class JobTimeoutException(WorkQueueException):
+    """
+    Reported through the job_error_event if a job did not complete
+    before its deadline.
+    """
+    pass
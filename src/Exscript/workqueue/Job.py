@@ -12,66 +12,69 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
-import sys
+import random
 import threading
 import multiprocessing
-from copy import copy
+from cPickle import PicklingError
 from functools import partial
 from multiprocessing import Pipe
+from Exscript.util.event import Event
 from Exscript.util.impl import serializeable_sys_exc_info
 
-class _ChildWatcher(threading.Thread):
-    def __init__(self, child, callback):
-        threading.Thread.__init__(self)
-        self.child = child
-        self.cb    = callback
-
-    def __copy__(self):
-        watcher = _ChildWatcher(copy(self.child), self.cb)
-        return watcher
-
-    def run(self):
-        to_child, to_self = Pipe()
-        try:
-            self.child.start(to_self)
-            result = to_child.recv()
-            self.child.join()
-        except:
-            result = sys.exc_info()
-        finally:
-            to_child.close()
-            to_self.close()
-        if result == '':
-            self.cb(None)
-        else:
-            self.cb(result)
-
 def _make_process_class(base, clsname):
     class process_cls(base):
         def __init__(self, id, function, name, data):
             base.__init__(self, name = name)
-            self.id       = id
-            self.pipe     = None
-            self.function = function
-            self.failures = 0
-            self.data     = data
+            self.id           = id
+            self.pipe         = None
+            self.function     = function
+            self.failures     = 0
+            self.data         = data
+            self.result       = None
+            self.cancel_event = Event()
 
         def run(self):
             """
-            Start the associated function.
+            Start the associated function, and send the result to the
+            parent as an (exc_info, result) tuple. A thread stores the
+            result in self.result instead, so it need not be pickled.
             """
             try:
-                self.function(self)
+                result = self.function(self)
             except:
-                self.pipe.send(serializeable_sys_exc_info())
+                self.pipe.send((serializeable_sys_exc_info(), None))
             else:
-                self.pipe.send('')
+                if not isinstance(self, multiprocessing.Process):
+                    self.result = result
+                    result      = None
+                try:
+                    self.pipe.send((None, result))
+                except (PicklingError, TypeError):
+                    # The result could not be pickled.
+                    self.pipe.send((serializeable_sys_exc_info(), None))
             finally:
                 self.pipe = None
 
         def start(self, pipe):
             self.pipe = pipe
             base.start(self)
+
+        def cancel(self):
+            """
+            Asks the running function to stop. A process is terminated.
+            A thread can not be killed, so the cancel_event is sent instead;
+            the function should connect to it to abort what it is doing,
+            e.g. by closing its connection.
+
+            @rtype:  bool
+            @return: True if the function was stopped, False if it was
+                only asked to stop.
+            """
+            if isinstance(self, multiprocessing.Process):
+                self.terminate()
+                return True
+            self.cancel_event()
+            return False
     process_cls.__name__ = clsname
     return process_cls
 
@@ -85,25 +88,87 @@ class Job(object):
                  'times',
                  'failures',
                  'data',
-                 'child',
-                 'watcher')
+                 'retry_delay',
+                 'deadline',
+                 'result',
+                 'child')
+
+    def __init__(self,
+                 function,
+                 name,
+                 times,
+                 data,
+                 retry_delay = None,
+                 deadline    = None):
+        self.id          = None
+        self.func        = function
+        self.name        = name is None and str(id(function)) or name
+        self.times       = times
+        self.failures    = 0
+        self.data        = data
+        self.retry_delay = retry_delay
+        self.deadline    = deadline
+        self.result      = None
+        self.child       = None
+
+    def get_retry_delay(self):
+        """
+        Returns the number of seconds to wait before the job is retried,
+        or None if it is retried immediately.
+        A numeric retry_delay is doubled with every failure, and varied by
+        up to 50 percent, so that failed jobs are not all retried at the
+        same time. Otherwise, retry_delay is a function that is called
+        with the number of failures and returns the delay.
+        """
+        if self.retry_delay is None:
+            return None
+        if callable(self.retry_delay):
+            return self.retry_delay(self.failures)
+        delay = self.retry_delay * 2 ** (self.failures - 1)
+        return delay * random.uniform(.5, 1.5)
 
-    def __init__(self, function, name, times, data):
-        self.id       = None
-        self.func     = function
-        self.name     = name is None and str(id(function)) or name
-        self.times    = times
-        self.failures = 0
-        self.data     = data
-        self.child    = None
-        self.watcher  = None
+    def _on_child_done(self, reactor, pipe, child, on_complete, message):
+        # Called by the reactor when the child has sent its result. If the
+        # job was cancelled, self.child may already be the next attempt.
+        reactor.remove(pipe)
+        pipe.close()
+        reactor.join_later(child)
+        if message is None:
+            try:
+                raise Exception('job %s died unexpectedly' % repr(self.name))
+            except Exception:
+                message = serializeable_sys_exc_info(), None
+        exc_info, result = message
+        if isinstance(child, multiprocessing.Process):
+            child.result = result
+        on_complete(self, exc_info)
 
-    def start(self, child_cls, on_complete):
+    def start(self, child_cls, reactor, on_complete):
+        """
+        Starts the job in a new thread or process. The reactor reports
+        the result by calling on_complete with the job and the exception
+        info, or None on success. The return value of the function is
+        then available in self.child.result.
+        """
+        to_child, to_self = Pipe()
         self.child = child_cls(self.id, self.func, self.name, self.data)
         self.child.failures = self.failures
-        self.watcher = _ChildWatcher(self.child, partial(on_complete, self))
-        self.watcher.start()
+        done = partial(self._on_child_done,
+                       reactor,
+                       to_child,
+                       self.child,
+                       on_complete)
+        reactor.add(to_child, done)
+        try:
+            self.child.start(to_self)
+        except:
+            reactor.remove(to_child)
+            to_child.close()
+            to_self.close()
+            on_complete(self, serializeable_sys_exc_info())
+            return
 
-    def join(self):
-        self.watcher.join()
-        self.child = None
+        # A process has inherited its end of the pipe. Closing ours
+        # ensures that the reactor sees EOF if the process dies.
+        if isinstance(self.child, multiprocessing.Process):
+            to_self.close()
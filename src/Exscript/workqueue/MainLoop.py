@@ -13,15 +13,66 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 import threading
+import traceback
 import multiprocessing
 from Exscript.util.event import Event
+from Exscript.util.impl import serializeable_sys_exc_info
 from Exscript.workqueue.Job import Job
+from Exscript.workqueue.Exception import JobTimeoutException
 
 # See http://bugs.python.org/issue1731717
 multiprocessing.process._cleanup = lambda: None
 
+class _Deadline(object):
+    """
+    Watches one attempt to run a job. If the deadline expires first, the
+    job is cancelled using on_expire, and reported to on_complete as
+    failed with a JobTimeoutException. on_expire returns whether the job
+    was stopped; if it was not, e.g. because a thread can not be killed,
+    the job is only reported once it has actually completed, so that it
+    keeps its slot until then.
+    """
+    def __init__(self, job, reactor, on_expire, on_complete):
+        self.job         = job
+        self.reactor     = reactor
+        self.on_expire   = on_expire
+        self.on_complete = on_complete
+        self.lock        = threading.Lock()
+        self.done        = False
+        self.expired     = None # The exc_info of the expired deadline.
+        self.timer       = reactor.call_later(job.deadline, self._expire)
+
+    def _expire(self):
+        # Called in the reactor thread.
+        try:
+            msg = 'job %s exceeded its deadline of %.1fs'
+            raise JobTimeoutException(msg % (repr(self.job.name),
+                                             self.job.deadline))
+        except JobTimeoutException:
+            exc_info = serializeable_sys_exc_info()
+        with self.lock:
+            if self.done:
+                return
+            self.expired = exc_info
+        stopped = True
+        try:
+            stopped = self.on_expire(self.job)
+        finally:
+            if stopped:
+                self.completed(self.job, exc_info)
+
+    def completed(self, job, exc_info):
+        with self.lock:
+            if self.done:
+                return # The job was stopped before.
+            self.done = True
+            if self.expired is not None:
+                exc_info = self.expired
+        self.reactor.cancel_call(self.timer)
+        self.on_complete(job, exc_info)
+
 class MainLoop(threading.Thread):
-    def __init__(self, collection, job_cls):
+    def __init__(self, collection, job_cls, pool = None, reactor = None):
         threading.Thread.__init__(self)
         self.job_init_event      = Event()
         self.job_started_event   = Event()
@@ -31,6 +82,8 @@ class MainLoop(threading.Thread):
         self.queue_empty_event   = Event()
         self.collection          = collection
         self.job_cls             = job_cls
+        self.pool                = pool
+        self.reactor             = reactor
         self.debug               = 5
         self.daemon              = True
 
@@ -38,35 +91,181 @@ class MainLoop(threading.Thread):
         if self.debug >= level:
             print msg
 
-    def enqueue(self, function, name, times, data):
-        job    = Job(function, name, times, data)
-        job.id = self.collection.append(job)
+    def _emit(self, event, *args):
+        # A failing listener must neither keep the job from being removed
+        # from the queue, nor kill the reactor or worker thread that
+        # completes it.
+        try:
+            event(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _cancel_job(self, job):
+        # Returns False if the job was only asked to stop.
+        self._dbg(1, 'Job "%s" exceeded its deadline.' % job.name)
+        if self.pool is None:
+            return job.child.cancel()
+        return self.pool.cancel(job)
+
+    def _start_job(self, job):
+        # The deadline applies to every attempt separately.
+        on_complete = self._on_job_completed
+        if job.deadline is not None:
+            deadline    = _Deadline(job,
+                                    self.reactor,
+                                    self._cancel_job,
+                                    on_complete)
+            on_complete = deadline.completed
+        if self.pool is None:
+            job.start(self.job_cls, self.reactor, on_complete)
+        else:
+            self.pool.start(job, on_complete)
+        self.job_started_event(job.child)
+
+    def enqueue(self,
+                function,
+                name,
+                times,
+                data,
+                priority    = 0,
+                retry_delay = None,
+                deadline    = None):
+        job    = Job(function, name, times, data, retry_delay, deadline)
+        job.id = self.collection.append(job, priority = priority)
         return job.id
 
-    def enqueue_or_ignore(self, function, name, times, data):
+    def enqueue_many(self,
+                     function,
+                     jobs,
+                     times,
+                     priority    = 0,
+                     retry_delay = None,
+                     deadline    = None):
+        jobs = [(Job(function, name, times, data, retry_delay, deadline), name)
+                for name, data in jobs]
+        ids  = self.collection.append_many(jobs, priority)
+        for (job, name), job_id in zip(jobs, ids):
+            job.id = job_id
+        return ids
+
+    def enqueue_or_ignore(self,
+                          function,
+                          name,
+                          times,
+                          data,
+                          priority    = 0,
+                          retry_delay = None,
+                          deadline    = None):
         def conditional_append(queue):
             if queue.get_from_name(name) is not None:
                 return None
-            job    = Job(function, name, times, data)
-            job.id = queue.append(job, name)
+            job    = Job(function, name, times, data, retry_delay, deadline)
+            job.id = queue.append(job, name, priority)
             return job.id
         return self.collection.with_lock(conditional_append)
 
-    def priority_enqueue(self, function, name, force_start, times, data):
-        job    = Job(function, name, times, data)
+    def enqueue_many_or_ignore(self,
+                               function,
+                               jobs,
+                               times,
+                               priority    = 0,
+                               retry_delay = None,
+                               deadline    = None):
+        def conditional_append(queue):
+            # Names are only registered by append_many(), so duplicates
+            # within the batch need to be tracked separately.
+            seen   = set()
+            added  = []
+            result = []
+            for name, data in jobs:
+                if name in seen or queue.get_from_name(name) is not None:
+                    result.append(None)
+                    continue
+                if name is not None:
+                    seen.add(name)
+                job = Job(function, name, times, data, retry_delay, deadline)
+                added.append((job, name))
+                result.append(job)
+            ids = queue.append_many(added, priority)
+            for (job, name), job_id in zip(added, ids):
+                job.id = job_id
+            return [job and job.id for job in result]
+        return self.collection.with_lock(conditional_append)
+
+    def enqueue_many_or_merge(self,
+                              function,
+                              jobs,
+                              merge,
+                              times,
+                              priority    = 0,
+                              retry_delay = None,
+                              deadline    = None):
+        def merge_or_append(queue):
+            batch  = {} # Maps names to the jobs of this batch.
+            added  = []
+            result = []
+            for name, data in jobs:
+                job = batch.get(name) or queue.get_from_name(name)
+                if job is not None \
+                   and job.failures == 0 \
+                   and not queue.is_working(job) \
+                   and merge(job, function):
+                    result.append(job)
+                    continue
+                # A name that is taken by a started job is not indexed,
+                # so that a new job can be added regardless.
+                new = Job(function, name, times, data, retry_delay, deadline)
+                if job is None:
+                    added.append((new, name))
+                else:
+                    added.append((new, None))
+                if name is not None:
+                    batch[name] = new
+                result.append(new)
+            ids = queue.append_many(added, priority)
+            for (job, name), job_id in zip(added, ids):
+                job.id = job_id
+            return [job.id for job in result]
+        return self.collection.with_lock(merge_or_append)
+
+    def priority_enqueue(self,
+                         function,
+                         name,
+                         force_start,
+                         times,
+                         data,
+                         retry_delay = None,
+                         deadline    = None):
+        job    = Job(function, name, times, data, retry_delay, deadline)
         job.id = self.collection.appendleft(job, name, force = force_start)
         return job.id
 
+    def priority_enqueue_many(self,
+                              function,
+                              jobs,
+                              force_start,
+                              times,
+                              retry_delay = None,
+                              deadline    = None):
+        jobs = [(Job(function, name, times, data, retry_delay, deadline), name)
+                for name, data in jobs]
+        ids  = self.collection.appendleft_many(jobs, force_start)
+        for (job, name), job_id in zip(jobs, ids):
+            job.id = job_id
+        return ids
+
     def priority_enqueue_or_raise(self,
                                   function,
                                   name,
                                   force_start,
                                   times,
-                                  data):
+                                  data,
+                                  retry_delay = None,
+                                  deadline    = None):
         def conditional_append(queue):
             job = queue.get_from_name(name)
             if job is None:
-                job    = Job(function, name, times, data)
+                job = Job(function, name, times, data, retry_delay, deadline)
                 job.id = queue.append(job, name)
                 return job.id
             queue.prioritize(job, force = force_start)
@@ -80,8 +279,9 @@ class MainLoop(threading.Thread):
         return len(self.collection)
 
     def _on_job_completed(self, job, exc_info):
-        # This function is called in a sub-thread, so we need to be
-        # careful that we are not in a lock while sending an event.
+        # This function is called in the reactor thread (or in a worker
+        # thread), so we need to be careful that we are not in a lock
+        # while sending an event.
         self._dbg(1, 'Job "%s" called completed()' % job.name)
 
         try:
@@ -94,20 +294,29 @@ class MainLoop(threading.Thread):
             if exc_info:
                 self._dbg(1, 'Error in job "%s"' % job.name)
                 job.failures += 1
-                self.job_error_event(job.child, exc_info)
+                self._emit(self.job_error_event, job.child, exc_info)
                 if job.failures >= job.times:
                     self._dbg(1, 'Job "%s" finally failed' % job.name)
-                    self.job_aborted_event(job.child)
+                    self._emit(self.job_aborted_event, job.child)
             else:
                 self._dbg(1, 'Job "%s" succeeded.' % job.name)
-                self.job_succeeded_event(job.child)
+                self._emit(self.job_succeeded_event, job.child)
 
         finally:
-            # Remove the watcher from the queue, and re-enque if needed.
+            # Remove the job from the queue, and re-enque if needed.
+            # A delayed retry does not hold a slot while it waits.
+            # Immediate retries also return to the front of the queue,
+            # so that the reserve function is asked again before the
+            # next attempt.
             if exc_info and job.failures < job.times:
-                self._dbg(1, 'Restarting job "%s"' % job.name)
-                job.start(self.job_cls, self._on_job_completed)
-                self.job_started_event(job.child)
+                delay = job.get_retry_delay()
+                if delay is None:
+                    self._dbg(1, 'Restarting job "%s"' % job.name)
+                    self.collection.defer(job, 0)
+                else:
+                    msg = 'Retrying job "%s" in %.1fs' % (job.name, delay)
+                    self._dbg(1, msg)
+                    self.collection.defer(job, delay)
             else:
                 self.collection.task_done(job)
 
@@ -121,8 +330,9 @@ class MainLoop(threading.Thread):
             if job is None:
                 break  # self.collection.stop() was called.
 
-            self.job_init_event(job)
-            job.start(self.job_cls, self._on_job_completed)
-            self.job_started_event(job.child)
+            # Jobs that are retried after a delay were already initialized.
+            if job.failures == 0:
+                self.job_init_event(job)
+            self._start_job(job)
             self._dbg(1, 'Job "%s" started.' % job.name)
         self._dbg(2, 'Main loop terminated.')
@@ -12,50 +12,248 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
-from uuid import uuid4
-from collections import deque
+import time
+from heapq import heappush, heappop, heapify
+from itertools import count
+from collections import OrderedDict, defaultdict
 from multiprocessing import Condition, RLock
 
+# Item ids are unique within the process, even across pipelines.
+_item_ids = count(1)
+
+class _Record(object):
+    """
+    Everything the pipeline knows about a registered item.
+    """
+    __slots__ = 'id', 'name', 'item', 'groups'
+
+    def __init__(self, item_id, name, item, groups):
+        self.id     = item_id
+        self.name   = name
+        self.item   = item
+        self.groups = groups
+
 class Pipeline(object):
     """
     A collection that is similar to Python's Queue object, except
     it also tracks items that are currently sleeping or in progress.
+
+    Items may be appended with a numeric priority; items with a higher
+    priority are returned first, and items with the same priority are
+    returned in FIFO order. To avoid starving items with a low priority,
+    they age: one priority level is worth the given number of items that
+    were appended later. In other words, an item with priority n only
+    overtakes an item with priority n - 1 if it was appended less than
+    "aging" items after it.
+
+    Queued items are kept in a heap that is ordered by a (key, sequence
+    number) tuple per item. Removing an item from the queue only drops
+    its key; the stale heap entry is skipped when it reaches the top. This
+    way, prioritize() does not need to search the queue.
+    Queued items that are sleeping are taken out of the heap, but keep
+    their key, so that they return to their original position when they
+    wake up.
+
+    Items may also belong to concurrency groups, as returned by the
+    function that is passed to set_group_function(). No more than the
+    limit of a group (see set_group_limit()) of its items are working
+    at the same time. Items that are blocked by a group are taken out
+    of the heap in the same way as sleeping items, until an item of the
+    group is done.
+
+    Working items may be deferred for a while, e.g. to retry a failed
+    job later. Until it is due, a deferred item does not count as
+    working; it is then queued again at the very front of the queue.
+
+    Items may also belong to a flow, as returned by the function that is
+    passed to set_flow_function(), such as the order that created them.
+    Queued items of different flows are returned in a weighted round-robin
+    fashion: every flow has a virtual clock that advances by the inverse
+    of its weight (see set_flow_weight()) per appended item, and items
+    are keyed by the clock of their flow instead of by the number of
+    items appended before them. A flow that had no queued items starts at
+    the clock of the item that was returned last, so that a small flow
+    that is appended behind a large one does not wait for it to finish.
+    Without a flow function, all items are in the same flow, and the
+    queue is a FIFO as described above.
+
+    Finally, an item may need a resource that is managed elsewhere, such
+    as a user account. The function that is passed to
+    set_reserve_function() is asked to reserve the resources of an item
+    before it is started; if a resource is not available, the item is
+    taken out of the heap like a blocked item, until unblock() is called
+    with that resource.
     """
-    def __init__(self, max_working = 1):
+    def __init__(self, max_working = 1, aging = 1000):
+        """
+        Constructor.
+
+        @type  max_working: int
+        @param max_working: The maximum number of items that are working.
+        @type  aging: int
+        @param aging: The number of appended items per priority level.
+        """
         self.condition   = Condition(RLock())
         self.max_working = max_working
+        self.aging       = int(aging)
         self.running     = True
         self.paused      = False
-        self.queue       = None
+        self.queue       = None # Heap of (key, sequence number, item).
+        self.item2key    = None # Maps queued items to (key, sequence number).
+        self.asleep      = None # Like item2key, for sleeping queued items.
+        self.head        = None # The lowest key that was assigned.
+        self.tail        = None # The last sequence number.
+        self.vclock      = None # The key of the last item that was returned.
+        self.flow_tail   = None # Maps flows to their virtual clock.
+        self.max_flows   = None # The number of flows before cleaning up.
+        self.get_flow    = None # Maps an item to its flow.
+        self.weights     = dict()
         self.force       = None
         self.sleeping    = None
         self.working     = None
-        self.item2id     = None
-        self.id2item     = None # for performance reasons
-        self.name2id     = None
-        self.id2name     = None
+        self.records     = None # Maps items to their _Record.
+        self.id2record   = None
+        self.name2record = None
+        self.get_groups  = None # Maps an item to a list of groups.
+        self.reserve     = None # Reserves the resources of an item.
+        self.limits      = dict()
+        self.group_load  = None # Maps groups to their working item count.
+        self.blocked     = None # Maps blocked items to (key, group/resource).
+        self.blocked_by  = None # Maps groups/resources to blocked items.
+        self.deferred    = None # Heap of (due time, item id, item).
+        self.due         = None # Maps deferred items to their due time.
         self.clear()
 
     def __len__(self):
         with self.condition:
-            return len(self.id2item)
+            return len(self.records)
 
     def __contains__(self, item):
         with self.condition:
-            return item in self.item2id
+            return item in self.records
 
     def _register_item(self, name, item):
-        uuid               = uuid4().hex
-        self.id2item[uuid] = item
-        self.item2id[item] = uuid
-        if name is None:
-            return uuid
-        if name in self.name2id:
+        if name is not None and name in self.name2record:
             msg = 'an item named %s is already queued' % repr(name)
             raise AttributeError(msg)
-        self.name2id[name] = uuid
-        self.id2name[uuid] = name
-        return uuid
+        groups = ()
+        if self.get_groups is not None:
+            groups = tuple(self.get_groups(item) or ())
+        record                    = _Record(self._new_id(name, item),
+                                            name,
+                                            item,
+                                            groups)
+        self.records[item]        = record
+        self.id2record[record.id] = record
+        if name is not None:
+            self.name2record[name] = record
+        return record.id
+
+    def _register_many(self, items):
+        # Registers a batch of items as a whole: if one of them can not be
+        # registered, e.g. because the group function raised, the items
+        # that were already registered are forgotten again.
+        self._check_names(items)
+        ids = []
+        try:
+            for item, name in items:
+                ids.append(self._register_item(name, item))
+        except:
+            for item, name in items[:len(ids)]:
+                self._unregister_item(item)
+            raise
+        return ids
+
+    def _unregister_item(self, item):
+        # Forgets the given item, including its place in the queue.
+        record = self.records.pop(item)
+        del self.id2record[record.id]
+        if record.name is not None:
+            del self.name2record[record.name]
+        self.item2key.pop(item, None)
+        self.force.pop(item, None)
+        return record
+
+    def _new_id(self, name, item):
+        # Returns the id of an item that is being registered.
+        return _item_ids.next()
+
+    def _check_names(self, items):
+        # Makes sure that a batch of items can be registered as a whole.
+        names = set()
+        for item, name in items:
+            if name is None:
+                continue
+            if name in self.name2record or name in names:
+                msg = 'an item named %s is already queued' % repr(name)
+                raise AttributeError(msg)
+            names.add(name)
+
+    def _next_key(self, priority = None, flow = None):
+        # Without a priority, the key is lower than any other key, so
+        # that the item is placed at the very front of the queue.
+        self.tail += 1
+        if priority is None:
+            self.head -= 1
+            return self.head, self.tail
+        start  = max(self.flow_tail.get(flow, 0), self.vclock)
+        finish = start + 1.0 / self.weights.get(flow, 1)
+        self.flow_tail[flow] = finish
+        if len(self.flow_tail) > self.max_flows:
+            self._forget_flows()
+        key       = finish - int(priority) * self.aging
+        self.head = min(self.head, key)
+        return key, self.tail
+
+    def _forget_flows(self):
+        # Flows whose clock is behind the virtual clock start at the
+        # virtual clock anyway, so they need not be remembered.
+        for flow, finish in self.flow_tail.items():
+            if finish <= self.vclock:
+                del self.flow_tail[flow]
+        self.max_flows = 2 * len(self.flow_tail) + 32
+
+    def _get_flow_of(self, item):
+        if self.get_flow is None:
+            return None
+        return self.get_flow(item)
+
+    def _push(self, item, key):
+        self.item2key[item] = key
+        heappush(self.queue, key + (item,))
+
+    def _peek(self):
+        # Drops stale entries from the top of the heap, and returns the
+        # first valid item or None.
+        while self.queue:
+            entry = self.queue[0]
+            item  = entry[2]
+            if self.item2key.get(item) == entry[:2]:
+                return item
+            heappop(self.queue)
+        return None
+
+    def _iter_queue(self):
+        # Yields the valid items of the heap in order, without changing
+        # the heap: the candidates for the next item are the children of
+        # the entries that were already yielded.
+        queue      = self.queue
+        candidates = queue and [(queue[0], 0)] or []
+        while candidates:
+            entry, index = heappop(candidates)
+            item         = entry[2]
+            if self.item2key.get(item) == entry[:2]:
+                yield item
+            for child in 2 * index + 1, 2 * index + 2:
+                if child < len(queue):
+                    heappush(candidates, (queue[child], child))
+
+    def _compact(self):
+        # Removes stale entries once they outnumber the valid ones.
+        if len(self.queue) < 2 * len(self.item2key) + 32:
+            return
+        self.queue = [k + (i,) for i, k in self.item2key.iteritems()]
+        heapify(self.queue)
 
     def get_from_name(self, name):
         """
@@ -64,22 +262,29 @@ class Pipeline(object):
         """
         with self.condition:
             try:
-                item_id = self.name2id[name]
+                return self.name2record[name].item
             except KeyError:
                 return None
-            return self.id2item[item_id]
         return None
 
     def has_id(self, item_id):
         """
         Returns True if the queue contains an item with the given id.
         """
-        return item_id in self.id2item
+        return item_id in self.id2record
+
+    def _release(self, item):
+        # Frees the slots that the working item occupies. Raises KeyError
+        # if the item is not working.
+        self.working.remove(item)
+        for group in self.records[item].groups:
+            self.group_load[group] -= 1
+            self._unblock(group)
 
     def task_done(self, item):
         with self.condition:
             try:
-                self.working.remove(item)
+                self._release(item)
             except KeyError:
                 # This may happen if we receive a notification from a
                 # thread that was previously enqueued, but then the
@@ -87,62 +292,167 @@ class Pipeline(object):
                 # child threads to complete.
                 self.condition.notify_all()
                 return
-            item_id = self.item2id.pop(item)
-            self.id2item.pop(item_id)
+            self._unregister_item(item)
+            self.condition.notify_all()
+
+    def defer(self, item, delay):
+        """
+        Stops the given working item, and queues it again at the front
+        of the queue after the given number of seconds.
+
+        @type  item: object
+        @param item: The working item.
+        @type  delay: float
+        @param delay: The number of seconds to wait.
+        """
+        with self.condition:
             try:
-                name = self.id2name.pop(item_id)
+                self._release(item)
             except KeyError:
-                pass
-            else:
-                self.name2id.pop(name)
+                # See task_done().
+                self.condition.notify_all()
+                return
+            due            = time.time() + delay
+            self.due[item] = due
+            heappush(self.deferred, (due, self.records[item].id, item))
             self.condition.notify_all()
 
-    def append(self, item, name = None):
+    def append(self, item, name = None, priority = 0):
         """
-        Adds the given item to the end of the pipeline.
+        Adds the given item to the end of the pipeline, behind all items
+        with the same or a higher priority.
+
+        @type  item: object
+        @param item: The item that is added.
+        @type  name: str
+        @param name: An optional name of the item; names must be unique.
+        @type  priority: int
+        @param priority: Items with a higher priority are returned first.
         """
         with self.condition:
-            self.queue.append(item)
-            uuid = self._register_item(name, item)
+            flow    = self._get_flow_of(item)
+            item_id = self._register_item(name, item)
+            self._push(item, self._next_key(priority, flow))
             self.condition.notify_all()
-            return uuid
+            return item_id
+
+    def append_many(self, items, priority = 0):
+        """
+        Like append(), but adds a whole batch of items while the
+        pipeline is locked only once. If any of the names is already
+        in use, no item is added.
+
+        @type  items: list[(object, str)]
+        @param items: A list of (item, name) tuples; the name may be None.
+        @type  priority: int
+        @param priority: Items with a higher priority are returned first.
+        @rtype:  list[int]
+        @return: The ids of the items, in the given order.
+        """
+        with self.condition:
+            flows = [self._get_flow_of(item) for item, name in items]
+            ids   = self._register_many(items)
+            for (item, name), flow in zip(items, flows):
+                self._push(item, self._next_key(priority, flow))
+            self.condition.notify_all()
+            return ids
 
     def appendleft(self, item, name = None, force = False):
         with self.condition:
+            item_id = self._register_item(name, item)
             if force:
-                self.force.append(item)
+                self.force[item] = None
             else:
-                self.queue.appendleft(item)
-            uuid = self._register_item(name, item)
+                self._push(item, self._next_key())
+            self.condition.notify_all()
+            return item_id
+
+    def appendleft_many(self, items, force = False):
+        """
+        Like append_many(), but calls appendleft() for each item.
+
+        @type  items: list[(object, str)]
+        @param items: A list of (item, name) tuples; the name may be None.
+        @type  force: bool
+        @param force: Whether to start the items regardless of max_working.
+        @rtype:  list[int]
+        @return: The ids of the items, in the given order.
+        """
+        with self.condition:
+            ids = self._register_many(items)
+            for item, name in items:
+                if force:
+                    self.force[item] = None
+                else:
+                    self._push(item, self._next_key())
             self.condition.notify_all()
-            return uuid
+            return ids
 
     def prioritize(self, item, force = False):
         """
         Moves the item to the very left of the queue.
+        Raises ValueError if the item is not in the pipeline.
         """
         with self.condition:
             # If the job is already running (or about to be forced),
             # there is nothing to be done.
             if item in self.working or item in self.force:
                 return
-            self.queue.remove(item)
+            if item not in self.records:
+                raise ValueError('item is not in the pipeline')
+            if item in self.asleep:
+                del self.asleep[item]
+                if force:
+                    self.force[item] = None
+                else:
+                    self.asleep[item] = self._next_key()
+                self.condition.notify_all()
+                return
+            if item in self.blocked:
+                key, group = self.blocked.pop(item)
+                if force:
+                    self.force[item] = None
+                else:
+                    self.blocked[item] = self._next_key(), group
+                self.condition.notify_all()
+                return
+            if item in self.due:
+                del self.due[item]
+                if force:
+                    self.force[item] = None
+                else:
+                    self._push(item, self._next_key())
+                self.condition.notify_all()
+                return
+            del self.item2key[item]
             if force:
-                self.force.append(item)
+                self.force[item] = None
             else:
-                self.queue.appendleft(item)
+                self._push(item, self._next_key())
+            self._compact()
             self.condition.notify_all()
 
     def clear(self):
         with self.condition:
-            self.queue    = deque()
-            self.force    = deque()
+            self.queue    = []
+            self.item2key = dict()
+            self.asleep   = dict()
+            self.head     = 0
+            self.tail     = 0
+            self.vclock   = 0
+            self.flow_tail   = dict()
+            self.max_flows   = 32
+            self.force    = OrderedDict()
             self.sleeping = set()
             self.working  = set()
-            self.item2id  = dict()
-            self.id2item  = dict()
-            self.name2id  = dict()
-            self.id2name  = dict()
+            self.records     = dict()
+            self.id2record   = dict()
+            self.name2record = dict()
+            self.group_load  = defaultdict(int)
+            self.blocked     = dict()
+            self.blocked_by  = defaultdict(list)
+            self.deferred    = []
+            self.due         = dict()
             self.condition.notify_all()
 
     def stop(self):
@@ -172,12 +482,21 @@ class Pipeline(object):
     def sleep(self, item):
         with self.condition:
             self.sleeping.add(item)
+            key = self.item2key.pop(item, None)
+            if key is None:
+                key = self.blocked.pop(item, (None, None))[0]
+            if key is not None:
+                self.asleep[item] = key
+                self._compact()
             self.condition.notify_all()
 
     def wake(self, item):
         assert item in self.sleeping
         with self.condition:
             self.sleeping.remove(item)
+            key = self.asleep.pop(item, None)
+            if key is not None:
+                self._push(item, key)
             self.condition.notify_all()
 
     def wait_for_id(self, item_id):
@@ -201,6 +520,24 @@ class Pipeline(object):
             while len(self) > 0:
                 self.condition.wait()
 
+    def wait_for_room(self, max_pending):
+        """
+        Waits until fewer than max_pending items are queued but not yet
+        working, or until the pipeline is stopped.
+
+        @type  max_pending: int
+        @param max_pending: The maximum number of pending items.
+        @rtype:  int
+        @return: The number of items that may be added, 0 if stopped.
+        """
+        with self.condition:
+            while self.running:
+                pending = len(self.records) - len(self.working)
+                if pending < max_pending:
+                    return max_pending - pending
+                self.condition.wait()
+            return 0
+
     def with_lock(self, function, *args, **kwargs):
         with self.condition:
             return function(self, *args, **kwargs)
@@ -216,54 +553,225 @@ class Pipeline(object):
     def get_working(self):
         return list(self.working)
 
-    def _popleft_sleeping(self):
-        sleeping = []
+    def is_working(self, item):
+        """
+        Returns True if the given item was started and is not yet done.
+        """
+        with self.condition:
+            return item in self.working
+
+    def set_group_function(self, function):
+        """
+        Defines the concurrency groups of items that are added later.
+
+        @type  function: callable
+        @param function: Called with an item, returns a list of groups.
+        """
+        with self.condition:
+            self.get_groups = function
+
+    def set_group_limit(self, group, limit):
+        """
+        Set the maximum number of items of the given group that are
+        working at the same time. Forced items ignore the limit.
+
+        @type  group: object
+        @param group: The name of the group.
+        @type  limit: int
+        @param limit: The maximum number of items, or None for no limit.
+        """
+        with self.condition:
+            if limit is None:
+                self.limits.pop(group, None)
+            else:
+                self.limits[group] = int(limit)
+            self._unblock(group)
+            self.condition.notify_all()
+
+    def get_group_limit(self, group):
+        """
+        Returns the limit of the given group, or None.
+
+        @type  group: object
+        @param group: The name of the group.
+        @rtype:  int
+        @return: The maximum number of working items in the group.
+        """
+        return self.limits.get(group)
+
+    def set_flow_function(self, function):
+        """
+        Defines the flows of items that are appended later. The given
+        function is called with an item, and returns the flow that the
+        item belongs to, or None.
+
+        @type  function: callable
+        @param function: Called with an item, returns a hashable flow.
+        """
+        with self.condition:
+            self.get_flow = function
+
+    def set_flow_weight(self, flow, weight):
+        """
+        Defines the share of the given flow, relative to other flows. A
+        flow with weight 2 is served twice as often as a flow with the
+        default weight of 1, as long as both have queued items. Applies
+        to items that are appended later.
+
+        @type  flow: object
+        @param flow: The flow, as returned by the flow function.
+        @type  weight: float
+        @param weight: The weight, or None to restore the default.
+        """
+        with self.condition:
+            if weight is None:
+                self.weights.pop(flow, None)
+            elif weight <= 0:
+                raise ValueError('weight must be positive: %s' % weight)
+            else:
+                self.weights[flow] = float(weight)
+
+    def get_flow_weight(self, flow):
+        """
+        Returns the weight of the given flow.
+
+        @type  flow: object
+        @param flow: The flow, as returned by the flow function.
+        @rtype:  float
+        @return: The weight of the flow.
+        """
+        return self.weights.get(flow, 1)
+
+    def set_reserve_function(self, function):
+        """
+        Defines a function that is called with the next item, while the
+        pipeline is locked, before the item is started. If the function
+        returns None, the item is started, so the function should reserve
+        whatever the item needs at that point. Otherwise, the function
+        returns the resource that the item waits for, and the item is
+        not started before unblock() is called with that resource.
+        Forced items are started without calling the function.
+
+        @type  function: callable
+        @param function: Called with an item, returns None or a resource.
+        """
+        with self.condition:
+            self.reserve = function
+
+    def unblock(self, resource, max_items = None):
+        """
+        Returns the items that wait for the given resource into the queue.
+        Items that still find the resource unavailable wait again.
+
+        @type  resource: object
+        @param resource: The resource, as returned by the reserve function.
+        @type  max_items: int
+        @param max_items: The maximum number of items to return, or None
+            for all of them.
+        @rtype:  int
+        @return: The number of items that still wait for the resource.
+        """
+        with self.condition:
+            items = self._get_blocked_by(resource)
+            if max_items is None:
+                max_items = len(items)
+            if items[max_items:]:
+                self.blocked_by[resource] = items[max_items:]
+            for item in items[:max_items]:
+                self._push(item, self.blocked.pop(item)[0])
+            if items[:max_items]:
+                self.condition.notify_all()
+            return len(items[max_items:])
+
+    def _get_blocked_by(self, group):
+        # Removes the list of items that are blocked by the given group or
+        # resource, and returns the items that still wait for it. Items
+        # that were woken or prioritized in the meantime are listed even
+        # if they no longer wait, possibly more than once.
+        items = OrderedDict()
+        for item in self.blocked_by.pop(group, ()):
+            blocked = self.blocked.get(item)
+            if blocked is not None and blocked[1] == group:
+                items[item] = None
+        return items.keys()
+
+    def _get_full_group(self, item):
+        for group in self.records[item].groups:
+            limit = self.limits.get(group)
+            if limit is not None and self.group_load[group] >= limit:
+                return group
+        return None
+
+    def _unblock(self, group):
+        # Returns the items that are blocked by the group into the heap.
+        # They are blocked again by _get_next() if another group is full.
+        limit = self.limits.get(group)
+        if limit is not None and self.group_load[group] >= limit:
+            return
+        for item in self._get_blocked_by(group):
+            self._push(item, self.blocked.pop(item)[0])
+
+    def _start(self, item):
+        # Returns False if the item was dropped instead of being started.
+        self.working.add(item)
+        for group in self.records[item].groups:
+            self.group_load[group] += 1
+        return True
+
+    def _get_next(self):
+        # Sleeping items are not in the heap, so the first valid entry
+        # is the next item, unless one of its groups is full, or one of
+        # its resources is not available.
         while True:
-            try:
-                node = self.queue[0]
-            except IndexError:
-                break
-            if node not in self.sleeping:
+            next = self._peek()
+            if next is None:
+                return None
+            group = self._get_full_group(next)
+            if group is None and self.reserve is not None:
+                group = self.reserve(next)
+            if group is None:
                 break
-            sleeping.append(node)
-            self.queue.popleft()
-        return sleeping
-
-    def _get_next(self, pop = True):
-        # We need to leave sleeping items in the queue because else we
-        # would not know their original position after they wake up.
-        # So we need to temporarily remove sleeping items from the top of
-        # the queue here.
-        sleeping = self._popleft_sleeping()
-
-        # Get the first non-sleeping item from the queue.
-        if pop:
-            try:
-                next = self.queue.popleft()
-            except IndexError:
-                next = None
-        else:
-            try:
-                next = self.queue[0]
-            except IndexError:
-                next = None
-
-        # Re-insert sleeping items.
-        self.queue.extendleft(sleeping)
+            heappop(self.queue)
+            self.blocked[next] = self.item2key.pop(next), group
+            self.blocked_by[group].append(next)
+        heappop(self.queue)
+        key         = self.item2key.pop(next)
+        self.vclock = max(self.vclock, key[0])
         return next
 
+    def _queue_due(self):
+        # Queues the deferred items that are due, and returns the number
+        # of seconds until the next one is due, or None.
+        now = time.time()
+        while self.deferred:
+            due, item_id, item = self.deferred[0]
+            if self.due.get(item) != due:
+                heappop(self.deferred)
+            elif due <= now:
+                heappop(self.deferred)
+                del self.due[item]
+                # A sleeping item is queued by wake() instead.
+                if item in self.sleeping:
+                    self.asleep[item] = self._next_key()
+                else:
+                    self._push(item, self._next_key())
+            else:
+                return due - now
+        return None
+
     def try_next(self):
         """
         Like next(), but only returns the item that would be selected
         right now, without locking and without changing the queue.
         """
         with self.condition:
-            try:
-                return self.force[0]
-            except IndexError:
-                pass
+            for item in self.force:
+                return item
 
-            return self._get_next(False)
+            for item in self._iter_queue():
+                if self._get_full_group(item) is None:
+                    return item
+            return None
 
     def next(self):
         with self.condition:
@@ -281,19 +789,18 @@ class Pipeline(object):
 
                 # Forced items are returned regardless of how many tasks
                 # are already working.
-                try:
-                    next = self.force.popleft()
-                except IndexError:
-                    pass
-                else:
-                    self.working.add(next)
-                    return next
+                if self.force:
+                    next = self.force.popitem(last = False)[0]
+                    if self._start(next):
+                        return next
+                    continue
 
-                # Return the first non-sleeping task.
-                next = self._get_next()
+                # Return the first non-sleeping, non-blocked task.
+                timeout = self._queue_due()
+                next    = self._get_next()
                 if next is None:
-                    self.condition.wait()
+                    self.condition.wait(timeout)
                     continue
-                self.working.add(next)
-                return next
+                if self._start(next):
+                    return next
         return None
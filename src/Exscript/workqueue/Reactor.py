@@ -0,0 +1,271 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+Waits for messages on many pipes using a single thread.
+"""
+import os
+import errno
+import fcntl
+import time
+import heapq
+import select
+import threading
+import traceback
+from itertools import count
+
+class Reactor(threading.Thread):
+    """
+    A thread that waits for data on any number of pipes at once, and
+    passes every message that is received to the callback that was
+    registered with the pipe.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon   = True
+        self.lock     = threading.Lock()
+        self.pipes    = {} # Maps a file descriptor to (pipe, callback).
+        self.readers  = {} # Maps a file descriptor to a callback.
+        self.children = [] # Processes that are done but not yet reaped.
+        self.timers   = [] # A heap of [due, seq, callback] lists.
+        self.seq      = count()
+        self.running  = True
+        self.wakeup   = os.pipe()
+        flags = fcntl.fcntl(self.wakeup[1], fcntl.F_GETFL)
+        fcntl.fcntl(self.wakeup[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.wakeup[0], select.POLLIN)
+        else:
+            self.poller = None
+
+    def _wake(self):
+        with self.lock:
+            if self.wakeup is None:
+                return
+            try:
+                os.write(self.wakeup[1], 'x')
+            except OSError, e:
+                # If the pipe is full, the reactor is woken anyway.
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def add(self, pipe, callback):
+        """
+        Starts watching the given pipe. The callback is called with every
+        object that is received. When the other end of the pipe is closed,
+        the pipe is removed from the reactor, and the callback is called
+        with None.
+
+        @type  pipe: multiprocessing.Connection
+        @param pipe: The pipe to watch.
+        @type  callback: callable
+        @param callback: Called in the reactor thread.
+        """
+        fd = pipe.fileno()
+        with self.lock:
+            self.pipes[fd] = pipe, callback
+            if self.poller is not None:
+                self.poller.register(fd, select.POLLIN)
+        self._wake()
+
+    def remove(self, pipe):
+        """
+        Stops watching the given pipe. The pipe is not closed; it must not
+        be closed before it is removed.
+
+        @type  pipe: multiprocessing.Connection
+        @param pipe: The pipe that was passed to add().
+        """
+        fd = pipe.fileno()
+        with self.lock:
+            if self.pipes.pop(fd, None) is None:
+                return
+            if self.poller is not None:
+                self.poller.unregister(fd)
+
+    def add_reader(self, fileobj, callback):
+        """
+        Calls the given function once, as soon as the given file or socket
+        is readable. The callback must not block.
+
+        @type  fileobj: object
+        @param fileobj: An object that has a fileno() method.
+        @type  callback: callable
+        @param callback: Called in the reactor thread without arguments.
+        """
+        fd = fileobj.fileno()
+        with self.lock:
+            self.readers[fd] = callback
+            if self.poller is not None:
+                self.poller.register(fd, select.POLLIN)
+        self._wake()
+
+    def remove_reader(self, fileobj):
+        """
+        Cancels a callback that was registered using add_reader(). Does
+        nothing if the callback was already called.
+
+        @type  fileobj: object
+        @param fileobj: The object that was passed to add_reader().
+        """
+        with self.lock:
+            self._unregister_reader(fileobj.fileno())
+
+    def _unregister_reader(self, fd):
+        # Called with the lock acquired.
+        callback = self.readers.pop(fd, None)
+        if callback is not None and self.poller is not None:
+            self.poller.unregister(fd)
+        return callback
+
+    def join_later(self, child):
+        """
+        Joins the given thread or process as soon as it has terminated,
+        without blocking the reactor.
+
+        @type  child: threading.Thread|multiprocessing.Process
+        @param child: The child to join.
+        """
+        with self.lock:
+            self.children.append(child)
+        self._wake()
+
+    def call_later(self, delay, callback):
+        """
+        Calls the given function in the reactor thread after the given
+        number of seconds. The callback must not block.
+
+        @type  delay: float
+        @param delay: The number of seconds to wait.
+        @type  callback: callable
+        @param callback: Called without arguments.
+        @rtype:  object
+        @return: A handle that may be passed to cancel_call().
+        """
+        timer = [time.time() + delay, self.seq.next(), callback]
+        with self.lock:
+            heapq.heappush(self.timers, timer)
+        self._wake()
+        return timer
+
+    def cancel_call(self, handle):
+        """
+        Cancels a call that was scheduled using call_later(). Does nothing
+        if the callback was already called.
+
+        @type  handle: object
+        @param handle: The value that call_later() returned.
+        """
+        with self.lock:
+            # Removed lazily when it reaches the top of the heap.
+            handle[2] = None
+
+    def stop(self):
+        """
+        Stops the reactor thread. Pipes that are still being watched are
+        not closed.
+        """
+        self.running = False
+        self._wake()
+
+    def _call(self, callback, *args):
+        # An exception must not terminate the reactor thread, because then
+        # nothing would ever complete any job again.
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _tick(self):
+        # Called after every iteration of the main loop. Returns True if
+        # it needs to be called again soon, even if no data arrives.
+        # is_alive() joins a terminated process without blocking.
+        with self.lock:
+            self.children = [c for c in self.children if c.is_alive()]
+            return len(self.children) > 0
+
+    def _run_timers(self):
+        # Calls all timers that are due, and returns the number of seconds
+        # until the next one, or None if there is none.
+        while True:
+            with self.lock:
+                if not self.timers:
+                    return None
+                due, seq, callback = self.timers[0]
+                if callback is not None:
+                    timeout = due - time.time()
+                    if timeout > 0:
+                        return timeout
+                heapq.heappop(self.timers)
+            if callback is not None:
+                self._call(callback)
+
+    def _wait(self, timeout):
+        try:
+            if self.poller is not None:
+                if timeout is not None:
+                    timeout *= 1000
+                return [fd for fd, event in self.poller.poll(timeout)]
+            with self.lock:
+                fds = self.pipes.keys() + self.readers.keys()
+            fds.append(self.wakeup[0])
+            return select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def _handle(self, fd):
+        with self.lock:
+            reader = self._unregister_reader(fd)
+        if reader is not None:
+            self._call(reader)
+            return
+
+        with self.lock:
+            try:
+                pipe, callback = self.pipes[fd]
+            except KeyError:
+                return # Removed in the meantime.
+
+        # The descriptor may have been re-used for a new pipe since it was
+        # reported as readable, so never block here.
+        try:
+            if not pipe.poll():
+                return
+            result = pipe.recv()
+        except (EOFError, IOError):
+            self.remove(pipe)
+            self._call(callback, None)
+        else:
+            self._call(callback, result)
+
+    def run(self):
+        timeout = None
+        while self.running:
+            for fd in self._wait(timeout):
+                if fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                else:
+                    self._handle(fd)
+            timeout = self._tick() and .1 or None
+            next_timer = self._run_timers()
+            if next_timer is not None and (timeout is None or
+                                           next_timer < timeout):
+                timeout = next_timer
+        with self.lock:
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
+            self.wakeup = None
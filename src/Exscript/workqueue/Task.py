@@ -15,25 +15,96 @@
 """
 Represents a batch of enqueued actions.
 """
+import threading
+from tempfile import TemporaryFile
+from cPickle import dumps, load, PicklingError
 from Exscript.util.event import Event
 
 class Task(object):
     """
     Represents a batch of running actions.
     """
-    def __init__(self, workqueue):
-        self.done_event = Event()
-        self.workqueue  = workqueue
-        self.job_ids    = set()
-        self.completed  = 0
-        self.workqueue.job_succeeded_event.listen(self._on_job_done)
-        self.workqueue.job_aborted_event.listen(self._on_job_done)
+    def __init__(self, workqueue, max_results = None):
+        """
+        Constructor.
+
+        @type  workqueue: WorkQueue
+        @param workqueue: The workqueue that runs the jobs.
+        @type  max_results: int
+        @param max_results: The maximum number of results that are kept
+            in memory, or None for no limit. Beyond that, results are
+            written to a temporary file; see L{results()}. Results
+            that can not be pickled are kept in memory regardless.
+        """
+        self.done_event  = Event()
+        self.workqueue   = workqueue
+        self.job_ids     = set()
+        self.completed   = 0
+        self.closed      = threading.Event()
+        self.lock        = threading.Lock()
+        self.max_results = max_results
+        self.result_list = [] # (name, result) tuples.
+        self.spill_file  = None
+        self.pinned      = [] # Results that could not be spilled.
+        self.closed.set()
+        self.workqueue.job_succeeded_event.listen(self._on_job_succeeded)
+        self.workqueue.job_aborted_event.listen(self._on_job_aborted)
+
+    def _add_result(self, name, result):
+        # Called with the lock acquired.
+        self.result_list.append((name, result))
+        if self.max_results is None \
+           or len(self.result_list) <= self.max_results:
+            return
+        if self.spill_file is None:
+            self.spill_file = TemporaryFile()
+        self.spill_file.seek(0, 2)
+        for item in self.result_list:
+            # In threading mode, results need not be picklable. Such a
+            # result is stored in memory, and its index in the file.
+            try:
+                data = dumps(item, -1)
+            except (PicklingError, TypeError):
+                data = dumps(len(self.pinned), -1)
+                self.pinned.append(item)
+            self.spill_file.write(data)
+        self.result_list = []
+
+    def _on_job_succeeded(self, job):
+        if job.id not in self.job_ids:
+            return
+        with self.lock:
+            self._add_result(job.name, job.result)
+        self._on_job_done(job)
+
+    def _on_job_aborted(self, job):
+        self._on_job_done(job)
 
     def _on_job_done(self, job):
         if job.id not in self.job_ids:
             return
-        self.completed += 1
-        if self.is_completed():
+        with self.lock:
+            self.completed += 1
+            completed = self.is_completed()
+        if completed:
+            self.done_event()
+
+    def open(self):
+        """
+        Marks the task as open, meaning that more jobs may still be added
+        to it. An open task is never completed.
+        """
+        self.closed.clear()
+
+    def close(self):
+        """
+        Marks the task as closed after open() was called, meaning that
+        all jobs were added.
+        """
+        with self.lock:
+            self.closed.set()
+            completed = self.is_completed()
+        if completed:
             self.done_event()
 
     def is_completed(self):
@@ -44,16 +115,47 @@ class Task(object):
         @rtype:  bool
         @return: Whether the task is completed.
         """
-        return self.completed == len(self.job_ids)
+        return self.closed.is_set() and self.completed == len(self.job_ids)
 
     def wait(self):
         """
         Waits until all actions in the task have completed.
         Does not use any polling.
         """
-        for theid in self.job_ids:
+        self.closed.wait()
+        for theid in list(self.job_ids):
             self.workqueue.wait_for(theid)
 
+    def results(self):
+        """
+        Returns an iterator over the return values of all jobs in the
+        task that succeeded so far, in the order in which they completed.
+        Results of jobs that complete while iterating are not included.
+        In multiprocessing mode, the return values are passed to the
+        parent process along with the completion of the job, so they must
+        be picklable.
+
+        @rtype:  iterator
+        @return: (job name, return value) tuples.
+        """
+        with self.lock:
+            in_memory = list(self.result_list)
+            end = 0
+            if self.spill_file is not None:
+                self.spill_file.seek(0, 2)
+                end = self.spill_file.tell()
+        offset = 0
+        while offset < end:
+            with self.lock:
+                self.spill_file.seek(offset)
+                item   = load(self.spill_file)
+                offset = self.spill_file.tell()
+                if isinstance(item, int):
+                    item = self.pinned[item]
+            yield item
+        for item in in_memory:
+            yield item
+
     def add_job_id(self, theid):
         """
         Adds a job to the task.
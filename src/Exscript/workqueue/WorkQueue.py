@@ -16,6 +16,10 @@ from Exscript.util.event import Event
 from Exscript.workqueue.Job import Thread, Process
 from Exscript.workqueue.Pipeline import Pipeline
 from Exscript.workqueue.MainLoop import MainLoop
+from Exscript.workqueue.WorkerPool import WorkerPool
+from Exscript.workqueue.CoroutinePool import CoroutinePool
+from Exscript.workqueue.Reactor import Reactor
+from Exscript.workqueue.Autotuner import Autotuner
 
 class WorkQueue(object):
     """
@@ -26,21 +30,79 @@ class WorkQueue(object):
                  collection = None,
                  debug = 0,
                  max_threads = 1,
-                 mode = 'threading'):
+                 mode = 'threading',
+                 stack_size = None,
+                 threads_per_process = 1,
+                 blocking_threads = 8):
         """
         Constructor.
+        In 'threading' and 'multiprocessing' mode, every job is executed
+        in a thread or process of its own. In 'threadpool' and
+        'processpool' mode, jobs are passed to a pool of long-lived
+        workers instead; the pool holds max_threads workers.
+        In 'hybrid' mode, the pool holds worker processes that run
+        threads_per_process threads each, so that max_threads jobs are
+        spread over max_threads / threads_per_process processes.
+        For I/O-bound jobs, a small stack_size lets a 'threadpool' queue
+        run many thousands of concurrent workers.
+        In 'async' mode, jobs whose function is a generator function run
+        as coroutines in a single thread (see L{Exscript.util.coroutine}),
+        so max_threads only limits the number of jobs that are in
+        progress. Blocking calls, and jobs whose function is not a
+        generator function, are passed to blocking_threads threads.
 
         @type  debug: int
         @param debug: The debug level.
         @type  max_threads: int
         @param max_threads: The maximum number of concurrent threads.
-        """
+        @type  mode: str
+        @param mode: 'threading', 'multiprocessing', 'threadpool',
+            'processpool', 'hybrid' or 'async'.
+        @type  stack_size: int
+        @param stack_size: The stack size of the worker threads in bytes
+            in 'threadpool', 'hybrid' and 'async' mode, or None for the
+            system default. Other modes raise a TypeError if it is given.
+        @type  threads_per_process: int
+        @param threads_per_process: The number of threads of each worker
+            process in 'hybrid' mode.
+        @type  blocking_threads: int
+        @param blocking_threads: The number of threads for blocking calls
+            in 'async' mode.
+        """
+        if stack_size is not None \
+           and mode not in ('threadpool', 'hybrid', 'async'):
+            msg = 'stack_size is not supported in %s mode' % mode
+            raise TypeError(msg)
+        self.mode    = mode
+        self.job_cls = None
+        self.pool    = None
+        self.reactor = Reactor()
         if mode == 'threading':
             self.job_cls = Thread
         elif mode == 'multiprocessing':
             self.job_cls = Process
+        elif mode == 'threadpool':
+            self.pool = WorkerPool('threading',
+                                   max_threads,
+                                   stack_size = stack_size)
+        elif mode == 'processpool':
+            self.pool = WorkerPool('multiprocessing',
+                                   max_threads,
+                                   self.reactor)
+        elif mode == 'hybrid':
+            self.pool = WorkerPool('hybrid',
+                                   max_threads,
+                                   self.reactor,
+                                   stack_size = stack_size,
+                                   threads    = threads_per_process)
+        elif mode == 'async':
+            self.pool = CoroutinePool(self.reactor,
+                                      max_threads,
+                                      blocking_threads,
+                                      stack_size)
         else:
             raise TypeError('invalid "mode" argument: ' + repr(mode))
+        self.reactor.start()
         if collection is None:
             self.collection = Pipeline(max_threads)
         else:
@@ -52,12 +114,19 @@ class WorkQueue(object):
         self.job_succeeded_event = Event()
         self.job_aborted_event   = Event()
         self.queue_empty_event   = Event()
+        self.worker_init_event   = Event()
         self.debug               = debug
         self.main_loop           = None
+        self.autotuner           = None
+        if self.pool is not None:
+            self.pool.worker_init_event.listen(self.worker_init_event)
         self._init()
 
     def _init(self):
-        self.main_loop       = MainLoop(self.collection, self.job_cls)
+        self.main_loop       = MainLoop(self.collection,
+                                        self.job_cls,
+                                        self.pool,
+                                        self.reactor)
         self.main_loop.debug = self.debug
         self.main_loop.job_init_event.listen(self.job_init_event)
         self.main_loop.job_started_event.listen(self.job_started_event)
@@ -103,13 +172,142 @@ class WorkQueue(object):
             raise TypeError('max_threads must not be None.')
         self._check_if_ready()
         self.collection.set_max_working(max_threads)
+        if self.pool is not None:
+            self.pool.set_size(max_threads)
+
+    def enable_autotune(self, min_threads, max_threads):
+        """
+        Adjusts the maximum number of concurrent threads at runtime,
+        depending on how many jobs succeed, and on how many fail with
+        a timeout (see L{Autotuner}).
+
+        @type  min_threads: int
+        @param min_threads: The lowest number of threads.
+        @type  max_threads: int
+        @param max_threads: The highest number of threads.
+        """
+        self._check_if_ready()
+        self.disable_autotune()
+        self.autotuner = Autotuner(self, min_threads, max_threads)
+
+    def disable_autotune(self):
+        """
+        Stops adjusting the maximum number of threads; the current
+        number of threads is kept.
+        """
+        if self.autotuner is None:
+            return
+        self.autotuner.stop()
+        self.autotuner = None
+
+    def set_group_function(self, function):
+        """
+        Defines the concurrency groups of the jobs that are enqueued
+        later. The given function is called with a Job, and returns a
+        list of the names of the groups the job belongs to.
+
+        @type  function: callable
+        @param function: Returns the groups of a job.
+        """
+        self._check_if_ready()
+        self.collection.set_group_function(function)
+
+    def set_group_limit(self, group, limit):
+        """
+        Set the maximum number of jobs of the given group that are running
+        at the same time, regardless of max_threads.
+
+        @type  group: object
+        @param group: The name of the group.
+        @type  limit: int
+        @param limit: The maximum number of jobs, or None for no limit.
+        """
+        self._check_if_ready()
+        self.collection.set_group_limit(group, limit)
 
-    def enqueue(self, function, name = None, times = 1, data = None):
+    def set_flow_function(self, function):
+        """
+        Defines the flows of the jobs that are enqueued later. The given
+        function is called with a Job, and returns the flow that the job
+        belongs to, e.g. the order that created it. Queued jobs of
+        different flows are started in a weighted round-robin fashion,
+        so that a flow with few jobs is not stuck behind a large one.
+        See L{Pipeline.set_flow_function()}.
+
+        @type  function: callable
+        @param function: Returns the flow of a job.
+        """
+        self._check_if_ready()
+        self.collection.set_flow_function(function)
+
+    def set_flow_weight(self, flow, weight):
+        """
+        Defines the share of the given flow, relative to other flows.
+        The default weight of a flow is 1.
+
+        @type  flow: object
+        @param flow: The flow, as returned by the flow function.
+        @type  weight: float
+        @param weight: The weight, or None to restore the default.
+        """
+        self._check_if_ready()
+        self.collection.set_flow_weight(flow, weight)
+
+    def set_reserve_function(self, function):
+        """
+        Defines a function that reserves the resources of a job before
+        it is started. The function is called with the Job, and returns
+        None if the job may start, or the resource that the job waits
+        for; the job then does not occupy a thread until unblock() is
+        called with that resource.
+        See L{Pipeline.set_reserve_function()}.
+
+        @type  function: callable
+        @param function: Called with a Job, returns None or a resource.
+        """
+        self._check_if_ready()
+        self.collection.set_reserve_function(function)
+
+    def unblock(self, resource, max_jobs = None):
+        """
+        Lets the jobs that wait for the given resource try again.
+
+        @type  resource: object
+        @param resource: The resource, as returned by the reserve function.
+        @type  max_jobs: int
+        @param max_jobs: The maximum number of jobs, or None for all.
+        @rtype:  int
+        @return: The number of jobs that still wait for the resource.
+        """
+        self._check_if_ready()
+        return self.collection.unblock(resource, max_jobs)
+
+    def enqueue(self,
+                function,
+                name        = None,
+                times       = 1,
+                data        = None,
+                priority    = 0,
+                retry_delay = None,
+                deadline    = None):
         """
         Appends a function to the queue for execution. The times argument
         specifies the number of attempts if the function raises an exception.
         If the name argument is None it defaults to whatever id(function)
         returns.
+        Functions with a higher priority are started first; functions with
+        a lower priority age, so that they are not starved (see L{Pipeline}).
+        By default, a failed job is retried immediately. If a retry_delay
+        is given, the job is queued again after that many seconds instead,
+        and does not occupy a thread while it waits; see
+        L{Job.get_retry_delay()}.
+        If an attempt takes longer than the given deadline, the job is
+        cancelled, and it is reported through the job_error_event with a
+        L{JobTimeoutException}. A process is terminated, and its slot is
+        released immediately. A thread can not be killed, so its
+        cancel_event is sent instead (see L{Job.Thread.cancel()}); the
+        job keeps its slot until the thread has returned, so that no
+        more than max_threads threads ever run at the same time.
 
         @type  function: callable
         @param function: The function that is executed.
@@ -119,13 +317,67 @@ class WorkQueue(object):
         @param times: The maximum number of attempts.
         @type  data: object
         @param data: Optional data to store in Job.data.
+        @type  priority: int
+        @param priority: The priority of the job.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  int
         @return: The id of the new job.
         """
         self._check_if_ready()
-        return self.main_loop.enqueue(function, name, times, data)
+        return self.main_loop.enqueue(function,
+                                      name,
+                                      times,
+                                      data,
+                                      priority,
+                                      retry_delay,
+                                      deadline)
+
+    def enqueue_many(self,
+                     function,
+                     jobs,
+                     times       = 1,
+                     priority    = 0,
+                     retry_delay = None,
+                     deadline    = None):
+        """
+        Like enqueue(), but appends one job per (name, data) tuple in
+        the given list. The whole batch is added at once, so this is a
+        lot cheaper than calling enqueue() for each job.
 
-    def enqueue_or_ignore(self, function, name = None, times = 1, data = None):
+        @type  function: callable
+        @param function: The function that is executed.
+        @type  jobs: list[(str, object)]
+        @param jobs: A list of (name, data) tuples, one per job.
+        @type  times: int
+        @param times: The maximum number of attempts.
+        @type  priority: int
+        @param priority: The priority of the jobs.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
+        @rtype:  list[int]
+        @return: The ids of the new jobs.
+        """
+        self._check_if_ready()
+        return self.main_loop.enqueue_many(function,
+                                           jobs,
+                                           times,
+                                           priority,
+                                           retry_delay,
+                                           deadline)
+
+    def enqueue_or_ignore(self,
+                          function,
+                          name        = None,
+                          times       = 1,
+                          data        = None,
+                          priority    = 0,
+                          retry_delay = None,
+                          deadline    = None):
         """
         Like enqueue(), but does nothing if a function with the same name
         is already in the queue.
@@ -139,18 +391,112 @@ class WorkQueue(object):
         @param times: The maximum number of attempts.
         @type  data: object
         @param data: Optional data to store in Job.data.
+        @type  priority: int
+        @param priority: The priority of the job.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  int or None
         @return: The id of the new job.
         """
         self._check_if_ready()
-        return self.main_loop.enqueue_or_ignore(function, name, times, data)
+        return self.main_loop.enqueue_or_ignore(function,
+                                                name,
+                                                times,
+                                                data,
+                                                priority,
+                                                retry_delay,
+                                                deadline)
+
+    def enqueue_many_or_ignore(self,
+                               function,
+                               jobs,
+                               times       = 1,
+                               priority    = 0,
+                               retry_delay = None,
+                               deadline    = None):
+        """
+        Like enqueue_many(), but ignores any job whose name is already
+        in the queue.
+        Returns a list that contains a job id for every job that was
+        added, and None for every job that was ignored.
+
+        @type  function: callable
+        @param function: The function that is executed.
+        @type  jobs: list[(str, object)]
+        @param jobs: A list of (name, data) tuples, one per job.
+        @type  times: int
+        @param times: The maximum number of attempts.
+        @type  priority: int
+        @param priority: The priority of the jobs.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
+        @rtype:  list[int or None]
+        @return: The ids of the new jobs.
+        """
+        self._check_if_ready()
+        return self.main_loop.enqueue_many_or_ignore(function,
+                                                     jobs,
+                                                     times,
+                                                     priority,
+                                                     retry_delay,
+                                                     deadline)
+
+    def enqueue_many_or_merge(self,
+                              function,
+                              jobs,
+                              merge,
+                              times       = 1,
+                              priority    = 0,
+                              retry_delay = None,
+                              deadline    = None):
+        """
+        Like enqueue_many(), but for every job whose name is already in
+        the queue, merge is called with the existing job and the given
+        function. If the existing job was not started yet, and merge
+        returns True, no new job is added; merge is expected to have
+        changed the existing job such that it does the work of both.
+        Otherwise, a new job is added, even if its name is already taken.
+        Returns a list that contains one job id for every (name, data)
+        tuple, which is the id of the existing job if it was merged.
+
+        @type  function: callable
+        @param function: The function that is executed.
+        @type  jobs: list[(str, object)]
+        @param jobs: A list of (name, data) tuples, one per job.
+        @type  merge: callable
+        @param merge: Called as merge(job, function) to merge a job.
+        @type  times: int
+        @param times: The maximum number of attempts.
+        @type  priority: int
+        @param priority: The priority of the jobs.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
+        @rtype:  list[int]
+        @return: The ids of the new or merged jobs.
+        """
+        self._check_if_ready()
+        return self.main_loop.enqueue_many_or_merge(function,
+                                                    jobs,
+                                                    merge,
+                                                    times,
+                                                    priority,
+                                                    retry_delay,
+                                                    deadline)
 
     def priority_enqueue(self,
                          function,
                          name        = None,
                          force_start = False,
                          times       = 1,
-                         data        = None):
+                         data        = None,
+                         retry_delay = None,
+                         deadline    = None):
         """
         Like L{enqueue()}, but adds the given function at the top of the
         queue.
@@ -167,6 +513,10 @@ class WorkQueue(object):
         @param times: The maximum number of attempts.
         @type  data: object
         @param data: Optional data to store in Job.data.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  int
         @return: The id of the new job.
         """
@@ -175,14 +525,51 @@ class WorkQueue(object):
                                                name,
                                                force_start,
                                                times,
-                                               data)
+                                               data,
+                                               retry_delay,
+                                               deadline)
+
+    def priority_enqueue_many(self,
+                              function,
+                              jobs,
+                              force_start = False,
+                              times       = 1,
+                              retry_delay = None,
+                              deadline    = None):
+        """
+        Like enqueue_many(), but calls priority_enqueue() for each job.
+
+        @type  function: callable
+        @param function: The function that is executed.
+        @type  jobs: list[(str, object)]
+        @param jobs: A list of (name, data) tuples, one per job.
+        @type  force_start: bool
+        @param force_start: Whether to start execution immediately.
+        @type  times: int
+        @param times: The maximum number of attempts.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
+        @rtype:  list[int]
+        @return: The ids of the new jobs.
+        """
+        self._check_if_ready()
+        return self.main_loop.priority_enqueue_many(function,
+                                                    jobs,
+                                                    force_start,
+                                                    times,
+                                                    retry_delay,
+                                                    deadline)
 
     def priority_enqueue_or_raise(self,
                                   function,
                                   name        = None,
                                   force_start = False,
                                   times       = 1,
-                                  data        = None):
+                                  data        = None,
+                                  retry_delay = None,
+                                  deadline    = None):
         """
         Like priority_enqueue(), but if a function with the same name is
         already in the queue, the existing function is moved to the top of
@@ -197,6 +584,10 @@ class WorkQueue(object):
         @param times: The maximum number of attempts.
         @type  data: object
         @param data: Optional data to store in Job.data.
+        @type  retry_delay: float|callable
+        @param retry_delay: The delay before a failed job is retried.
+        @type  deadline: float
+        @param deadline: The maximum number of seconds per attempt.
         @rtype:  int or None
         @return: The id of the new job.
         """
@@ -205,7 +596,32 @@ class WorkQueue(object):
                                                         name,
                                                         force_start,
                                                         times,
-                                                        data)
+                                                        data,
+                                                        retry_delay,
+                                                        deadline)
+
+    def recover(self, load = None):
+        """
+        Restores the jobs that a persistent collection, such as
+        L{Exscript.workqueue.DBPipeline.DBPipeline}, kept from an earlier
+        run, e.g. before the process was restarted. The jobs keep their
+        ids. Jobs that were started before are started again.
+
+        @type  load: callable
+        @param load: Rebuilds a job from what the dump function of the
+            collection has stored; see
+            L{Exscript.workqueue.DBPipeline.DBPipeline.recover()}.
+        @rtype:  list[int]
+        @return: The ids of the restored jobs.
+        """
+        self._check_if_ready()
+        def restore(collection):
+            ids = []
+            for job_id, job in collection.recover(load):
+                job.id = job_id
+                ids.append(job_id)
+            return ids
+        return self.collection.with_lock(restore)
 
     def unpause(self):
         """
@@ -263,6 +679,11 @@ class WorkQueue(object):
         if restart:
             self.collection.start()
             self._init()
+        else:
+            self.disable_autotune()
+            if self.pool is not None:
+                self.pool.stop()
+            self.reactor.stop()
 
     def destroy(self):
         """
@@ -274,6 +695,10 @@ class WorkQueue(object):
         self.main_loop.join()
         self.main_loop = None
         self.collection.clear()
+        self.disable_autotune()
+        if self.pool is not None:
+            self.pool.stop(False)
+        self.reactor.stop()
 
     def is_paused(self):
         """
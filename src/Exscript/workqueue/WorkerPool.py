@@ -0,0 +1,459 @@
+# Copyright (C) 2007-2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+A pool of long-lived threads or processes that execute jobs.
+"""
+import threading
+import multiprocessing
+from cPickle import PicklingError
+from functools import partial
+from collections import deque
+from multiprocessing import Pipe
+from Exscript.util.event import Event
+from Exscript.util.impl import serializeable_sys_exc_info
+
+# threading.stack_size() is process-wide, so it must not be changed by
+# two pools at the same time.
+_stack_size_lock = threading.Lock()
+
+def _start_thread(thread, stack_size):
+    if stack_size is None:
+        thread.start()
+        return
+    with _stack_size_lock:
+        old_size = threading.stack_size(stack_size)
+        try:
+            thread.start()
+        finally:
+            threading.stack_size(old_size)
+
+class _LocalPipe(object):
+    """
+    Stands in for a multiprocessing.Pipe() when the worker lives in the
+    parent process, so that job descriptors do not need to be pickled.
+    The parent puts descriptors into the inbox, and results that the
+    worker sends are passed to the callback directly.
+    """
+    def __init__(self, callback):
+        self.cond     = threading.Condition(threading.Lock())
+        self.inbox    = deque()
+        self.callback = callback
+
+    def put(self, descriptor):
+        with self.cond:
+            self.inbox.append(descriptor)
+            self.cond.notify()
+
+    def recv(self):
+        with self.cond:
+            while not self.inbox:
+                self.cond.wait()
+            return self.inbox.popleft()
+
+    def send(self, result):
+        self.callback(result)
+
+def _make_worker_class(base, clsname):
+    class worker_cls(base):
+        def __init__(self, pipe):
+            base.__init__(self)
+            self.daemon       = True
+            self.pipe         = pipe
+            self.context      = {}
+            self.id           = None
+            self.function     = None
+            self.failures     = 0
+            self.data         = None
+            self.cancel_event = Event()
+
+        def _run_job(self, descriptor):
+            self.id, self.function, name, self.failures, data = descriptor
+            self.name = name
+            if self.context and (data is None or isinstance(data, dict)):
+                context = self.context.copy()
+                context.update(data or {})
+                data = context
+            self.data = data
+            try:
+                return None, self.function(self)
+            except:
+                return serializeable_sys_exc_info(), None
+
+        def run(self):
+            """
+            Executes jobs until None is received, or the pipe is closed.
+            """
+            while True:
+                try:
+                    descriptor = self.pipe.recv()
+                except (EOFError, IOError):
+                    break
+                if descriptor is None:
+                    break
+                result        = self._run_job(descriptor)
+                self.function = None
+                self.data     = None
+                self.cancel_event.disconnect_all()
+                if not isinstance(self, multiprocessing.Process):
+                    self.pipe.send(result)
+                    continue
+                try:
+                    self.pipe.send(result)
+                except (PicklingError, TypeError):
+                    # The return value of the function can not be pickled.
+                    self.pipe.send((serializeable_sys_exc_info(), None))
+
+        def cancel(self):
+            """
+            Asks the running job to stop; see L{Job.Thread.cancel()}.
+            A worker process is terminated.
+
+            @rtype:  bool
+            @return: True if the job was stopped.
+            """
+            if isinstance(self, multiprocessing.Process):
+                self.terminate()
+                return True
+            self.cancel_event()
+            return False
+    worker_cls.__name__ = clsname
+    return worker_cls
+
+ThreadWorker = _make_worker_class(threading.Thread, 'ThreadWorker')
+ProcessWorker = _make_worker_class(multiprocessing.Process, 'ProcessWorker')
+
+class HybridWorker(multiprocessing.Process):
+    """
+    A worker process that executes up to the given number of jobs at the
+    same time, using a ThreadWorker for each of them. Results are sent
+    to the parent as (job id, result) tuples.
+    """
+    def __init__(self, pipe, threads, stack_size = None):
+        multiprocessing.Process.__init__(self)
+        self.daemon     = True
+        self.pipe       = pipe
+        self.stack_size = stack_size
+        self.lock       = threading.Lock()
+        self.inbox      = _LocalPipe(self._send_result)
+        self.threads    = [ThreadWorker(self.inbox) for n in range(threads)]
+
+    def _send_result(self, result):
+        # Called by the threads, which all share the pipe to the parent.
+        thread = threading.current_thread()
+        key    = thread.id, thread.failures
+        with self.lock:
+            try:
+                self.pipe.send((key, result))
+            except (PicklingError, TypeError):
+                # The return value of the function can not be pickled.
+                exc_info = serializeable_sys_exc_info()
+                self.pipe.send((key, (exc_info, None)))
+
+    def _cancel(self, key):
+        for thread in self.threads:
+            if thread.function is not None \
+              and (thread.id, thread.failures) == key:
+                thread.cancel()
+
+    def run(self):
+        """
+        Passes jobs to the threads until None is received, or the pipe
+        is closed. Messages are ('run', descriptor) tuples, which start a
+        job, or ('cancel', (job_id, failures)) tuples, which cancel the
+        given attempt of a job.
+        """
+        # The process is not shared with any other threads, so the
+        # stack size may be changed for good.
+        if self.stack_size is not None:
+            threading.stack_size(self.stack_size)
+        for thread in self.threads:
+            thread.start()
+        while True:
+            try:
+                message = self.pipe.recv()
+            except (EOFError, IOError):
+                break
+            if message is None:
+                break
+            command, arg = message
+            if command == 'cancel':
+                self._cancel(arg)
+            else:
+                self.inbox.put(arg)
+        for thread in self.threads:
+            self.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class WorkerPool(object):
+    """
+    Executes jobs in a set of long-lived threads or processes, instead of
+    starting a new thread or process for every job.
+    Jobs are passed to the workers as (id, function, name, failures, data)
+    descriptors; in multiprocessing and hybrid mode, the descriptor is
+    pickled, so the function and the data must be picklable.
+
+    In hybrid mode, every worker is a process that runs a number of
+    threads, so that CPU-bound work is spread over all cores while most
+    of the jobs are executed at the cost of a thread.
+
+    The following events are provided:
+
+      - worker_init_event: A new worker is about to be started. Listeners
+      may fill the worker's context dictionary; the context is added to the
+      data of every job that the worker executes. In hybrid mode, the
+      event is sent for every thread of the new process.
+    """
+    def __init__(self,
+                 mode       = 'threading',
+                 size       = 1,
+                 reactor    = None,
+                 stack_size = None,
+                 threads    = 1):
+        """
+        Constructor.
+
+        @type  mode: str
+        @param mode: 'threading', 'multiprocessing' or 'hybrid'
+        @type  size: int
+        @param size: The number of workers to keep. In hybrid mode, the
+            number of threads; the pool keeps enough processes to hold
+            them.
+        @type  reactor: Reactor
+        @param reactor: Receives the results of worker processes; required
+            in multiprocessing and hybrid mode.
+        @type  stack_size: int
+        @param stack_size: The stack size of worker threads in bytes, or
+            None for the system default. Not supported in multiprocessing
+            mode.
+        @type  threads: int
+        @param threads: The number of threads per process in hybrid mode.
+        """
+        if mode == 'threading':
+            self.worker_cls = ThreadWorker
+        elif mode == 'multiprocessing':
+            self.worker_cls = ProcessWorker
+        elif mode == 'hybrid':
+            self.worker_cls = HybridWorker
+        else:
+            raise TypeError('invalid "mode" argument: ' + repr(mode))
+        if mode != 'threading' and reactor is None:
+            raise TypeError('%s mode requires a reactor' % mode)
+        if mode == 'multiprocessing' and stack_size is not None:
+            raise TypeError('stack_size is not supported in %s mode' % mode)
+        self.reactor           = reactor
+        self.stack_size        = stack_size
+        self.worker_init_event = Event()
+        self.mode              = mode
+        self.size              = int(size)
+        self.threads           = mode == 'hybrid' and int(threads) or 1
+        self.lock              = threading.Lock()
+        self.workers           = {} # Maps a worker to the parent pipe end.
+        self.idle              = [] # Contains a worker once per free slot.
+        self.running           = {} # Maps a worker to running jobs by
+                                    # (job id, failures).
+
+    def _get_max_workers(self):
+        # The number of workers that is needed to run size jobs at once.
+        return (self.size + self.threads - 1) // self.threads
+
+    def _spawn(self):
+        if self.mode == 'threading':
+            pipe   = _LocalPipe(None)
+            worker = self.worker_cls(pipe)
+            pipe.callback = lambda r: self._on_result(worker, r)
+            self.workers[worker] = pipe.put
+        elif self.mode == 'multiprocessing':
+            to_worker, to_self = Pipe()
+            worker = self.worker_cls(to_self)
+            self.workers[worker] = to_worker.send
+        else:
+            to_worker, to_self = Pipe()
+            worker = self.worker_cls(to_self, self.threads, self.stack_size)
+            self.workers[worker] = to_worker.send
+        threads = getattr(worker, 'threads', [worker])
+        for thread in threads:
+            self.worker_init_event(thread)
+        if self.mode == 'threading':
+            _start_thread(worker, self.stack_size)
+        else:
+            worker.start()
+
+        if self.mode != 'threading':
+            # The parent must not keep the worker's resources open, or
+            # the other ends would never notice that the worker is gone.
+            to_self.close()
+            for thread in threads:
+                thread.context = {}
+            self.reactor.add(to_worker, partial(self._on_result, worker))
+        self.running[worker] = {}
+        self.idle.extend([worker] * self.threads)
+        return worker
+
+    def _retire(self, worker):
+        send      = self.workers.pop(worker)
+        self.idle = [w for w in self.idle if w is not worker]
+        if not self.running.get(worker):
+            self.running.pop(worker, None)
+        send(None)
+
+    def _shrink(self):
+        # Stops workers that have no running jobs while there are more
+        # workers than needed.
+        for worker in self.workers.keys():
+            if len(self.workers) <= self._get_max_workers():
+                break
+            if not self.running[worker]:
+                self._retire(worker)
+
+    def _on_result(self, worker, message):
+        with self.lock:
+            jobs = self.running.get(worker)
+            if jobs is None:
+                # The worker was retired, or it died while idle.
+                self.workers.pop(worker, None)
+                return
+            if message is None:
+                # The worker process died while executing jobs.
+                self.running.pop(worker)
+                self.workers.pop(worker, None)
+                self.idle = [w for w in self.idle if w is not worker]
+                done = [(job, on_complete, None)
+                        for job, on_complete in jobs.itervalues()]
+            else:
+                if self.mode == 'hybrid':
+                    key, result = message
+                else:
+                    key, result = jobs.keys()[0], message
+                job, on_complete = jobs.pop(key)
+                done = [(job, on_complete, result)]
+                if worker in self.workers:
+                    self.idle.append(worker)
+                    self._shrink()
+                elif not jobs:
+                    # The pool was stopped in the meantime.
+                    self.running.pop(worker)
+
+        for job, on_complete, result in done:
+            if result is None:
+                try:
+                    raise Exception('worker for job %s died' % repr(job.name))
+                except Exception:
+                    result = serializeable_sys_exc_info(), None
+            exc_info, job.result = result
+            on_complete(job, exc_info)
+
+    def start(self, job, on_complete):
+        """
+        Passes the given job to an idle worker. If no idle worker is
+        available, the pool is filled up to its size; if it is already
+        full, one additional worker is started.
+        When the job is completed, on_complete is called with the job and
+        the exception info, or None on success. The return value of the
+        function is stored in job.result.
+
+        @type  job: Job
+        @param job: The job that is executed.
+        @type  on_complete: callable
+        @param on_complete: Called when the job is completed.
+        """
+        with self.lock:
+            if not self.idle:
+                missing = self._get_max_workers() - len(self.workers)
+                for n in range(max(1, missing)):
+                    self._spawn()
+            worker = self.idle.pop()
+            key    = job.id, job.failures
+            self.running[worker][key] = job, on_complete
+            send = self.workers[worker]
+
+        job.child  = job
+        descriptor = job.id, job.func, job.name, job.failures, job.data
+        if self.mode == 'hybrid':
+            descriptor = 'run', descriptor
+        try:
+            send(descriptor)
+        except Exception:
+            exc_info = serializeable_sys_exc_info()
+            with self.lock:
+                self.running[worker].pop(key)
+                self.idle.append(worker)
+            on_complete(job, exc_info)
+
+    def cancel(self, job):
+        """
+        Asks the worker that executes the given job to stop it. Worker
+        threads are sent their cancel_event, worker processes are
+        terminated. Does nothing if the job is not running.
+
+        @type  job: Job
+        @param job: The job that is cancelled.
+        @rtype:  bool
+        @return: False if the job was only asked to stop, and is still
+            running.
+        """
+        key = job.id, job.failures
+        with self.lock:
+            for worker, jobs in self.running.iteritems():
+                if jobs.get(key, (None,))[0] is job:
+                    send = self.workers.get(worker)
+                    break
+            else:
+                return True
+
+        # Cancelling calls the listeners of the job, which must not be
+        # done with the pool locked.
+        if self.mode != 'hybrid':
+            return worker.cancel()
+        if send is not None:
+            send(('cancel', key))
+        return False
+
+    def set_size(self, size):
+        """
+        Changes the number of workers that are kept. Surplus workers are
+        stopped as soon as they are idle.
+
+        @type  size: int
+        @param size: The number of workers.
+        """
+        with self.lock:
+            self.size = int(size)
+            self._shrink()
+
+    def get_size(self):
+        """
+        Returns the number of workers that are kept.
+
+        @rtype:  int
+        @return: The number of workers.
+        """
+        return self.size
+
+    def stop(self, join = True):
+        """
+        Stops all workers. Jobs that are currently running are completed
+        first.
+
+        @type  join: bool
+        @param join: Whether to wait until all workers have terminated.
+        """
+        with self.lock:
+            workers = self.workers.keys()
+            for worker in workers:
+                self._retire(worker)
+        if join:
+            for worker in workers:
+                worker.join()
@@ -15,6 +15,8 @@
 from Exscript.workqueue.WorkQueue import WorkQueue
 from Exscript.workqueue.Task import Task
 from Exscript.workqueue.Pipeline import Pipeline
+from Exscript.workqueue.Exception import WorkQueueException, \
+                                        JobTimeoutException
 
 import inspect 
 __all__ = [name for name, obj in locals().items()
@@ -21,6 +21,7 @@ from functools import partial
 from lxml import etree
 from Exscript import Queue
 from Exscript.AccountPool import AccountPool
+from Exscript.workqueue.DBPipeline import DBPipeline
 from Exscript.util.file import get_accounts_from_file
 from Exscriptd.OrderDB import OrderDB
 from Exscriptd.HTTPDaemon import HTTPDaemon
@@ -67,10 +68,20 @@ class Config(ConfigReader):
 
     @cache_result
     def _init_queue_from_name(self, name):
-        # Create the queue first.
+        # Create the queue first. Queues that name a database keep their
+        # jobs in it, so that they survive a restart.
         element     = self.cfgtree.find('queue[@name="%s"]' % name)
         max_threads = element.find('max-threads').text
-        queue       = Queue(verbose = 0, max_threads = max_threads)
+        db_elem     = element.find('database')
+        collection  = None
+        if db_elem is not None:
+            engine     = self.get_database_from_name(db_elem.text)
+            collection = DBPipeline(engine)
+            collection.set_table_prefix('exscriptd_queue_%s_' % name)
+            collection.install()
+        queue       = Queue(verbose     = 0,
+                            max_threads = max_threads,
+                            collection  = collection)
 
         # Assign account pools to the queue.
         def match_cb(condition, host):
@@ -118,6 +129,20 @@ class Config(ConfigReader):
         return dict((name, self._init_queue_from_name(name))
                     for name in names)
 
+    def get_service_weights(self):
+        """
+        Returns the weights of the services in each queue, as a dict that
+        maps queue names to a dict that maps service names to weights.
+        Services that are not listed in a queue have the weight 1.
+        """
+        weights = {}
+        for queue_elem in self.cfgtree.iterfind('queue'):
+            queue_weights = {}
+            for elem in queue_elem.iterfind('service-weight'):
+                queue_weights[elem.get('service')] = float(elem.text)
+            weights[queue_elem.get('name')] = queue_weights
+        return weights
+
     def _init_database_from_dbn(self, dbn):
         from sqlalchemy import create_engine
         from sqlalchemy.pool import NullPool
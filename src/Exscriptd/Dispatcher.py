@@ -16,7 +16,7 @@ import os
 import logging
 from functools import partial
 from collections import defaultdict
-from threading import Thread, Lock
+from threading import Thread, Lock, local
 from Exscriptd.util import synchronized
 from Exscriptd import Task
 
@@ -31,7 +31,7 @@ class _AsyncFunction(Thread):
         self.function(*self.args, **self.kwargs)
 
 class Dispatcher(object):
-    def __init__(self, order_db, queues, logger, logdir):
+    def __init__(self, order_db, queues, logger, logdir, weights = None):
         self.order_db = order_db
         self.queues   = {}
         self.logger   = logger
@@ -40,8 +40,8 @@ class Dispatcher(object):
         self.lock     = Lock()
         self.services = {}
         self.daemons  = {}
-        self.logger.info('Closing all open orders.')
-        self.order_db.close_open_orders()
+        self.weights  = weights or {} # map queue names to service weights
+        self.entering = local()       # the order that is being entered
 
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
@@ -53,7 +53,9 @@ class Dispatcher(object):
 
     def add_queue(self, name, queue):
         self.queues[name] = queue
+        queue.set_dump_function(self._get_job_reference)
         wq = queue.workqueue
+        wq.set_flow_function(self._get_flow)
         wq.job_init_event.connect(partial(self._on_job_event, name, 'init'))
         wq.job_started_event.connect(partial(self._on_job_event,
                                              name,
@@ -68,6 +70,72 @@ class Dispatcher(object):
                                              name,
                                              'aborted'))
 
+    def _get_flow(self, job):
+        # Jobs that a service enqueues while it enters an order share the
+        # order's flow, so that orders are processed in a round-robin
+        # fashion. Jobs that are enqueued by other threads, such as the
+        # feeders of a lazy host list, share one flow.
+        return getattr(self.entering, 'order_id', None)
+
+    def _get_job_reference(self, host):
+        # Jobs of a persistent queue are stored as the service and the
+        # order that enqueued them, so that the service can provide the
+        # function again after a restart; see recover().
+        order_id = getattr(self.entering, 'order_id', None)
+        if order_id is None:
+            return None
+        return self.entering.service_name, order_id
+
+    def _get_recovered_function(self, functions, reference, host):
+        # Returns the function for a job that was restored from a
+        # persistent queue. The function is requested once per order.
+        if reference is None:
+            return None
+        if reference not in functions:
+            service_name, order_id = reference
+            service  = self.services.get(service_name)
+            order    = self.order_db.get_order(id = order_id)
+            function = None
+            if service is not None \
+              and order is not None \
+              and order.get_closed_timestamp() is None:
+                function = service.recover(order)
+            functions[reference] = function
+        return functions[reference]
+
+    def recover(self):
+        """
+        Restores the jobs of queues that keep their jobs in a database,
+        and closes all other open orders. Must be called once all
+        services were added, because the functions of the jobs are
+        requested from the service that entered the order; see
+        L{Exscriptd.Service.Service.recover()}.
+
+        @rtype:  list[int]
+        @return: The ids of the restored jobs.
+        """
+        functions = {}
+        job_ids   = []
+        for name, queue in self.queues.iteritems():
+            if not hasattr(queue.workqueue.collection, 'recover'):
+                continue
+            recovered = partial(self._get_recovered_function, functions)
+            ids       = queue.recover(recovered)
+            job_ids  += ids
+            self.logger.info('%s: %d jobs recovered.' % (name, len(ids)))
+        self.logger.info('Closing all open orders without jobs.')
+        self.order_db.close_open_orders(job_ids)
+        return job_ids
+
+    def _set_flow_weights(self, service, order_id, reset = False):
+        for queue_name, queue in self.queues.iteritems():
+            weight = self.weights.get(queue_name, {}).get(service.name)
+            if weight is None:
+                continue
+            if reset:
+                weight = None
+            queue.workqueue.set_flow_weight(order_id, weight)
+
     def _set_task_status(self, job_id, queue_name, status):
         # Log the status change.
         task = self.order_db.get_task(job_id = job_id)
@@ -233,6 +301,10 @@ class Dispatcher(object):
             for queue in self.queues.itervalues():
                 queue.workqueue.pause()
 
+            # The weight only affects jobs while they are enqueued.
+            self._set_flow_weights(service, order.get_id())
+            self.entering.order_id     = order.get_id()
+            self.entering.service_name = service.name
             try:
                 service.enter(order)
             except Exception, e:
@@ -241,6 +313,9 @@ class Dispatcher(object):
                 self.set_order_status(order, 'error')
                 raise
             finally:
+                self.entering.order_id = None
+                self._set_flow_weights(service, order.get_id(), True)
+
                 # Re-enable the workqueue.
                 for queue in self.queues.itervalues():
                     queue.workqueue.unpause()
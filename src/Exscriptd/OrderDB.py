@@ -424,16 +424,28 @@ class OrderDB(object):
             for order in to_list(orders):
                 self.__add_order(order)
 
-    def close_open_orders(self):
+    def close_open_orders(self, job_ids = None):
         """
         Sets the 'closed' timestamp of all orders that have none, without
-        changing the status field.
-        """
-        closed = datetime.utcnow()
-        tbl_o  = self._table_map['order']
-        tbl_t  = self._table_map['task']
-        query1 = tbl_t.update(tbl_t.c.closed == None)
-        query2 = tbl_o.update(tbl_o.c.closed == None)
+        changing the status field. Tasks of the jobs with the given ids
+        are kept open, and so are the orders that they belong to.
+
+        @type  job_ids: list[str]
+        @param job_ids: The ids of jobs that are still running.
+        """
+        closed  = datetime.utcnow()
+        tbl_o   = self._table_map['order']
+        tbl_t   = self._table_map['task']
+        job_ids = [str(job_id) for job_id in job_ids or ()]
+        where1  = tbl_t.c.closed == None
+        where2  = tbl_o.c.closed == None
+        if job_ids:
+            running = tbl_t.c.job_id.in_(job_ids)
+            orders  = sa.select([tbl_t.c.order_id], running)
+            where1  = sa.and_(where1, sa.not_(running))
+            where2  = sa.and_(where2, sa.not_(tbl_o.c.id.in_(orders)))
+        query1 = tbl_t.update(where1)
+        query2 = tbl_o.update(where2)
         query1.execute(closed = closed)
         query2.execute(closed = closed)
 
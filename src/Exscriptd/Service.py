@@ -55,8 +55,9 @@ class Service(object):
         result = eval(code, self.vars)
         sys.path.pop(0)
 
-        self.check_func = self.vars.get('check')
-        self.enter_func = self.vars.get('enter')
+        self.check_func   = self.vars.get('check')
+        self.enter_func   = self.vars.get('enter')
+        self.recover_func = self.vars.get('recover')
 
         if not self.enter_func:
             msg = filename + ': required function enter() not found.'
@@ -77,5 +78,15 @@ class Service(object):
     def enter(self, order):
         return self.enter_func(order)
 
+    def recover(self, order):
+        """
+        Returns the function that the jobs of the given order are
+        restored with after a restart, or None if the service does not
+        define a recover() function.
+        """
+        if self.recover_func:
+            return self.recover_func(order)
+        return None
+
     def run_function(self, name, *args):
         return self.vars.get(name)(*args)
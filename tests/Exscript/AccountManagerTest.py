@@ -88,6 +88,21 @@ class AccountManagerTest(unittest.TestCase):
         self.assertNotEqual(account, None)
         account.release()
 
+        # Non-blocking acquisition.
+        self.assertEqual(self.am.acquire_account(account3), account3)
+        self.assertEqual(self.am.acquire_account(account3, blocking = False),
+                         None)
+        account3.release()
+
+    def testGetAccountPoolFor(self):
+        self.assertEqual(self.am.get_account_pool_for('myhost'),
+                         self.am.default_pool)
+        pool = AccountPool()
+        self.am.add_pool(pool, lambda host: host == 'myhost')
+        self.assertEqual(self.am.get_account_pool_for('myhost'), pool)
+        self.assertEqual(self.am.get_account_pool_for('other'),
+                         self.am.default_pool)
+
     def testAcquireAccountFor(self):
         self.testAddPool()
 
@@ -101,6 +116,31 @@ class AccountManagerTest(unittest.TestCase):
         self.assertEqual(self.data, {'match-called': True, 'host': 'myhost'})
         self.assertEqual(self.account, account)
 
+        # Non-blocking acquisition.
+        account = self.am.acquire_account_for('myhost')
+        self.assertEqual(self.am.acquire_account_for('myhost',
+                                                     blocking = False), None)
+        account.release()
+
+    def testTransferAccount(self):
+        account1 = Account('foo')
+        pool = AccountPool()
+        pool.add_account(account1)
+        self.am.add_pool(pool, lambda x: None)
+        account2 = Account('bar')
+        self.am.add_account(account2)
+
+        self.am.acquire_account(account1, 'one')
+        self.am.acquire_account(account2, 'one')
+        self.am.transfer_account(account1, 'two')
+        self.am.transfer_account(account2, 'two')
+        self.am.release_accounts('one')
+        self.assert_(account1 not in pool.unlocked_accounts)
+        self.assert_(account2 not in self.am.default_pool.unlocked_accounts)
+        self.am.release_accounts('two')
+        self.assert_(account1 in pool.unlocked_accounts)
+        self.assert_(account2 in self.am.default_pool.unlocked_accounts)
+
     def testReleaseAccounts(self):
         account1 = Account('foo')
         pool = AccountPool()
@@ -123,6 +163,15 @@ class AccountManagerTest(unittest.TestCase):
         self.assert_(account1 in pool.unlocked_accounts)
         self.assert_(account2 in self.am.default_pool.unlocked_accounts)
 
+        # Releases in any of the pools are announced.
+        released = []
+        self.am.account_released_event.connect(released.append)
+        self.am.acquire_account(account2, 'two')
+        pool.acquire_account(account1, 'one')
+        self.am.release_accounts('two')
+        self.am.release_accounts('one')
+        self.assertEqual(released, [account2, account1])
+
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(AccountManagerTest)
 if __name__ == '__main__':
@@ -63,6 +63,15 @@ class AccountPoolTest(unittest.TestCase):
         self.accm.acquire_account(self.account1)
         self.account1.release()
 
+        # Non-blocking acquisition returns None if the account is locked.
+        self.accm.acquire_account(self.account1)
+        self.assertEqual(self.accm.acquire_account(self.account1,
+                                                   blocking = False), None)
+        self.account1.release()
+        account = self.accm.acquire_account(self.account1, blocking = False)
+        self.assertEqual(account, self.account1)
+        self.account1.release()
+
         # Add three more accounts.
         filename = os.path.join(os.path.dirname(__file__), 'account_pool.cfg')
         self.accm.add_account(get_accounts_from_file(filename))
@@ -89,6 +98,33 @@ class AccountPoolTest(unittest.TestCase):
             for account in acquired.itervalues():
                 account.release()
 
+    def testNUnlocked(self):
+        self.assertEqual(self.accm.n_unlocked(), 0)
+        self.accm.add_account(self.account1)
+        self.accm.add_account(self.account2)
+        self.assertEqual(self.accm.n_unlocked(), 2)
+        self.accm.acquire_account(self.account1)
+        self.assertEqual(self.accm.n_unlocked(), 1)
+        self.account1.release()
+        self.assertEqual(self.accm.n_unlocked(), 2)
+
+    def testTransferAccount(self):
+        self.accm.add_account(self.account1)
+        self.accm.add_account(self.account2)
+        self.assertRaises(Exception,
+                          self.accm.transfer_account,
+                          self.account1,
+                          'two')
+        self.accm.acquire_account(self.account1, 'one')
+        self.accm.transfer_account(self.account1, 'two')
+
+        # The account stays locked, and belongs to the new owner.
+        self.assert_(self.account1 not in self.accm.unlocked_accounts)
+        self.accm.release_accounts('one')
+        self.assert_(self.account1 not in self.accm.unlocked_accounts)
+        self.accm.release_accounts('two')
+        self.assert_(self.account1 in self.accm.unlocked_accounts)
+
     def testReleaseAccounts(self):
         account1 = Account('foo')
         account2 = Account('bar')
@@ -110,6 +146,13 @@ class AccountPoolTest(unittest.TestCase):
         self.assert_(account1 in pool.unlocked_accounts)
         self.assert_(account2 in pool.unlocked_accounts)
 
+        # Every release is announced.
+        released = []
+        pool.account_released_event.connect(released.append)
+        pool.acquire_account(account1, 'one')
+        pool.release_accounts('one')
+        self.assertEqual(released, [account1])
+
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(AccountPoolTest)
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
 warnings.simplefilter('ignore', DeprecationWarning)
 
 import shutil
+import threading
 import time
 import ctypes
 from functools import partial
@@ -11,10 +12,11 @@ from tempfile import mkdtemp
 from multiprocessing import Value
 from multiprocessing.managers import BaseManager
 from Exscript import Queue, Account, AccountPool, FileLogger
-from Exscript.protocols import Protocol, Dummy
+from Exscript.protocols import Protocol, Dummy, SessionPool
 from Exscript.interpreter.Exception import FailException
-from Exscript.util.decorator import bind
+from Exscript.util.decorator import bind, autologin
 from Exscript.util.log import log_to
+from Exscript.util.coroutine import Return, sleep
 
 def count_calls(job, data, **kwargs):
     assert hasattr(job, 'start')
@@ -49,6 +51,48 @@ def fatal_error(job, host, conn):
     say_hello(job, host, conn)
     raise Exception('intentional fatal error')
 
+def mark_connection(job, host, conn):
+    conn.marked = True
+
+def count_marked(job, host, conn, data):
+    assert conn.marked
+    data.value += 1
+
+def get_name(job, host, conn):
+    return host.get_name()
+
+def count_and_get_name(job, host, conn, data):
+    with data.get_lock():
+        data.value += 1
+    return host.get_name()
+
+def fail_first_attempt(job, host, conn, data):
+    with data.get_lock():
+        data.value += 1
+    if job.failures == 0:
+        raise FailException('intentional error')
+    return 'retried'
+
+def get_name_async(job, host, conn, data):
+    yield sleep(.1)
+    with data.get_lock():
+        data.value += 1
+    raise Return(host.get_name())
+
+def hang(job, host, conn):
+    # A thread can not be killed, so it holds its slot until it returns.
+    cancelled = threading.Event()
+    job.cancel_event.connect(cancelled.set)
+    cancelled.wait(5)
+
+def count_concurrency(job, host, conn, running, maximum):
+    with running.get_lock():
+        running.value += 1
+        maximum.value  = max(maximum.value, running.value)
+    time.sleep(.1)
+    with running.get_lock():
+        running.value -= 1
+
 class MyProtocol(Dummy):
     pass
 
@@ -179,7 +223,37 @@ class QueueTest(unittest.TestCase):
         pipe.send(('release-account', account.__hash__()))
         response = pipe.recv()
         self.assertEqual(response, 'ok')
+
+        # While the account is locked, a request from a second pipe is
+        # parked without blocking the requests of other pipes.
+        pipe.send(('acquire-account-from-hash', account.__hash__()))
+        self.assertEqual(pipe.recv(), expected)
+        pipe2 = self.queue._create_pipe()
+        pipe2.send(('acquire-account-from-hash', account.__hash__()))
+        self.failIf(pipe2.poll(.2))
+        pipe.send(('log-add', (None, 1, 'name', 1)))
+        self.assertEqual(pipe.recv(), None)
+
+        # Parked requests are indexed by the account they wait for.
+        pipe3 = self.queue._create_pipe()
+        pipe3.send(('acquire-account', None))
+        self.failIf(pipe3.poll(.2))
+        parked = self.queue.broker.parked
+        self.assertEqual(sorted(len(q) for q in parked.itervalues()), [1, 1])
+        self.assertEqual(len(parked[account.__hash__()]), 1)
+        self.assertEqual(len(parked[self.accm.default_pool]), 1)
+
+        # Closing the pipe releases the account. The request that was
+        # parked first gets it.
         pipe.close()
+        self.assert_(pipe2.poll(5))
+        self.assertEqual(pipe2.recv(), expected)
+        self.failIf(pipe3.poll(.2))
+        pipe2.close()
+        self.assert_(pipe3.poll(5))
+        self.assertEqual(pipe3.recv(), expected)
+        pipe3.close()
+        self.queue.join()
 
     def testSetMaxThreads(self):
         self.assertEqual(1, self.queue.get_max_threads())
@@ -245,6 +319,16 @@ class QueueTest(unittest.TestCase):
                                 'start-called': True,
                                 'account-hash': account2.__hash__()})
 
+        # Jobs are not started before an account of their pool is free.
+        running = Value('i', 0)
+        maximum = Value('i', 0)
+        hosts   = ['dummy://dummy1', 'dummy://dummy2', 'dummy://dummy3']
+        self.queue.set_max_threads(5)
+        self.queue.run(hosts, bind(count_concurrency, running, maximum))
+        self.queue.shutdown()
+        self.assertEqual(maximum.value, 1)
+        self.assert_(account2 in pool2.unlocked_accounts)
+
     def startTask(self):
         self.testAddAccount()
         hosts = ['dummy://dummy1', 'dummy://dummy2']
@@ -294,9 +378,162 @@ class QueueTest(unittest.TestCase):
         self.assertEqual(data.value, 3)
 
         self.queue.run('dummy://dummy4', func)
-        self.queue.destroy()
+        self.queue.shutdown()
         self.assertEqual(data.value, 4)
 
+    def testRunGenerator(self):
+        # Hosts may also be pulled from a generator.
+        data  = Value('i', 0)
+        hosts = ('dummy://dummy%d' % n for n in range(10))
+        task  = self.queue.run(hosts, bind(count_calls2, data, testarg = 1))
+        self.queue.shutdown()
+        self.assert_(task.is_completed())
+        self.assertEqual(data.value, 10)
+
+    def testDeadline(self):
+        # Attempts that exceed the deadline are aborted.
+        start = time.time()
+        self.queue.run('dummy://dummy5', hang, deadline = .2)
+        self.queue.shutdown()
+        self.assert_(time.time() - start < 4)
+
+    def testSessionPool(self):
+        # With a session pool, a job takes over the connection that the
+        # last job for the same host left logged in. Connections are not
+        # reused by processes that run a single job.
+        if self.mode == 'multiprocessing':
+            return
+        pool = SessionPool()
+        self.createQueue(verbose = -1, session_pool = pool)
+        self.queue.add_account(Account('user', 'test'))
+        data = Value('i', 0)
+        self.queue.run('dummy://dummy1', autologin()(mark_connection))
+        self.queue.shutdown()
+        self.assertEqual(len(pool), 1)
+        self.queue.run('dummy://dummy1', autologin()(bind(count_marked,
+                                                          data)))
+        self.queue.destroy()
+        self.assertEqual(data.value, 1)
+        self.assertEqual(len(pool), 0)
+
+    def testResults(self):
+        # Return values are collected in the task.
+        task = self.queue.run(['dummy://dummy1', 'dummy://dummy2'], get_name)
+        task.wait()
+        self.assertEqual(sorted(task.results()), [('dummy1', 'dummy1'),
+                                                  ('dummy2', 'dummy2')])
+
+    def testRunAsync(self):
+        # Coroutines are only supported in async mode.
+        data  = Value('i', 0)
+        func  = bind(get_name_async, data)
+        hosts = ['dummy://dummy%d' % n for n in range(50)]
+        if self.mode != 'async':
+            self.assertRaises(TypeError, self.queue.run, hosts, func)
+            return
+
+        # They do not hold a thread while they wait.
+        self.queue.set_max_threads(50)
+        start = time.time()
+        task  = self.queue.run(hosts, log_to(self.logger)(func))
+        task.wait()
+        self.assert_(time.time() - start < 3)
+        self.assertEqual(data.value, 50)
+        self.assertEqual(sorted(task.results()),
+                         sorted((h[8:], h[8:]) for h in hosts))
+        self.assertEqual(self.logger.get_succeeded_actions(), 50)
+
+    def testCoalesce(self):
+        # In coalescing mode, functions for a waiting host share one
+        # connection.
+        if self.mode == 'async':
+            self.assertRaises(TypeError,
+                              self.createQueue,
+                              verbose  = -1,
+                              coalesce = True)
+            return
+        self.createQueue(verbose = -1, coalesce = True)
+        data  = Value('i', 0)
+        hosts = ['dummy://dummy1', 'dummy://dummy2']
+        self.queue.workqueue.pause()
+        task1 = self.queue.run(hosts, mark_connection)
+        task2 = self.queue.run(hosts, bind(count_marked, data))
+        self.assertEqual(self.queue.workqueue.get_length(), 2)
+        self.queue.workqueue.unpause()
+        task2.wait()
+        self.assert_(task1.is_completed())
+        self.assertEqual(data.value, 2)
+        self.queue.shutdown()
+
+        # A retry only calls the functions that failed, and every task
+        # only gets the results of its own functions.
+        calls = Value('i', 0)
+        fails = Value('i', 0)
+        self.queue.workqueue.pause()
+        task1 = self.queue.run(hosts,
+                               bind(fail_first_attempt, fails),
+                               attempts = 2)
+        task2 = self.queue.run(hosts, bind(count_and_get_name, calls))
+        self.queue.workqueue.unpause()
+        task1.wait()
+        task2.wait()
+        self.assertEqual(fails.value, 4)
+        self.assertEqual(calls.value, 2)
+        self.assertEqual(sorted(task1.results()), [('dummy1', 'retried'),
+                                                   ('dummy2', 'retried')])
+        self.assertEqual(sorted(task2.results()), [('dummy1', 'dummy1'),
+                                                   ('dummy2', 'dummy2')])
+        self.queue.shutdown()
+
+        # If the job is aborted, the functions that succeeded still
+        # count, and every error is reported.
+        self.createQueue(verbose = 0, coalesce = True)
+        self.queue.workqueue.pause()
+        task1 = self.queue.run('dummy://dummy1', get_name)
+        task2 = self.queue.run('dummy://dummy1', error)
+        task3 = self.queue.run('dummy://dummy1', fatal_error)
+        self.queue.workqueue.unpause()
+        self.queue.shutdown()
+        self.assertEqual(list(task1.results()), [('dummy1', 'dummy1')])
+        self.assertEqual(list(task2.results()), [])
+        self.assertEqual(list(task3.results()), [])
+        errors = self.err.read()
+        self.assert_('intentional error' in errors, errors)
+        self.assert_('intentional fatal error' in errors, errors)
+
+    def testRecover(self):
+        from tempfile import NamedTemporaryFile
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import NullPool
+        from Exscript.workqueue.DBPipeline import DBPipeline
+        dbfile = NamedTemporaryFile()
+        engine = create_engine('sqlite:///' + dbfile.name,
+                               poolclass = NullPool)
+        DBPipeline(engine).install()
+
+        # Queue two hosts, and stop before they are started.
+        self.createQueue(verbose = -1, collection = DBPipeline(engine))
+        self.queue.set_dump_function(lambda host: 'count')
+        self.queue.workqueue.pause()
+        self.queue.run(['dummy://dummy1', 'dummy://dummy2'], do_nothing)
+        self.queue.destroy(force = True)
+        self.queue = None
+
+        # A new queue on the same database resumes them, using the
+        # function that is returned for the stored reference.
+        data = Value('i', 0)
+        def load(reference, host):
+            self.assertEqual(reference, 'count')
+            return bind(count_calls2, data, testarg = 1)
+        self.createQueue(verbose = -1, collection = DBPipeline(engine))
+        self.assertEqual(len(self.queue.recover(load)), 2)
+        self.queue.shutdown()
+        self.assertEqual(data.value, 2)
+        dbfile.close()
+
+    def testSetDumpFunction(self):
+        self.testRecover()
+
     def testRunOrIgnore(self):
         data  = Value('i', 0)
         hosts = ['dummy://dummy1', 'dummy://dummy2', 'dummy://dummy1']
@@ -342,6 +579,51 @@ class QueueTest(unittest.TestCase):
         self.queue.destroy()
         self.assertEqual(data.value, 3)
 
+    def testEnableAutotune(self):
+        data  = Value('i', 0)
+        hosts = ['dummy://dummy%d' % n for n in range(10)]
+        func  = bind(count_calls2, data, testarg = 1)
+        self.queue.enable_autotune(2, 4)
+        self.assertEqual(self.queue.get_max_threads(), 2)
+        self.queue.run(hosts, func)
+        self.queue.shutdown()
+        self.assertEqual(data.value, 10)
+        self.assertEqual(self.queue.get_max_threads(), 4)
+
+        # The output follows the number of threads that is chosen.
+        self.createQueue(verbose = 1)
+        self.queue.enable_autotune(1, 4)
+        self.assertEqual(self.queue.channel_map['status_bar'],
+                         self.queue.devnull)
+        self.queue.run(hosts, func)
+        self.queue.shutdown()
+        self.assertEqual(self.queue.get_max_threads(), 4)
+        self.assertEqual(self.queue.channel_map['status_bar'], self.out)
+
+        # The time it took to connect was passed to the autotuner.
+        self.assertNotEqual(self.queue.workqueue.autotuner.latency, None)
+
+    def testDisableAutotune(self):
+        self.queue.enable_autotune(2, 4)
+        self.queue.disable_autotune()
+        self.queue.set_max_threads(7)
+        self.assertEqual(self.queue.get_max_threads(), 7)
+
+    def testSetGroupFunction(self):
+        self.testSetGroupLimit()
+
+    def testSetGroupLimit(self):
+        data  = Value('i', 0)
+        hosts = ['dummy://dummy1', 'dummy://dummy2', 'dummy://dummy3']
+        func  = bind(count_calls2, data, testarg = 1)
+        self.queue.set_max_threads(10)
+        self.queue.set_group_function(lambda host: host.get_name()[:-1])
+        self.queue.set_group_limit('dummy', 1)
+        self.queue.run(hosts, func)
+        self.queue.enqueue(bind(count_calls, data, testarg = 1))
+        self.queue.shutdown()
+        self.assertEqual(data.value, 4)
+
     def testForceRun(self):
         data  = Value('i', 0)
         hosts = ['dummy://dummy1', 'dummy://dummy2']
@@ -368,9 +650,16 @@ class QueueTest(unittest.TestCase):
 
         func = bind(count_and_fail, data, testarg = 1)
         self.queue.enqueue(func, attempts = 7)
-        self.queue.destroy()
+        self.queue.shutdown()
         self.assertEqual(data.value, 10)
 
+        # Retry after a delay.
+        start = time.time()
+        self.queue.enqueue(func, attempts = 3, retry_delay = lambda n: .2)
+        self.queue.destroy()
+        self.assertEqual(data.value, 13)
+        self.assert_(time.time() - start >= .4)
+
     #FIXME: Not a method test; this should probably be elsewhere.
     def testLogging(self):
         task = self.startTask()
@@ -392,10 +681,18 @@ class QueueTest(unittest.TestCase):
 class QueueTestMultiProcessing(QueueTest):
     mode = 'multiprocessing'
 
+class QueueTestThreadPool(QueueTest):
+    mode = 'threadpool'
+
+class QueueTestAsync(QueueTest):
+    mode = 'async'
+
 def suite():
     loader = unittest.TestLoader()
     suite1 = loader.loadTestsFromTestCase(QueueTest)
     suite2 = loader.loadTestsFromTestCase(QueueTestMultiProcessing)
-    return unittest.TestSuite((suite1, suite2))
+    suite3 = loader.loadTestsFromTestCase(QueueTestThreadPool)
+    suite4 = loader.loadTestsFromTestCase(QueueTestAsync)
+    return unittest.TestSuite((suite1, suite2, suite3, suite4))
 if __name__ == '__main__':
     unittest.TextTestRunner(verbosity = 2).run(suite())
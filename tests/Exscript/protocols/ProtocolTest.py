@@ -2,6 +2,7 @@ import sys, unittest, re, os.path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
 
 import time
+import threading
 from functools import partial
 from ConfigParser                 import RawConfigParser
 from Exscript                     import Account, PrivateKey
@@ -10,6 +11,14 @@ from Exscript.protocols.Exception import TimeoutException, \
                                          InvalidCommandException, \
                                          ExpectCancelledException
 from Exscript.protocols.Protocol import Protocol
+from Exscript.util.coroutine import Return
+from Exscript.workqueue.Job import Job
+from Exscript.workqueue.Reactor import Reactor
+from Exscript.workqueue.CoroutinePool import CoroutinePool
+
+def _run_coroutine(coroutine, job):
+    result = yield coroutine
+    raise Return(result)
 
 class ProtocolTest(unittest.TestCase):
     """
@@ -45,6 +54,9 @@ class ProtocolTest(unittest.TestCase):
         ls_response = '-rw-r--r--  1 sab  nmc    1628 Aug 18 10:02 file'
         self.device.add_command('ls',   ls_response)
         self.device.add_command('df',   'foobar')
+        self.long_response = '\n'.join('interface %d' % n
+                                       for n in range(20000))
+        self.device.add_command('show-config', self.long_response)
         self.device.add_command('exit', '')
         self.device.add_command('this-command-causes-an-error',
                                 '\ncommand not found')
@@ -55,6 +67,30 @@ class ProtocolTest(unittest.TestCase):
     def createProtocol(self):
         self.protocol = Protocol()
 
+    def runAsync(self, coroutine):
+        # Runs the given coroutine in an event loop, and returns its
+        # result or raises its exception.
+        reactor = Reactor()
+        reactor.start()
+        pool    = CoroutinePool(reactor)
+        done    = threading.Event()
+        result  = []
+        def on_complete(job, exc_info):
+            result.append(exc_info)
+            done.set()
+        job    = Job(partial(_run_coroutine, coroutine), 'async', 1, None)
+        job.id = 1
+        try:
+            pool.start(job, on_complete)
+            done.wait(30)
+        finally:
+            pool.stop()
+            reactor.stop()
+        self.assertEqual(len(result), 1)
+        if result[0] is not None:
+            raise result[0][1]
+        return job.result
+
     def doConnect(self):
         self.protocol.connect(self.hostname, self.port)
 
@@ -236,6 +272,30 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(self.protocol.response, None)
         self.assertEqual(self.protocol.get_host(), self.hostname)
 
+    def testConnectAsync(self):
+        # Test can not work on the abstract base.
+        if self.protocol.__class__ == Protocol:
+            self.assertRaises(Exception,
+                              self.runAsync,
+                              self.protocol.connect_async())
+            return
+        coroutine = self.protocol.connect_async(self.hostname, self.port)
+        self.runAsync(coroutine)
+        self.assertEqual(self.protocol.get_host(), self.hostname)
+
+    def testLoginAsync(self):
+        # Test can not work on the abstract base.
+        if self.protocol.__class__ == Protocol:
+            self.assertRaises(Exception,
+                              self.runAsync,
+                              self.protocol.login_async(self.account))
+            return
+        self.doConnect()
+        self.runAsync(self.protocol.login_async(self.account))
+        self.assert_(self.protocol.is_protocol_authenticated())
+        self.assert_(self.protocol.is_app_authenticated())
+        self.assert_(self.protocol.is_app_authorized())
+
     def testLogin(self):
         # Test can not work on the abstract base.
         if self.protocol.__class__ == Protocol:
@@ -406,6 +466,10 @@ class ProtocolTest(unittest.TestCase):
         self.assert_(self.protocol.response is not None)
         self.assert_(self.protocol.response.startswith('ls'))
 
+        # A response that spans many reads is returned as a whole.
+        self.protocol.execute('show-config')
+        self.assert_(self.long_response in self.protocol.response)
+
         # Make sure that we raise an error if the device responds
         # with something that matches any of the error prompts.
         self.protocol.set_error_prompt('.')
@@ -413,6 +477,29 @@ class ProtocolTest(unittest.TestCase):
                           self.protocol.execute,
                           'this-command-causes-an-error')
 
+    def testExecuteAsync(self):
+        # Test can not work on the abstract base.
+        if self.protocol.__class__ == Protocol:
+            self.assertRaises(Exception,
+                              self.runAsync,
+                              self.protocol.execute_async('ls'))
+            return
+        self.doLogin()
+        self.runAsync(self.protocol.execute_async('ls'))
+        self.assert_(self.protocol.response is not None)
+        self.assert_(self.protocol.response.startswith('ls'))
+
+        # A response that spans many reads is returned as a whole, and
+        # the blocking methods still work afterwards.
+        self.runAsync(self.protocol.execute_async('show-config'))
+        self.assert_(self.long_response in self.protocol.response)
+        self.protocol.execute('df')
+        self.assert_(self.protocol.response.startswith('df'))
+
+        self.protocol.set_error_prompt('.')
+        coroutine = self.protocol.execute_async('this-command-causes-an-error')
+        self.assertRaises(InvalidCommandException, self.runAsync, coroutine)
+
     def testWaitfor(self):
         # Test can not work on the abstract base.
         if self.protocol.__class__ == Protocol:
@@ -428,6 +515,22 @@ class ProtocolTest(unittest.TestCase):
         self.protocol.waitfor(re.compile(r'[\r\n]'))
         self.assertEqual(oldresponse, self.protocol.response)
 
+    def testWaitforAsync(self):
+        # Test can not work on the abstract base.
+        if self.protocol.__class__ == Protocol:
+            self.assertRaises(Exception,
+                              self.runAsync,
+                              self.protocol.waitfor_async('ls'))
+            return
+        self.doLogin()
+        oldresponse = self.protocol.response
+        self.protocol.send('ls\r')
+        self.runAsync(self.protocol.waitfor_async(re.compile(r'[\r\n]')))
+        self.failIfEqual(oldresponse, self.protocol.response)
+        oldresponse = self.protocol.response
+        self.runAsync(self.protocol.waitfor_async(re.compile(r'[\r\n]')))
+        self.assertEqual(oldresponse, self.protocol.response)
+
     def testExpect(self):
         # Test can not work on the abstract base.
         if self.protocol.__class__ == Protocol:
@@ -440,6 +543,27 @@ class ProtocolTest(unittest.TestCase):
         self.protocol.expect(re.compile(r'[\r\n]'))
         self.failIfEqual(oldresponse, self.protocol.response)
 
+    def testExpectAsync(self):
+        # Test can not work on the abstract base.
+        if self.protocol.__class__ == Protocol:
+            self.assertRaises(Exception,
+                              self.runAsync,
+                              self.protocol.expect_async('ls'))
+            return
+        self.doLogin()
+        oldresponse = self.protocol.response
+        self.protocol.send('ls\r')
+        result = self.runAsync(self.protocol.expect_async(r'[\r\n]'))
+        self.failIfEqual(oldresponse, self.protocol.response)
+        self.assertEqual(result[0], 0)
+
+        # Nothing else is received, so the next line times out.
+        self.runAsync(self.protocol.expect_prompt_async())
+        if not self.protocol.is_dummy():
+            self.protocol.set_timeout(.5)
+            coroutine = self.protocol.expect_async('nothing')
+            self.assertRaises(TimeoutException, self.runAsync, coroutine)
+
     def testExpectPrompt(self):
         # Test can not work on the abstract base.
         if self.protocol.__class__ == Protocol:
@@ -452,6 +576,25 @@ class ProtocolTest(unittest.TestCase):
         self.protocol.expect_prompt()
         self.failIfEqual(oldresponse, self.protocol.response)
 
+    def testExpectPromptAsync(self):
+        # Test can not work on the abstract base.
+        if self.protocol.__class__ == Protocol:
+            self.assertRaises(Exception,
+                              self.runAsync,
+                              self.protocol.expect_prompt_async())
+            return
+        self.doLogin()
+        oldresponse = self.protocol.response
+        self.protocol.send('ls\r')
+        self.runAsync(self.protocol.expect_prompt_async())
+        self.failIfEqual(oldresponse, self.protocol.response)
+        self.assert_(self.protocol.response.startswith('ls'))
+
+        # The synchronous expect() continues after the async match.
+        self.protocol.send('ls\r')
+        self.protocol.expect_prompt()
+        self.assert_(self.protocol.response.startswith('ls'))
+
     def testAddMonitor(self):
         # Set the monitor callback up.
         def monitor_cb(thedata, *args, **kwargs):
@@ -0,0 +1,137 @@
+import sys, unittest, re, os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import time
+import pickle
+from Exscript import Account
+from Exscript.protocols import Dummy, SessionPool
+
+class SessionPoolTest(unittest.TestCase):
+    CORRELATE = SessionPool
+
+    def setUp(self):
+        self.pool    = SessionPool(max_idle = 60)
+        self.account = Account('user', password = 'password')
+        self.key     = ('dummy', 'testhost', 23, None)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def createSession(self):
+        conn = Dummy()
+        conn.connect('testhost')
+        conn.login(self.account)
+        return conn
+
+    def testConstructor(self):
+        self.assertEqual(len(self.pool), 0)
+
+    def testExpire(self):
+        self.pool.checkin(self.key, self.createSession())
+        self.pool.expire()
+        self.assertEqual(len(self.pool), 1)
+
+        self.pool.max_idle = 0
+        time.sleep(.01)
+        self.pool.expire()
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.pool.checkout(self.key), None)
+
+        # Idle sessions are also closed if nobody calls expire().
+        pool = SessionPool(max_idle = .2)
+        conn = self.createSession()
+        pool.checkin(self.key, conn)
+        self.assertEqual(len(pool), 1)
+        time.sleep(.5)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.timer, None)
+        pool.close()
+
+    def testRegister(self):
+        conn = Dummy()
+        self.pool.register(conn)
+        conn.connect('testhost')
+        conn.login(self.account)
+
+        # A job changes the settings of the session.
+        conn.set_driver('ios')
+        conn.set_prompt(re.compile(r'foo'))
+        conn.set_timeout(1)
+        conn.add_monitor(r'bar', lambda *args: None)
+        conn.data_received_event.connect(lambda data: None)
+
+        # Checking the session in restores them.
+        self.pool.checkin(self.key, conn)
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(conn.manual_driver, None)
+        self.assertEqual(conn.manual_prompt_re, None)
+        self.assertEqual(conn.get_timeout(), Dummy().get_timeout())
+        self.assertEqual(conn.buffer.monitors, [])
+        self.assertEqual(conn.data_received_event.n_subscribers(), 0)
+
+    def testCheckout(self):
+        self.assertEqual(self.pool.checkout(self.key), None)
+        conn = self.createSession()
+        self.pool.checkin(self.key, conn)
+        self.assertEqual(self.pool.checkout(('dummy', 'other', 23, None)),
+                         None)
+        self.assertEqual(self.pool.checkout(self.key), conn)
+        self.assertEqual(self.pool.checkout(self.key), None)
+
+        # Sessions that do not answer the probe are dropped.
+        def fail(command):
+            raise Exception('connection lost')
+        conn.execute = fail
+        self.pool.checkin(self.key, conn)
+        self.assertEqual(self.pool.checkout(self.key), None)
+        self.assertEqual(len(self.pool), 0)
+
+    def testCheckin(self):
+        # Sessions that are not logged in are not kept.
+        conn = Dummy()
+        conn.connect('testhost')
+        self.pool.checkin(self.key, conn)
+        self.assertEqual(len(self.pool), 0)
+
+        # No more than max_per_host sessions are kept for a host,
+        # regardless of the account.
+        self.pool.checkin(self.key, self.createSession())
+        self.pool.checkin(('dummy', 'testhost', 23, 'user'),
+                          self.createSession())
+        self.assertEqual(len(self.pool), 1)
+
+        pool = SessionPool(max_per_host = 2)
+        pool.checkin(self.key, self.createSession())
+        pool.checkin(self.key, self.createSession())
+        pool.checkin(self.key, self.createSession())
+        self.assertEqual(len(pool), 2)
+
+        # Sessions that were not registered are only kept if no driver
+        # or prompt was set.
+        conn = self.createSession()
+        conn.add_monitor(r'bar', lambda *args: None)
+        pool.checkin(('dummy', 'otherhost', 23, None), conn)
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(conn.buffer.monitors, [])
+        conn = self.createSession()
+        conn.set_prompt(re.compile(r'foo'))
+        pool.checkin(('dummy', 'otherhost', 23, None), conn)
+        self.assertEqual(len(pool), 3)
+
+        # A pool that is passed to another process is replaced by the
+        # pool of that process.
+        self.assertEqual(pickle.loads(pickle.dumps(pool)), pool)
+        pool.close()
+
+    def testClose(self):
+        self.pool.checkin(self.key, self.createSession())
+        self.pool.close()
+        self.assertEqual(len(self.pool), 0)
+
+        # A closed pool is no longer looked up by its id.
+        self.assertNotEqual(pickle.loads(pickle.dumps(self.pool)), self.pool)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(SessionPoolTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
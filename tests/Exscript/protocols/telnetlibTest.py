@@ -0,0 +1,191 @@
+import sys, unittest, re, os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import time
+import socket
+import threading
+from Exscript.protocols import telnetlib
+from Exscript.protocols.telnetlib import IAC, DO, DONT, WILL, WONT, SB, SE, \
+                                         ECHO, TTYPE, NAWS, SEND_TTYPE, \
+                                         theNULL
+
+class telnetlibTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        host, port  = self.server.getsockname()
+        self.tn     = telnetlib.Telnet(host, port, termtype = 'vt100')
+        self.peer   = self.server.accept()[0]
+
+    def tearDown(self):
+        self.tn.close()
+        self.peer.close()
+        self.server.close()
+
+    def receive(self, data):
+        # Sends the given data to the client, and returns what the
+        # client has processed.
+        self.peer.sendall(data)
+        result = ''
+        while len(result) < len(data.replace(IAC, '')):
+            self.tn.fill_rawq()
+            self.tn.process_rawq()
+            result += self.tn.read_very_lazy()
+            if self.tn.eof or not self.tn.sock_avail():
+                break
+        return result
+
+    def replies(self):
+        self.peer.settimeout(.1)
+        data = ''
+        try:
+            while True:
+                data += self.peer.recv(1024)
+        except socket.timeout:
+            pass
+        return data
+
+    def testConstructor(self):
+        self.assertEqual(self.tn.rawq, '')
+        self.assertEqual(self.tn.cookedq.getvalue(), '')
+
+    def testClose(self):
+        self.tn.close()
+        self.assertEqual(self.tn.eof, 1)
+        self.assertEqual(self.peer.recv(10), '')
+
+    def testCancel(self):
+        timer = threading.Timer(.1, self.tn.cancel)
+        timer.start()
+        start = time.time()
+        self.assertEqual(self.tn.expect(['foo'], 10), (-2, None, ''))
+        self.assert_(time.time() - start < 5)
+        timer.join()
+
+    def testProcessRawq(self):
+        # Data that contains no IAC is passed through unchanged.
+        data = 'hello world\r\n' * 10000
+        self.peer.sendall(data)
+        result = ''
+        while len(result) < len(data):
+            self.tn.fill_rawq()
+            self.tn.process_rawq()
+            result += self.tn.read_very_lazy()
+        self.assertEqual(result, data)
+
+        # Escaped IAC characters and NOPs.
+        self.tn.rawq  = 'a' + IAC + IAC + 'b' + IAC + theNULL + 'c'
+        self.tn.irawq = 0
+        self.tn.process_rawq()
+        self.assertEqual(self.tn.read_very_lazy(), 'a' + IAC + 'bc')
+
+        # Option negotiation in between data.
+        received = []
+        self.tn.set_receive_callback(received.append)
+        self.tn.window_size = 24, 80
+        self.assertEqual(self.receive('a' + IAC + DO + TTYPE
+                                    + 'b' + IAC + DO + NAWS
+                                    + 'c' + IAC + DO + chr(99)
+                                    + 'd' + IAC + DONT + ECHO
+                                    + 'e' + IAC + WILL + ECHO
+                                    + 'f' + IAC + WONT + chr(99)
+                                    + 'g'),
+                         'abcdefg')
+        self.assertEqual(''.join(received), 'abcdefg')
+        self.assertEqual(self.tn.can_naws, True)
+        self.assertEqual(self.replies(), IAC + WILL + TTYPE
+                                       + IAC + WILL + NAWS
+                                       + IAC + SB + NAWS + '\0\x50\0\x18'
+                                       + IAC + SE
+                                       + IAC + WONT + chr(99)
+                                       + IAC + WONT + ECHO
+                                       + IAC + DO + ECHO
+                                       + IAC + DONT + chr(99))
+
+        # Subnegotiation.
+        self.assertEqual(self.receive('a' + IAC + SB + TTYPE + SEND_TTYPE
+                                    + IAC + SE + 'b'
+                                    + IAC + SB + NAWS + 'xyz' + IAC + SE
+                                    + 'c'),
+                         'abc')
+        self.assertEqual(self.replies(), IAC + SB + TTYPE + theNULL
+                                       + 'vt100' + IAC + SE)
+
+        # Without blocking, a sequence that is split is kept in the raw
+        # queue until the rest of it arrives.
+        self.tn.rawq  = 'a' + IAC + SB + TTYPE
+        self.tn.irawq = 0
+        self.tn.process_rawq(block = False)
+        self.assertEqual(self.tn.read_very_lazy(), 'a')
+        self.assertEqual(self.tn.rawq[self.tn.irawq:], IAC + SB + TTYPE)
+        self.tn.rawq += SEND_TTYPE + IAC
+        self.tn.process_rawq(block = False)
+        self.assertEqual(self.tn.read_very_lazy(), '')
+        self.tn.rawq += SE + 'b' + IAC
+        self.tn.process_rawq(block = False)
+        self.assertEqual(self.tn.read_very_lazy(), 'b')
+        self.assertEqual(self.tn.rawq[self.tn.irawq:], IAC)
+        self.tn.rawq += IAC + 'c' + IAC + SB + NAWS + 'xy'
+        self.tn.process_rawq(block = False)
+        self.assertEqual(self.tn.read_very_lazy(), IAC + 'c')
+        self.tn.rawq += 'z' + IAC + SE + 'd'
+        self.tn.process_rawq(block = False)
+        self.assertEqual(self.tn.read_very_lazy(), 'd')
+        self.assertEqual(self.tn.rawq, '')
+        self.assertEqual(self.replies(), IAC + SB + TTYPE + theNULL
+                                       + 'vt100' + IAC + SE)
+
+    def testRawqSkipTo(self):
+        self.tn.rawq  = 'abc'
+        self.tn.irawq = 1
+        self.peer.sendall('defg')
+        self.tn.rawq_skip_to('e')
+        self.assertEqual(self.tn.rawq_getchar(), 'f')
+
+        self.peer.close()
+        self.assertRaises(EOFError, self.tn.rawq_skip_to, 'x')
+
+    def testCookedqSkip(self):
+        self.tn.cookedq.write('abcdef')
+        self.tn.cookedq_skip(2)
+        self.tn.cookedq.write('g')
+        self.assertEqual(self.tn.read_very_lazy(), 'cdefg')
+
+    def testFillRawq(self):
+        self.tn.rawq  = 'ab'
+        self.tn.irawq = 2
+        self.peer.sendall('cd')
+        self.tn.fill_rawq()
+        self.assertEqual(self.tn.rawq, 'cd')
+        self.assertEqual(self.tn.irawq, 0)
+
+        self.peer.close()
+        self.tn.fill_rawq()
+        self.assertEqual(self.tn.eof, True)
+
+    def testExpect(self):
+        self.peer.sendall('foo' + IAC + WILL + ECHO + 'bar> ')
+        result = self.tn.expect([re.compile(r'> $')], 5)
+        self.assertEqual(result[0], 0)
+
+        start = time.time()
+        self.assertEqual(self.tn.expect(['baz'], .2)[0], -1)
+        self.assert_(time.time() - start < 1)
+
+        # A match that is followed by more than the search window in the
+        # same read is found.
+        self.peer.sendall('banner PATTERN ' + 'x' * 500)
+        result = self.tn.expect(['PATTERN'], 2)
+        self.assertEqual(result[0], 0)
+        self.assertEqual(result[1].group(), 'PATTERN')
+
+        self.peer.sendall('banner PATTERN ' + 'x' * 500)
+        cleanup = lambda response: (response, '')
+        result  = self.tn.expect(['PATTERN'], 2, cleanup = cleanup)
+        self.assertEqual(result[0], 0)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(telnetlibTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -1,6 +1,7 @@
 import sys, unittest, re, os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
 
+import warnings
 from tempfile import TemporaryFile
 from functools import partial
 from Exscript.util.buffer import MonitoredBuffer
@@ -10,8 +11,14 @@ class bufferTest(unittest.TestCase):
 
     def testConstructor(self):
         MonitoredBuffer()
+
+        # The io argument is deprecated.
         with TemporaryFile() as f:
-            MonitoredBuffer(f)
+            with warnings.catch_warnings(record = True) as caught:
+                warnings.simplefilter('always')
+                MonitoredBuffer(f)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(caught[0].category, DeprecationWarning)
 
     def testSize(self):
         b = MonitoredBuffer()
@@ -66,6 +73,16 @@ class bufferTest(unittest.TestCase):
         self.assertEqual(b.pop(10), 'obardoh')
         self.assertEqual(str(b), '')
 
+        # Popping many small pieces from a large buffer.
+        data = ''.join(str(i % 10) for i in range(300000))
+        b.append(data)
+        for i in range(0, len(data), 1000):
+            self.assertEqual(b.pop(1000), data[i:i + 1000])
+            self.assertEqual(b.size(), len(data) - i - 1000)
+            self.assertEqual(b.head(3), data[i + 1000:i + 1003])
+            self.assertEqual(b.tail(3), data[-3:][:b.size()])
+        self.assertEqual(str(b), '')
+
     def testAppend(self):
         b = MonitoredBuffer()
         self.assertEqual(str(b), '')
@@ -75,6 +92,8 @@ class bufferTest(unittest.TestCase):
         self.assertEqual(str(b), 'foobar')
         b.append('doh')
         self.assertEqual(str(b), 'foobardoh')
+        b.append(u'\xe4')
+        self.assertEqual(str(b), 'foobardoh\xc3\xa4')
 
     def testClear(self):
         b = MonitoredBuffer()
@@ -122,6 +141,58 @@ class bufferTest(unittest.TestCase):
         self.assertEqual(data.get('args')[1].group(0), 'abc')
         self.assertEqual(data.get('kwargs'), {})
 
+        # Matches that span several appends are found.
+        data.clear()
+        b.append('xa')
+        b.append('b')
+        self.assertEqual(data, {})
+        b.append('cx')
+        self.assertEqual(data.get('args')[1].group(0), 'abc')
+
+        # All of the appended data is searched, even if it is larger
+        # than the limit.
+        data.clear()
+        b.append('abc' + 'x' * 1000)
+        self.assertEqual(data.get('args')[1].group(0), 'abc')
+
+        # Data that was popped does not match again.
+        data.clear()
+        b.pop(b.size() - 1)
+        b.append('bc')
+        self.assertEqual(data, {})
+
+    def testAddMonitorPositions(self):
+        b       = MonitoredBuffer()
+        matches = []
+        b.add_monitor(r'^\w+\$', lambda i, match: matches.append(match))
+
+        # Anchors apply to the whole buffer, not to the searched data.
+        b.append('foo$')
+        self.assertEqual([m.group(0) for m in matches], ['foo$'])
+        b.append(' bar$')
+        self.assertEqual(len(matches), 1)
+
+        b = MonitoredBuffer()
+        b.add_monitor(re.compile(r'^\w+\$', re.M),
+                      lambda i, match: matches.append(match))
+        del matches[:]
+        b.append('x' * 200 + '\nfoo')
+        b.append('$')
+        self.assertEqual(len(matches), 1)
+
+        # Match positions are relative to the start of the buffer, also
+        # after data was popped.
+        self.assertEqual(matches[0].span(), (201, 205))
+        self.assertEqual(str(b)[slice(*matches[0].span())], 'foo$')
+        b.pop(201)
+        b.append('\nbar$')
+        self.assertEqual(matches[1].group(0), 'bar$')
+        self.assertEqual(matches[1].span(), (5, 9))
+
+        # Matches do not change with the buffer.
+        b.clear()
+        self.assertEqual(matches[1].group(0), 'bar$')
+
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(bufferTest)
 if __name__ == '__main__':
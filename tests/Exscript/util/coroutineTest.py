@@ -0,0 +1,59 @@
+import sys, unittest, re, os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import Exscript.util.coroutine
+from functools import partial
+from multiprocessing import Pipe
+from Exscript.util.coroutine import Return, Readable, Sleep, Blocking
+
+def get_foo(job):
+    yield Exscript.util.coroutine.sleep(0)
+    raise Return('foo')
+
+def get_bar(job):
+    return 'bar'
+
+class coroutineTest(unittest.TestCase):
+    CORRELATE = Exscript.util.coroutine
+
+    def testReturn(self):
+        self.assertEqual(Return().value, None)
+        self.assertEqual(Return('foo').value, 'foo')
+        self.assert_(isinstance(Return(), Exception))
+
+    def testReadable(self):
+        from Exscript.util.coroutine import readable
+        pipe    = Pipe()
+        request = readable(pipe[0])
+        self.assert_(isinstance(request, Readable))
+        self.assertEqual(request.fileobj, pipe[0])
+        self.assertEqual(request.timeout, None)
+        self.assertEqual(readable(pipe[0], 5).timeout, 5)
+
+    def testSleep(self):
+        from Exscript.util.coroutine import sleep
+        request = sleep(1.5)
+        self.assert_(isinstance(request, Sleep))
+        self.assertEqual(request.seconds, 1.5)
+
+    def testBlocking(self):
+        from Exscript.util.coroutine import blocking
+        request = blocking(get_bar, 'job', foo = 'bar')
+        self.assert_(isinstance(request, Blocking))
+        self.assertEqual(request.function, get_bar)
+        self.assertEqual(request.args, ('job',))
+        self.assertEqual(request.kwargs, {'foo': 'bar'})
+
+    def testIsCoroutineFunction(self):
+        from Exscript.util.coroutine import is_coroutine_function
+        self.assert_(is_coroutine_function(get_foo))
+        self.assert_(is_coroutine_function(partial(get_foo)))
+        self.assert_(is_coroutine_function(partial(partial(get_foo))))
+        self.failIf(is_coroutine_function(get_bar))
+        self.failIf(is_coroutine_function(partial(get_bar)))
+        self.failIf(is_coroutine_function(lambda job: None))
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(coroutineTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -32,6 +32,16 @@ class FakeConnection(object):
         self.authenticated = True
         self.login_flushed = flush
 
+    def auto_app_authorize(self, flush = True):
+        self.logged_in     = True
+        self.login_flushed = flush
+
+    def is_app_authenticated(self):
+        return self.authenticated or self.logged_in
+
+    def is_app_authorized(self):
+        return self.logged_in
+
     def close(self, force):
         self.connected    = False
         self.close_forced = force
@@ -55,6 +65,30 @@ class decoratorTest(unittest.TestCase):
         result = bound(FakeJob())
         self.assert_(result == 123, result)
 
+        # Coroutines remain coroutines.
+        from Exscript.util.coroutine import Return, is_coroutine_function
+        def bind_async(job, *args, **kwargs):
+            raise Return(self.bind_cb(job, *args, **kwargs))
+            yield
+        bound     = bind(bind_async, 'one', 'two', three = 3)
+        coroutine = bound(FakeJob())
+        self.assert_(is_coroutine_function(bound))
+
+        # The bound coroutine yields the original one, and returns its
+        # return value.
+        inner = coroutine.send(None)
+        try:
+            inner.send(None)
+        except Return, e:
+            result = e.value
+        self.assertEqual(result, 123)
+        try:
+            coroutine.send(result)
+        except Return, e:
+            self.assertEqual(e.value, 123)
+        else:
+            self.fail('the coroutine did not return')
+
     def ios_cb(self, job, *args):
         return 'hello ios'
 
@@ -99,6 +133,20 @@ class decoratorTest(unittest.TestCase):
         result = bound(job, host, conn, 'one', 'two', three = 3)
         self.assertEqual(result, 123)
 
+        # A session that is logged in already is not logged in again.
+        conn.login = None
+        result = bound(job, host, conn, 'one', 'two', three = 3)
+        self.assertEqual(result, 123)
+
+        # A session that is only authenticated, e.g. one that was
+        # taken from a session pool, is authorized.
+        conn = job.data['conn'] = FakeConnection()
+        conn.authenticate()
+        conn.login = None
+        result = bound(job, host, conn, 'one', 'two', three = 3)
+        self.assertEqual(result, 123)
+        self.assert_(conn.is_app_authorized())
+
         # Monkey patch the fake connection such that the login fails.
         conn = FakeConnection()
         data = Value('i', 0)
@@ -0,0 +1,76 @@
+import sys, unittest, re, os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import time
+import socket
+import threading
+from Exscript.util.wakeup import WakeupPipe
+
+class wakeupTest(unittest.TestCase):
+    CORRELATE = WakeupPipe
+
+    def setUp(self):
+        self.wakeup     = WakeupPipe()
+        self.server     = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.sock       = socket.create_connection(self.server.getsockname())
+        self.peer, addr = self.server.accept()
+
+    def tearDown(self):
+        self.wakeup.close()
+        self.sock.close()
+        self.peer.close()
+        self.server.close()
+
+    def testConstructor(self):
+        self.assertEqual(self.wakeup.wait(self.sock, time.time()), False)
+
+    def testWake(self):
+        # A wake() before the wait interrupts the next wait only.
+        self.wakeup.wake()
+        self.wakeup.wake()
+        start = time.time()
+        self.assertEqual(self.wakeup.wait(self.sock, start + 10), False)
+        self.assert_(time.time() - start < 1)
+        self.assertEqual(self.wakeup.wait(self.sock, time.time() + .1),
+                         False)
+
+        # A wake() from another thread interrupts the wait immediately.
+        timer = threading.Timer(.1, self.wakeup.wake)
+        timer.start()
+        start = time.time()
+        self.assertEqual(self.wakeup.wait(self.sock, start + 10), False)
+        self.assert_(time.time() - start < 5)
+        timer.join()
+
+    def testWait(self):
+        # The deadline is kept exactly, not in steps of a second.
+        start = time.time()
+        self.assertEqual(self.wakeup.wait(self.sock, start + .2), False)
+        self.assert_(.15 < time.time() - start < .9)
+
+        # Data that arrives ends the wait.
+        self.peer.send('foo')
+        self.assertEqual(self.wakeup.wait(self.sock, time.time() + 10), True)
+
+    def testClose(self):
+        # A close() from another thread ends the wait without an error.
+        for n in range(20):
+            wakeup = WakeupPipe()
+            timer  = threading.Timer(.01 * (n % 3), wakeup.close)
+            timer.start()
+            start = time.time()
+            self.assertEqual(wakeup.wait(self.sock, start + 10), False)
+            self.assert_(time.time() - start < 5)
+            timer.join()
+
+        self.wakeup.close()
+        self.wakeup.close()
+        self.wakeup.wake()
+        self.assertEqual(self.wakeup.wait(self.sock, time.time()), False)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(wakeupTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
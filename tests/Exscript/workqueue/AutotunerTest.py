@@ -0,0 +1,115 @@
+import sys, unittest, re, os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from Exscript.workqueue import WorkQueue
+from Exscript.workqueue.Autotuner import Autotuner
+from Exscript.protocols.Exception import TimeoutException
+from Exscript.workqueue.Exception import JobTimeoutException
+
+def get_exc_info(exc):
+    try:
+        raise exc
+    except Exception:
+        return sys.exc_info()
+
+class AutotunerTest(unittest.TestCase):
+    CORRELATE = Autotuner
+
+    def setUp(self):
+        self.wq    = WorkQueue()
+        self.tuner = Autotuner(self.wq, 2, 10)
+
+    def tearDown(self):
+        self.tuner.stop()
+        self.wq.destroy()
+
+    def succeed(self, n):
+        for i in range(n):
+            self.wq.job_succeeded_event(None)
+
+    def fail(self, exc):
+        self.wq.job_error_event(None, get_exc_info(exc))
+
+    def testConstructor(self):
+        self.assertEqual(self.tuner.get_threads(), 2)
+        self.assertEqual(self.wq.get_max_threads(), 2)
+        self.assertRaises(ValueError, Autotuner, self.wq, 0, 10)
+        self.assertRaises(ValueError, Autotuner, self.wq, 5, 4)
+
+    def testIsCongestion(self):
+        exc_info = get_exc_info(TimeoutException('timeout'))
+        self.assert_(self.tuner.is_congestion(exc_info))
+        exc_info = get_exc_info(JobTimeoutException('deadline'))
+        self.assert_(self.tuner.is_congestion(exc_info))
+        exc_info = get_exc_info(ValueError('foo'))
+        self.failIf(self.tuner.is_congestion(exc_info))
+
+    def testAddLatency(self):
+        self.succeed(2 + 3 + 4)
+        self.assertEqual(self.tuner.get_threads(), 5)
+
+        # Stable or small changes of the latency are no congestion.
+        for i in range(10):
+            self.tuner.add_latency(.01)
+            self.tuner.add_latency(.05)
+        self.assertEqual(self.tuner.get_threads(), 5)
+
+        # Connecting much more slowly is.
+        for i in range(10):
+            self.tuner.add_latency(1)
+        self.assertEqual(self.tuner.get_threads(), 2)
+
+        # If it stays slow, the number of threads grows again.
+        self.succeed(2 + 3)
+        for i in range(10):
+            self.tuner.add_latency(1)
+        self.assertEqual(self.tuner.get_threads(), 4)
+
+    def testGetThreads(self):
+        # Additive increase.
+        self.succeed(1)
+        self.assertEqual(self.tuner.get_threads(), 2)
+        self.succeed(1)
+        self.assertEqual(self.tuner.get_threads(), 3)
+        self.succeed(3)
+        self.assertEqual(self.tuner.get_threads(), 4)
+        self.assertEqual(self.wq.get_max_threads(), 4)
+
+        # Changes are announced.
+        changes = []
+        self.tuner.threads_changed_event.connect(changes.append)
+        self.succeed(4)
+        self.assertEqual(changes, [5])
+        self.wq.set_max_threads(4)
+        self.assertEqual(self.tuner.get_threads(), 4)
+
+        # Other errors do not decrease the number of threads.
+        self.fail(ValueError('foo'))
+        self.assertEqual(self.tuner.get_threads(), 4)
+
+        # Multiplicative decrease, but only once per overload.
+        self.fail(TimeoutException('timeout'))
+        self.assertEqual(self.tuner.get_threads(), 2)
+        self.fail(TimeoutException('timeout'))
+        self.assertEqual(self.tuner.get_threads(), 2)
+        self.succeed(2)
+        self.assertEqual(self.tuner.get_threads(), 3)
+
+        # The number of threads is bounded.
+        self.succeed(100)
+        self.assertEqual(self.tuner.get_threads(), 10)
+        for i in range(10):
+            self.succeed(10)
+            self.fail(TimeoutException('timeout'))
+        self.assertEqual(self.tuner.get_threads(), 2)
+
+    def testStop(self):
+        self.tuner.stop()
+        self.succeed(10)
+        self.assertEqual(self.tuner.get_threads(), 2)
+        self.tuner = Autotuner(self.wq, 2, 10)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(AutotunerTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -0,0 +1,217 @@
+import sys, unittest, re, os.path, threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import time
+from multiprocessing import Pipe
+from Exscript.util.coroutine import Return, readable, sleep, blocking
+from Exscript.workqueue.Job import Job
+from Exscript.workqueue.CoroutinePool import CoroutinePool
+from Exscript.workqueue.Reactor import Reactor
+
+def get_foo(job):
+    return job.data['foo']
+
+def get_foo_async(job):
+    yield sleep(.01)
+    raise Return(job.data['foo'])
+
+def get_thread(job):
+    yield sleep(0)
+    raise Return(threading.current_thread())
+
+def nested(job):
+    result = yield get_foo_async(job)
+    raise Return(result + 'baz')
+
+def call_blocking(job):
+    result = yield blocking(get_foo, job)
+    raise Return(result)
+
+def fail(job):
+    raise Exception('intentional error')
+
+def fail_async(job):
+    yield sleep(0)
+    raise Exception('intentional error')
+
+def catch_nested(job):
+    try:
+        yield fail_async(job)
+    except Exception, e:
+        raise Return(str(e))
+
+def yield_garbage(job):
+    yield 'garbage'
+
+def read_pipe(job):
+    pipe = job.data['pipe']
+    ready = yield readable(pipe, 5)
+    raise Return(ready and pipe.recv())
+
+def wait_for_timeout(job):
+    ready = yield readable(job.data['pipe'], .1)
+    raise Return(ready)
+
+def wait_forever(job):
+    job.data['started'].set()
+    try:
+        yield sleep(60)
+    finally:
+        job.data['closed'].set()
+
+def wait_for_event(job):
+    job.data['started'].set()
+    job.data['closed'].wait(5)
+    return 'done'
+
+class CoroutinePoolTest(unittest.TestCase):
+    CORRELATE = CoroutinePool
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.reactor.start()
+        self.pool = CoroutinePool(self.reactor, 10, 2)
+
+    def tearDown(self):
+        self.pool.stop()
+        self.reactor.stop()
+
+    def runJob(self, function, data = None):
+        done   = threading.Event()
+        result = []
+        def on_complete(job, exc_info):
+            result.append((job, exc_info))
+            done.set()
+        job    = Job(function, 'myjob', 1, data or {'foo': 'bar'})
+        job.id = 1
+        self.pool.start(job, on_complete)
+        done.wait(10)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], job)
+        return job, result[0][1]
+
+    def testConstructor(self):
+        self.assertEqual(self.pool.get_size(), 10)
+        self.assertEqual(self.pool.threads, 2)
+        self.assertEqual(self.pool.running, {})
+
+    def testStart(self):
+        # Functions that are not coroutines run in a thread.
+        job, exc_info = self.runJob(get_foo)
+        self.assertEqual(exc_info, None)
+        self.assertEqual(job.result, 'bar')
+        job, exc_info = self.runJob(fail)
+        self.assertEqual(exc_info[0], Exception)
+
+        # Coroutines run in the reactor thread.
+        job, exc_info = self.runJob(get_foo_async)
+        self.assertEqual(exc_info, None)
+        self.assertEqual(job.result, 'bar')
+        job, exc_info = self.runJob(get_thread)
+        self.assertEqual(job.result, self.reactor)
+
+        # Nested coroutines, blocking calls, and errors.
+        job, exc_info = self.runJob(nested)
+        self.assertEqual(job.result, 'barbaz')
+        job, exc_info = self.runJob(call_blocking)
+        self.assertEqual(job.result, 'bar')
+        job, exc_info = self.runJob(fail_async)
+        self.assertEqual(exc_info[0], Exception)
+        job, exc_info = self.runJob(catch_nested)
+        self.assertEqual(exc_info, None)
+        self.assertEqual(job.result, 'intentional error')
+        job, exc_info = self.runJob(yield_garbage)
+        self.assertEqual(exc_info[0], TypeError)
+        self.assertEqual(self.pool.running, {})
+
+        # Waiting for a pipe.
+        to_self, to_peer = Pipe()
+        timer = threading.Timer(.2, to_peer.send, ('hello',))
+        timer.start()
+        job, exc_info = self.runJob(read_pipe, {'pipe': to_self})
+        self.assertEqual(job.result, 'hello')
+        job, exc_info = self.runJob(wait_for_timeout, {'pipe': to_self})
+        self.assertEqual(job.result, False)
+        self.assertEqual(self.reactor.readers, {})
+        to_self.close()
+        to_peer.close()
+
+    def testManyCoroutines(self):
+        # Many more jobs than threads run at the same time.
+        done   = threading.Event()
+        result = []
+        def on_complete(job, exc_info):
+            result.append(exc_info)
+            if len(result) == 200:
+                done.set()
+        start = time.time()
+        for n in range(200):
+            job    = Job(get_foo_async, 'job' + str(n), 1, {'foo': 'bar'})
+            job.id = n
+            self.pool.start(job, on_complete)
+        done.wait(10)
+        self.assertEqual(result, [None] * 200)
+        self.assert_(time.time() - start < 1)
+
+    def testCancel(self):
+        data = {'started': threading.Event(), 'closed': threading.Event()}
+        job  = Job(wait_forever, 'myjob', 1, data)
+        job.id = 1
+        cancelled = threading.Event()
+        result    = []
+        def on_complete(job, exc_info):
+            result.append(exc_info)
+        self.pool.start(job, on_complete)
+        data['started'].wait(5)
+        coro = self.pool.running[1, 0]
+        coro.cancel_event.connect(cancelled.set)
+        self.pool.cancel(job)
+        cancelled.wait(5)
+        self.assert_(cancelled.is_set())
+        self.assert_(data['closed'].is_set())
+        self.assertEqual(self.pool.running, {})
+        self.assertEqual(result, [])
+
+        # Cancelling a job that is not running does nothing.
+        self.assertEqual(self.pool.cancel(job), True)
+
+        # A job that runs in a thread can not be stopped, so it is
+        # completed when the thread returns. Jobs that still wait for a
+        # thread are stopped.
+        self.pool.threads = 1
+        data = {'started': threading.Event(), 'closed': threading.Event()}
+        job1 = Job(wait_for_event, 'job1', 1, data)
+        job2 = Job(get_foo, 'job2', 1, {'foo': 'bar'})
+        job1.id = 2
+        job2.id = 3
+        self.pool.start(job1, on_complete)
+        self.pool.start(job2, on_complete)
+        data['started'].wait(5)
+        self.assertEqual(self.pool.cancel(job1), False)
+        self.assertEqual(self.pool.cancel(job2), True)
+        data['closed'].set()
+        for n in range(50):
+            if not self.pool.running:
+                break
+            time.sleep(.1)
+        self.assertEqual(self.pool.running, {})
+        self.assertEqual(result, [None])
+        self.assertEqual(job1.result, 'done')
+
+    def testSetSize(self):
+        self.pool.set_size(1000)
+        self.assertEqual(self.pool.get_size(), 1000)
+        self.assertEqual(self.pool.threads, 2)
+
+    def testGetSize(self):
+        self.assertEqual(self.pool.get_size(), 10)
+
+    def testStop(self):
+        self.runJob(get_foo)
+        self.pool.stop()
+        self.assertEqual(len(self.pool.executor.workers), 0)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CoroutinePoolTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -0,0 +1,300 @@
+import sys, unittest, re, os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from tempfile import NamedTemporaryFile
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+from Exscript.workqueue.DBPipeline import DBPipeline
+
+class DBPipelineTest(unittest.TestCase):
+    CORRELATE = DBPipeline
+
+    def setUp(self):
+        self.dbfile   = NamedTemporaryFile()
+        self.engine   = create_engine('sqlite:///' + self.dbfile.name,
+                                      poolclass = NullPool)
+        self.pipeline = DBPipeline(self.engine)
+        self.pipeline.install()
+
+    def tearDown(self):
+        self.dbfile.close()
+
+    def restart(self):
+        # Simulates a process that is restarted on the same database.
+        self.pipeline = DBPipeline(self.engine)
+        return self.pipeline.recover()
+
+    def count_rows(self, status = None):
+        tbl_j = self.pipeline._table_map['job']
+        query = tbl_j.select()
+        if status is not None:
+            query = tbl_j.select(tbl_j.c.status == status)
+        return len(query.execute().fetchall())
+
+    def testConstructor(self):
+        self.assertEqual(self.pipeline.get_max_working(), 1)
+        pipeline = DBPipeline(self.engine, max_working = 10)
+        self.assertEqual(pipeline.get_max_working(), 10)
+
+    def testInstall(self):
+        self.pipeline.install()
+
+    def testUninstall(self):
+        self.pipeline.uninstall()
+        self.pipeline.install()
+
+    def testClearDatabase(self):
+        self.pipeline.append('foo')
+        self.pipeline.clear_database()
+        self.assertEqual(self.count_rows(), 0)
+        self.assertEqual(self.restart(), [])
+
+    def testDebug(self):
+        self.pipeline.debug(True)
+        self.assertEqual(self.engine.echo, True)
+        self.pipeline.debug(False)
+        self.assertEqual(self.engine.echo, False)
+
+    def testSetTablePrefix(self):
+        self.assertEqual(self.pipeline.get_table_prefix(),
+                         'exscript_pipeline_')
+        self.pipeline.set_table_prefix('foo')
+        self.assertEqual(self.pipeline.get_table_prefix(), 'foo')
+        self.pipeline.install()
+        self.pipeline.uninstall()
+
+    def testGetTablePrefix(self):
+        self.testSetTablePrefix()
+
+    def testSetDumpFunction(self):
+        self.pipeline.set_dump_function(lambda item: item.upper())
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+
+        # Items are rebuilt from what was stored; rows of items that
+        # can not be rebuilt are deleted.
+        self.pipeline = DBPipeline(self.engine)
+        def load(item):
+            if item == 'TWO':
+                return None
+            return item.lower()
+        recovered = self.pipeline.recover(load)
+        self.assertEqual([item for id, item in recovered], ['one'])
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.assertEqual(self.count_rows(), 1)
+
+    def testFlush(self):
+        self.pipeline.set_max_working(2)
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.assertEqual(self.count_rows('working'), 2)
+
+        # While other items are working, state changes are batched.
+        self.pipeline.task_done('one')
+        self.assertEqual(self.count_rows(), 2)
+        self.pipeline.flush()
+        self.assertEqual(self.count_rows(), 1)
+
+        # The last working item is written immediately.
+        self.pipeline.task_done('two')
+        self.assertEqual(self.count_rows(), 0)
+
+    def testTaskDone(self):
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.pipeline.task_done('one')
+        self.assertEqual(self.count_rows(), 1)
+
+        # Items that were done are not recovered.
+        self.assertEqual(self.restart(), [(2, 'two')])
+
+        # Batched changes are written with the next claim.
+        self.pipeline = DBPipeline(self.engine, max_working = 2,
+                                   batch_size = 100)
+        self.pipeline.recover()
+        self.pipeline.append('three')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.assertEqual(self.pipeline.next(), 'three')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.count_rows(), 2)
+        self.pipeline.append('four')
+        self.assertEqual(self.pipeline.next(), 'four')
+        self.assertEqual(self.count_rows(), 2)
+
+        # Items that are not known are ignored.
+        self.pipeline.task_done('five')
+
+    def testDefer(self):
+        self.pipeline.set_max_working(2)
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.defer('one', 60)
+        self.pipeline.flush()
+        self.assertEqual(self.count_rows('queued'), 1)
+        self.assertEqual(self.count_rows('working'), 1)
+
+        # Deferred items are recovered without the delay, in front of
+        # the queue, but behind interrupted items.
+        self.pipeline.append('three')
+        self.restart()
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.assertEqual(self.count_rows('queued'), 1)
+
+    def testAppend(self):
+        self.assertEqual(len(self.pipeline), 0)
+        id1 = self.pipeline.append('one')
+        id2 = self.pipeline.append('two', 'foo', priority = 2)
+        self.assertEqual(len(self.pipeline), 2)
+        self.assertEqual(self.count_rows('queued'), 2)
+        self.assertEqual(self.pipeline.get_from_name('foo'), 'two')
+        self.assertRaises(AttributeError,
+                          self.pipeline.append,
+                          'three',
+                          'foo')
+        self.assertEqual(self.count_rows(), 2)
+
+        # Names, priorities and ids are restored.
+        self.assertEqual(self.restart(), [(id1, 'one'), (id2, 'two')])
+        self.assertEqual(self.pipeline.get_from_name('foo'), 'two')
+        self.assert_(self.pipeline.has_id(id1))
+        self.assert_(self.pipeline.has_id(id2))
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+
+    def testAppendMany(self):
+        ids = self.pipeline.append_many([('one', None), ('two', 'foo')])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.count_rows(), 2)
+
+        # A batch with a duplicate name is not written at all.
+        self.assertRaises(AttributeError,
+                          self.pipeline.append_many,
+                          [('three', None), ('four', 'foo')])
+        self.assertEqual(len(self.pipeline), 2)
+        self.assertEqual(self.count_rows(), 2)
+
+        # If the transaction fails, the batch is not added to the
+        # pipeline either, so that its ids are not used twice.
+        def fail(conn):
+            raise Exception('intentional error')
+        event.listen(self.engine, 'commit', fail)
+        self.assertRaises(Exception,
+                          self.pipeline.append_many,
+                          [('three', None), ('four', 'bar')])
+        event.remove(self.engine, 'commit', fail)
+        self.assertEqual(len(self.pipeline), 2)
+        self.assertEqual(self.pipeline.get_from_name('bar'), None)
+        self.assertEqual(self.count_rows(), 2)
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.pipeline.task_done('one')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.try_next(), None)
+        self.assertEqual(len(self.pipeline), 0)
+
+        ids = self.pipeline.append_many([('one', None), ('two', 'foo')])
+        self.assertEqual(self.restart(), zip(ids, ['one', 'two']))
+
+    def testNext(self):
+        self.pipeline.set_max_working(2)
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+
+        # An item whose row was claimed elsewhere is dropped.
+        tbl_j = self.pipeline._table_map['job']
+        tbl_j.update(tbl_j.c.id == 1).execute(status = 'working')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.assertEqual(len(self.pipeline), 1)
+        self.assertEqual(self.pipeline.get_working(), ['two'])
+        self.assertEqual(self.count_rows('working'), 2)
+
+    def testAppendleft(self):
+        self.pipeline.append('one')
+        self.pipeline.appendleft('two')
+        self.pipeline.appendleft('three')
+        self.restart()
+        self.assertEqual(self.pipeline.next(), 'three')
+        self.pipeline.task_done('three')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+
+    def testAppendleftMany(self):
+        self.pipeline.append('one')
+        ids = self.pipeline.appendleft_many([('two', None),
+                                             ('three', None)],
+                                            force = True)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.count_rows(), 3)
+
+        # Forced items are recovered like items that were appended
+        # without force.
+        self.restart()
+        self.assertEqual(len(self.pipeline), 3)
+        self.assertEqual(self.pipeline.next(), 'three')
+        self.pipeline.task_done('three')
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.next(), 'one')
+
+    def testPrioritize(self):
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+        self.pipeline.append('three')
+        self.pipeline.prioritize('three')
+        self.pipeline.prioritize('two', force = True)
+        self.restart()
+        self.assertEqual(self.pipeline.next(), 'two')
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.next(), 'three')
+        self.pipeline.task_done('three')
+        self.assertEqual(self.pipeline.next(), 'one')
+
+    def testClear(self):
+        self.pipeline.append('one')
+        self.pipeline.clear()
+        self.assertEqual(len(self.pipeline), 0)
+        self.assertEqual(self.count_rows(), 1)
+        self.assertEqual(len(self.pipeline.recover()), 1)
+        self.assertEqual(len(self.pipeline), 1)
+
+    def testRecover(self):
+        self.assertEqual(self.pipeline.recover(), [])
+        self.pipeline.append('one')
+        self.pipeline.append('two')
+        self.pipeline.append('three')
+        self.assertEqual(self.pipeline.next(), 'one')
+
+        # Items that are already queued are not recovered twice.
+        self.assertEqual(self.pipeline.recover(), [])
+
+        # The interrupted item is started first.
+        self.assertEqual(len(self.restart()), 3)
+        self.assertEqual(self.count_rows('working'), 0)
+        self.assertEqual(self.pipeline.next(), 'one')
+        self.pipeline.task_done('one')
+        self.assertEqual(self.pipeline.next(), 'two')
+
+        # Appended items do not collide with recovered ones.
+        id4 = self.pipeline.append('four')
+        self.assertEqual(self.pipeline.has_id(id4), True)
+        self.assertEqual(len(self.pipeline), 3)
+        self.pipeline.task_done('two')
+        self.assertEqual(self.pipeline.next(), 'three')
+        self.pipeline.task_done('three')
+        self.assertEqual(self.pipeline.next(), 'four')
+        self.pipeline.task_done('four')
+        self.assertEqual(self.count_rows(), 0)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(DBPipelineTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -1,14 +1,26 @@
 import sys, unittest, re, os.path, threading
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
 
+import multiprocessing
 from multiprocessing import Pipe
 from Exscript.workqueue.Job import Thread, Process, Job
 from tempfile import NamedTemporaryFile
 from cPickle import dumps, loads
 
+started = multiprocessing.Event()
+
 def do_nothing(job):
     pass
 
+def return_data(job):
+    return job.data
+
+def wait_for_cancel(job):
+    cancelled = threading.Event()
+    job.cancel_event.connect(cancelled.set)
+    started.set()
+    cancelled.wait(10)
+
 class ThreadTest(unittest.TestCase):
     CORRELATE = Thread
 
@@ -17,18 +29,34 @@ class ThreadTest(unittest.TestCase):
         self.assertEqual(do_nothing, job.function)
 
     def testRun(self):
-        job = self.CORRELATE(1, do_nothing, 'myaction', None)
+        job = self.CORRELATE(1, return_data, 'myaction', 'foo')
         to_child, to_self = Pipe()
         job.start(to_self)
         response = to_child.recv()
         while job.is_alive():
             pass
         job.join()
-        self.assertEqual(response, '')
+
+        # Processes send the return value, threads store it.
+        if isinstance(job, multiprocessing.Process):
+            self.assertEqual(response, (None, 'foo'))
+        else:
+            self.assertEqual(response, (None, None))
+            self.assertEqual(job.result, 'foo')
 
     def testStart(self):
         pass # See testRun()
 
+    def testCancel(self):
+        started.clear()
+        job = self.CORRELATE(1, wait_for_cancel, 'myaction', None)
+        to_child, to_self = Pipe()
+        job.start(to_self)
+        started.wait(5)
+        self.assertEqual(job.cancel(), isinstance(job, Process))
+        job.join(5)
+        self.failIf(job.is_alive())
+
 class ProcessTest(ThreadTest):
     CORRELATE = Process
 
@@ -41,6 +69,21 @@ class JobTest(unittest.TestCase):
         self.assertEqual(job.data, 'foo')
         self.assertEqual(job.child, None)
 
+    def testGetRetryDelay(self):
+        job = Job(do_nothing, 'myaction', 1, None)
+        self.assertEqual(job.get_retry_delay(), None)
+
+        job = Job(do_nothing, 'myaction', 1, None, lambda n: n * 10)
+        job.failures = 2
+        self.assertEqual(job.get_retry_delay(), 20)
+
+        # Exponential backoff with jitter.
+        job = Job(do_nothing, 'myaction', 1, None, 2)
+        for failures, delay in ((1, 2), (2, 4), (3, 8)):
+            job.failures = failures
+            for n in range(10):
+                self.assert_(.5 * delay <= job.get_retry_delay() <= 1.5 * delay)
+
     def testPickle(self):
         job1 = Job(do_nothing, 'myaction', 1, None)
         data = dumps(job1, -1)
@@ -61,12 +61,94 @@ class PipelineTest(unittest.TestCase):
         self.assertEqual(self.pipeline.has_id(id1), True)
         self.assertEqual(self.pipeline.has_id(id2), True)
 
+        # Ids are never reused, not even by other pipelines.
+        id3 = Pipeline().append(item1)
+        self.assert_(id1 < id2 < id3)
+        self.assertEqual(self.pipeline.has_id(id3), False)
+
     def testTaskDone(self):
         self.testNext()
 
     def testAppend(self):
         self.testContains()
 
+        # Items with a higher priority are returned first, and items with
+        # the same priority in FIFO order.
+        pipeline = Pipeline(max_working = 100, aging = 3)
+        items    = [object() for n in range(6)]
+        pipeline.append(items[0])
+        pipeline.append(items[1], priority = -1)
+        pipeline.append(items[2], priority = 1)
+        pipeline.append(items[3])
+        pipeline.append(items[4], priority = 1)
+        pipeline.appendleft(items[5])
+        self.assertEqual(pipeline.next(), items[5])
+        self.assertEqual(pipeline.next(), items[2])
+        self.assertEqual(pipeline.next(), items[0])
+        self.assertEqual(pipeline.next(), items[4])
+        self.assertEqual(pipeline.next(), items[3])
+        self.assertEqual(pipeline.next(), items[1])
+
+        # Items with a lower priority age.
+        low = object()
+        pipeline.append(low)
+        for n in range(5):
+            pipeline.append(object(), priority = 1)
+        for n in range(2):
+            self.assertNotEqual(pipeline.next(), low)
+        self.assertEqual(pipeline.next(), low)
+
+    def testAppendMany(self):
+        items = [object() for n in range(3)]
+        first = object()
+        self.pipeline.append(first)
+        ids = self.pipeline.append_many([(items[0], 'foo'),
+                                         (items[1], None),
+                                         (items[2], 'bar')])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(self.pipeline), 4)
+        self.assertEqual(self.pipeline.get_from_name('foo'), items[0])
+        self.assertEqual(self.pipeline.get_from_name('bar'), items[2])
+        for item, item_id in zip(items, ids):
+            self.assert_(item in self.pipeline)
+            self.assert_(self.pipeline.has_id(item_id))
+
+        # A batch with a name that is already in use is rejected as a whole.
+        item = object()
+        self.assertRaises(AttributeError,
+                          self.pipeline.append_many,
+                          [(item, 'baz'), (object(), 'foo')])
+        self.assert_(item not in self.pipeline)
+        self.assertRaises(AttributeError,
+                          self.pipeline.append_many,
+                          [(item, 'baz'), (object(), 'baz')])
+        self.assert_(item not in self.pipeline)
+
+        # If the group function raises, the batch is rejected as a whole,
+        # and the queue remains intact.
+        def get_groups(item):
+            if item is items[1]:
+                raise ValueError('no groups')
+            return ['foo']
+        pipeline = Pipeline()
+        pipeline.set_group_function(get_groups)
+        self.assertRaises(ValueError,
+                          pipeline.append_many,
+                          zip(items, ['foo', 'bar', 'baz']))
+        self.assertEqual(len(pipeline), 0)
+        self.assertEqual(pipeline.get_from_name('foo'), None)
+        pipeline.append(first)
+        self.assertEqual(pipeline.try_next(), first)
+
+        # The batch is queued in order, behind the existing items.
+        pipeline = Pipeline(max_working = 100)
+        pipeline.append(first)
+        pipeline.append_many([(item, None) for item in items])
+        pipeline.append_many([(object(), None)], priority = -1)
+        self.assertEqual(pipeline.next(), first)
+        for item in items:
+            self.assertEqual(pipeline.next(), item)
+
     def testAppendleft(self):
         item1 = object()
         item2 = object()
@@ -84,6 +166,21 @@ class PipelineTest(unittest.TestCase):
         self.pipeline.appendleft(item4, True)
         self.assertEqual(self.pipeline.try_next(), item4)
 
+    def testAppendleftMany(self):
+        item1 = object()
+        item2 = object()
+        item3 = object()
+        self.pipeline.append(item1)
+        ids = self.pipeline.appendleft_many([(item2, 'foo'), (item3, None)])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(len(self.pipeline), 3)
+        self.assertEqual(self.pipeline.get_from_name('foo'), item2)
+        self.assertEqual(self.pipeline.try_next(), item3)
+
+        item4 = object()
+        self.pipeline.appendleft_many([(item4, None)], True)
+        self.assertEqual(self.pipeline.try_next(), item4)
+
     def testPrioritize(self):
         item1 = object()
         item2 = object()
@@ -103,6 +200,25 @@ class PipelineTest(unittest.TestCase):
         self.pipeline.prioritize(item1, True)
         self.assertEqual(self.pipeline.try_next(), item1)
 
+        # Items that are not in the pipeline can not be prioritized.
+        self.assertRaises(ValueError, self.pipeline.prioritize, object())
+
+        # Prioritizing many times must not change the order of the other
+        # items.
+        self.pipeline.set_max_working(1000)
+        items = [object() for n in range(100)]
+        for item in items:
+            self.pipeline.append(item)
+        for n in range(500):
+            self.pipeline.prioritize(items[n % 3])
+        self.assertEqual(self.pipeline.next(), item1)
+        self.assertEqual(self.pipeline.next(), items[1])
+        self.assertEqual(self.pipeline.next(), items[0])
+        self.assertEqual(self.pipeline.next(), items[2])
+        self.assertEqual(self.pipeline.next(), item2)
+        for item in items[3:]:
+            self.assertEqual(self.pipeline.next(), item)
+
     def testClear(self):
         self.testAppendleft()
         self.assertEqual(len(self.pipeline), 4)
@@ -192,9 +308,71 @@ class PipelineTest(unittest.TestCase):
         self.assertRaises(Exception, self.pipeline.wake, item2)
         self.assertEqual(len(self.pipeline), 2)
 
+        # Sleeping items that are still queued are skipped, and return to
+        # their original position when they wake up.
+        self.pipeline.set_max_working(1000)
+        items = [object() for n in range(10)]
+        for item in items:
+            self.pipeline.append(item)
+        for item in items[:5]:
+            self.pipeline.sleep(item)
+        self.assertEqual(self.pipeline.try_next(), items[5])
+        self.assertEqual(self.pipeline.next(), items[5])
+        self.pipeline.prioritize(items[3])
+        self.pipeline.wake(items[3])
+        self.pipeline.wake(items[1])
+        self.assertEqual(self.pipeline.next(), items[3])
+        self.assertEqual(self.pipeline.next(), items[1])
+        self.assertEqual(self.pipeline.next(), items[6])
+        self.pipeline.wake(items[0])
+        self.assertEqual(self.pipeline.next(), items[0])
+
     def testWake(self):
         self.testSleep()
 
+    def testDefer(self):
+        item1 = object()
+        item2 = object()
+        self.pipeline.append(item1)
+        self.pipeline.append(item2)
+        self.assertEqual(self.pipeline.next(), item1)
+
+        # A deferred item does not occupy a slot while it waits.
+        start = time.time()
+        self.pipeline.defer(item1, .3)
+        self.assertEqual(len(self.pipeline), 2)
+        self.assertEqual(self.pipeline.next(), item2)
+        self.pipeline.task_done(item2)
+        self.assertEqual(self.pipeline.try_next(), None)
+
+        # When it is due, it is returned again.
+        self.assertEqual(self.pipeline.next(), item1)
+        self.assert_(time.time() - start >= .3)
+        self.pipeline.task_done(item1)
+        self.assertEqual(len(self.pipeline), 0)
+
+        # Deferred items may be prioritized.
+        self.pipeline.append(item1)
+        self.assertEqual(self.pipeline.next(), item1)
+        self.pipeline.defer(item1, 1000)
+        self.pipeline.prioritize(item1)
+        self.assertEqual(self.pipeline.next(), item1)
+        self.pipeline.task_done(item1)
+
+        # Deferred items that are sleeping when they are due are only
+        # returned after they wake up.
+        self.pipeline.append(item1)
+        self.assertEqual(self.pipeline.next(), item1)
+        self.pipeline.defer(item1, .2)
+        self.pipeline.sleep(item1)
+        time.sleep(.3)
+        self.pipeline.append(item2)
+        self.assertEqual(self.pipeline.next(), item2)
+        self.assertEqual(self.pipeline.try_next(), None)
+        self.pipeline.task_done(item2)
+        self.pipeline.wake(item1)
+        self.assertEqual(self.pipeline.next(), item1)
+
     def testWaitForId(self):
         item1 = object()
         item2 = object()
@@ -256,6 +434,38 @@ class PipelineTest(unittest.TestCase):
         self.pipeline.wait_all() # Must not deadlock.
         self.assertEqual(len(self.pipeline), 0)
 
+    def testWaitForRoom(self):
+        self.assertEqual(self.pipeline.wait_for_room(2), 2)
+        item1 = object()
+        item2 = object()
+        self.pipeline.append(item1)
+        self.assertEqual(self.pipeline.wait_for_room(2), 1)
+        self.pipeline.append(item2)
+
+        # Working items are not pending.
+        self.assertEqual(self.pipeline.next(), item1)
+        self.assertEqual(self.pipeline.wait_for_room(2), 1)
+
+        # Blocks until an item is done.
+        self.pipeline.append(object())
+        result = []
+        def wait():
+            result.append(self.pipeline.wait_for_room(2))
+        thread = Thread(target = wait)
+        thread.start()
+        time.sleep(.1)
+        self.assertEqual(result, [])
+        self.pipeline.task_done(item1)
+        self.pipeline.next()
+        self.pipeline.task_done(item2)
+        thread.join()
+        self.assertEqual(result, [1])
+
+        # Returns 0 when the pipeline is stopped.
+        self.pipeline.append(object())
+        self.pipeline.stop()
+        self.assertEqual(self.pipeline.wait_for_room(1), 0)
+
     def testWithLock(self):
         result = self.pipeline.with_lock(lambda p, x: x, 'test')
         self.assertEqual(result, 'test')
@@ -276,6 +486,204 @@ class PipelineTest(unittest.TestCase):
         self.assertEqual(self.pipeline.get_working(), [item])
         self.pipeline.task_done(theitem)
 
+    def testIsWorking(self):
+        item = object()
+        self.pipeline.append(item)
+        self.failIf(self.pipeline.is_working(item))
+        theitem = self.pipeline.next()
+        self.assert_(self.pipeline.is_working(item))
+        self.pipeline.task_done(theitem)
+        self.failIf(self.pipeline.is_working(item))
+
+    def testSetGroupFunction(self):
+        self.testSetGroupLimit()
+
+    def testSetGroupLimit(self):
+        groups   = dict()
+        pipeline = Pipeline(max_working = 10)
+        pipeline.set_group_function(groups.get)
+        pipeline.set_group_limit('site1', 1)
+        items = [object() for n in range(4)]
+        groups[items[0]] = ['site1']
+        groups[items[1]] = ['site1', 'site2']
+        groups[items[3]] = ['site2']
+        for item in items:
+            pipeline.append(item)
+
+        # The second item is blocked until the first one is done.
+        self.assertEqual(pipeline.next(), items[0])
+        self.assertEqual(pipeline.try_next(), items[2])
+        self.assertEqual(pipeline.blocked, {}) # try_next() changes nothing.
+        self.assertEqual(pipeline.next(), items[2])
+        self.assertEqual(pipeline.next(), items[3])
+        self.assertEqual(pipeline.try_next(), None)
+        pipeline.task_done(items[0])
+        self.assertEqual(pipeline.next(), items[1])
+
+        # Raising the limit unblocks items, too.
+        pipeline.append(items[0])
+        self.assertEqual(pipeline.try_next(), None)
+        pipeline.set_group_limit('site1', None)
+        self.assertEqual(pipeline.next(), items[0])
+
+        # Blocked items keep their position and may be prioritized.
+        pipeline.set_group_limit('site2', 1)
+        pipeline.task_done(items[1])
+        item = object()
+        groups[item] = ['site2']
+        pipeline.append(item)
+        pipeline.append(items[1])
+        self.assertEqual(pipeline.try_next(), None)
+        pipeline.prioritize(items[1])
+        pipeline.task_done(items[3])
+        self.assertEqual(pipeline.next(), items[1])
+
+    def testGetGroupLimit(self):
+        self.assertEqual(self.pipeline.get_group_limit('foo'), None)
+        self.pipeline.set_group_limit('foo', 3)
+        self.assertEqual(self.pipeline.get_group_limit('foo'), 3)
+        self.pipeline.set_group_limit('foo', None)
+        self.assertEqual(self.pipeline.get_group_limit('foo'), None)
+
+    def testSetFlowFunction(self):
+        flows    = dict()
+        pipeline = Pipeline(max_working = 100)
+        pipeline.set_flow_function(flows.get)
+        large    = [object() for n in range(10)]
+        small    = [object() for n in range(2)]
+        for item in large:
+            flows[item] = 'large'
+            pipeline.append(item)
+        self.assertEqual(pipeline.next(), large[0])
+        self.assertEqual(pipeline.next(), large[1])
+
+        # A flow that is appended later is not stuck behind the first.
+        for item in small:
+            flows[item] = 'small'
+            pipeline.append(item)
+        result = [pipeline.next() for n in range(6)]
+        self.assertEqual(result, [large[2], small[0],
+                                  large[3], small[1],
+                                  large[4], large[5]])
+
+        # Priorities still apply across flows.
+        item = object()
+        flows[item] = 'small'
+        pipeline.append(item, priority = 1)
+        self.assertEqual(pipeline.next(), item)
+
+        # Items without a flow share one.
+        items = [object(), object()]
+        for item in items:
+            pipeline.append(item)
+        self.assertEqual(pipeline.next(), large[6])
+        self.assertEqual(pipeline.next(), items[0])
+        self.assertEqual(pipeline.next(), large[7])
+        self.assertEqual(pipeline.next(), items[1])
+
+    def testSetFlowWeight(self):
+        flows    = dict()
+        pipeline = Pipeline(max_working = 100)
+        pipeline.set_flow_function(flows.get)
+        pipeline.set_flow_weight('heavy', 2)
+        self.assertRaises(ValueError, pipeline.set_flow_weight, 'foo', 0)
+        light = [object() for n in range(4)]
+        heavy = [object() for n in range(8)]
+        for item in light:
+            flows[item] = 'light'
+            pipeline.append(item)
+        for item in heavy:
+            flows[item] = 'heavy'
+            pipeline.append(item)
+
+        # The heavy flow gets two items per item of the light flow.
+        result = [flows[pipeline.next()] for n in range(9)]
+        self.assertEqual(result.count('heavy'), 6)
+        self.assertEqual(result.count('light'), 3)
+
+        pipeline.set_flow_weight('heavy', None)
+        self.assertEqual(pipeline.get_flow_weight('heavy'), 1)
+
+    def testGetFlowWeight(self):
+        self.assertEqual(self.pipeline.get_flow_weight('foo'), 1)
+        self.pipeline.set_flow_weight('foo', 3)
+        self.assertEqual(self.pipeline.get_flow_weight('foo'), 3)
+
+    def testSetReserveFunction(self):
+        free     = set()
+        pipeline = Pipeline(max_working = 10)
+        def reserve(item):
+            if item in free:
+                return None
+            return 'account'
+        pipeline.set_reserve_function(reserve)
+        items = [object() for n in range(4)]
+        for item in items:
+            pipeline.append(item)
+
+        # Items whose resource is not available are skipped, but
+        # try_next() does not reserve anything.
+        free.add(items[1])
+        self.assertEqual(pipeline.try_next(), items[0])
+        self.assertEqual(pipeline.next(), items[1])
+        self.assertEqual(pipeline.try_next(), items[2])
+        self.assertEqual(len(pipeline), 4)
+
+        # Forced items are started regardless.
+        item = object()
+        pipeline.appendleft(item, force = True)
+        self.assertEqual(pipeline.next(), item)
+
+        # Waiting items keep their position.
+        free.update(items)
+        self.assertEqual(pipeline.unblock('account'), 0)
+        self.assertEqual(pipeline.next(), items[0])
+        self.assertEqual(pipeline.next(), items[2])
+
+    def testUnblock(self):
+        pipeline = Pipeline(max_working = 10)
+        items    = [object() for n in range(3)]
+        waiting  = set(items)
+        def reserve(item):
+            if item in waiting:
+                return 'account'
+            return None
+        pipeline.set_reserve_function(reserve)
+        for item in items:
+            pipeline.append(item)
+        item = object()
+        pipeline.append(item)
+        self.assertEqual(pipeline.next(), item)
+        self.assertEqual(pipeline.try_next(), None)
+        self.assertEqual(pipeline.unblock('foo'), 0)
+
+        # The number of unblocked items may be limited.
+        self.assertEqual(pipeline.unblock('account', 0), 3)
+        waiting.clear()
+        self.assertEqual(pipeline.unblock('account', 2), 1)
+        self.assertEqual(pipeline.next(), items[0])
+        self.assertEqual(pipeline.next(), items[1])
+        self.assertEqual(pipeline.try_next(), None)
+        self.assertEqual(pipeline.unblock('account'), 0)
+        self.assertEqual(pipeline.next(), items[2])
+
+        # Items that were woken in the meantime no longer wait, and
+        # are not counted.
+        stale = [object() for n in range(2)]
+        waiting.update(stale)
+        for item in stale:
+            pipeline.append(item)
+        item = object()
+        pipeline.append(item)
+        self.assertEqual(pipeline.next(), item)
+        pipeline.sleep(stale[0])
+        pipeline.wake(stale[0])
+        self.assertEqual(pipeline.unblock('account', 1), 0)
+        self.assertEqual(pipeline.blocked, {})
+        waiting.clear()
+        self.assertEqual(pipeline.next(), stale[0])
+        self.assertEqual(pipeline.next(), stale[1])
+
     def testTryNext(self):
         pass # used for testing only anyway.
 
@@ -0,0 +1,154 @@
+import sys, unittest, re, os.path, threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from multiprocessing import Pipe, Process
+from Exscript.workqueue.Reactor import Reactor
+
+def do_nothing():
+    pass
+
+class ReactorTest(unittest.TestCase):
+    CORRELATE = Reactor
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.stop()
+        self.reactor.join()
+
+    def watch(self, pipe):
+        received = []
+        event    = threading.Event()
+        def on_message(msg):
+            received.append(msg)
+            event.set()
+        self.reactor.add(pipe, on_message)
+        return received, event
+
+    def testConstructor(self):
+        reactor = Reactor()
+        self.assert_(reactor.daemon)
+        self.assertEqual(reactor.pipes, {})
+
+    def testAdd(self):
+        to_self, to_peer = Pipe()
+        received, event = self.watch(to_self)
+        to_peer.send('hello')
+        event.wait(5)
+        self.assertEqual(received, ['hello'])
+
+        # Closing the other end passes None to the callback, and removes
+        # the pipe.
+        event.clear()
+        to_peer.close()
+        event.wait(5)
+        self.assertEqual(received, ['hello', None])
+        self.assertEqual(self.reactor.pipes, {})
+        to_self.close()
+
+    def testRemove(self):
+        to_self, to_peer = Pipe()
+        received, event = self.watch(to_self)
+        self.reactor.remove(to_self)
+        self.reactor.remove(to_self)
+        self.assertEqual(self.reactor.pipes, {})
+        to_peer.send('hello')
+        event.wait(.3)
+        self.assertEqual(received, [])
+        self.assertEqual(to_self.recv(), 'hello')
+        to_self.close()
+        to_peer.close()
+
+    def testAddReader(self):
+        to_self, to_peer = Pipe()
+        called = []
+        event  = threading.Event()
+        def on_readable():
+            called.append(to_self.recv())
+            event.set()
+        self.reactor.add_reader(to_self, on_readable)
+        event.wait(.3)
+        self.assertEqual(called, [])
+
+        # The callback is called once only.
+        to_peer.send('hello')
+        event.wait(5)
+        self.assertEqual(called, ['hello'])
+        self.assertEqual(self.reactor.readers, {})
+        to_self.close()
+        to_peer.close()
+
+    def testRemoveReader(self):
+        to_self, to_peer = Pipe()
+        called = []
+        self.reactor.add_reader(to_self, lambda: called.append(True))
+        self.reactor.remove_reader(to_self)
+        self.reactor.remove_reader(to_self)
+        self.assertEqual(self.reactor.readers, {})
+        to_peer.send('hello')
+        threading.Event().wait(.3)
+        self.assertEqual(called, [])
+        to_self.close()
+        to_peer.close()
+
+    def testJoinLater(self):
+        child = Process(target = do_nothing)
+        child.start()
+        self.reactor.join_later(child)
+        child.join(5)
+        for n in range(50):
+            if not self.reactor.children:
+                break
+            threading.Event().wait(.1)
+        self.assertEqual(self.reactor.children, [])
+
+    def testCallLater(self):
+        called = []
+        event  = threading.Event()
+        def on_timer(name):
+            called.append(name)
+            if len(called) == 2:
+                event.set()
+        self.reactor.call_later(.2, lambda: on_timer('second'))
+        self.reactor.call_later(.1, lambda: on_timer('first'))
+        event.wait(5)
+        self.assertEqual(called, ['first', 'second'])
+
+        # A callback that raises does not stop the reactor.
+        event.clear()
+        self.reactor.call_later(0, lambda: 1 / 0)
+        self.reactor.call_later(.1, event.set)
+        event.wait(5)
+        self.assert_(event.is_set())
+        self.assert_(self.reactor.is_alive())
+
+    def testCancelCall(self):
+        called = []
+        event  = threading.Event()
+        handle = self.reactor.call_later(.1, lambda: called.append('no'))
+        self.reactor.call_later(.2, event.set)
+        self.reactor.cancel_call(handle)
+        event.wait(5)
+        self.assertEqual(called, [])
+
+        # Cancelling a call that was already made does no harm.
+        self.reactor.cancel_call(handle)
+
+    def testStop(self):
+        self.reactor.stop()
+        self.reactor.join(5)
+        self.failIf(self.reactor.is_alive())
+        self.assertEqual(self.reactor.wakeup, None)
+
+        # Stopping twice does no harm.
+        self.reactor.stop()
+
+    def testRun(self):
+        pass # See testAdd()
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ReactorTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
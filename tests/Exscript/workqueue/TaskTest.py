@@ -1,4 +1,4 @@
-import sys, unittest, re, os.path, warnings
+import sys, unittest, re, os.path, warnings, threading
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
 
 warnings.simplefilter('ignore', DeprecationWarning)
@@ -18,6 +18,26 @@ class TaskTest(unittest.TestCase):
     def testConstructor(self):
         task = Task(self.wq)
 
+    def testOpen(self):
+        task = Task(self.wq)
+        done = []
+        task.done_event.connect(lambda: done.append(True))
+        task.open()
+        self.assertEqual(task.is_completed(), False)
+
+        job = Thread(1, object, 'foo1', None)
+        task.add_job_id(job.id)
+        self.wq.job_succeeded_event(job)
+        self.assertEqual(task.is_completed(), False)
+        self.assertEqual(done, [])
+
+        task.close()
+        self.assertEqual(task.is_completed(), True)
+        self.assertEqual(done, [True])
+
+    def testClose(self):
+        self.testOpen()
+
     def testIsCompleted(self):
         task = Task(self.wq)
         task.add_job_id(123)
@@ -38,6 +58,45 @@ class TaskTest(unittest.TestCase):
         self.wq.job_succeeded_event(job2)
         self.assertEqual(task.is_completed(), True)
 
+    def testResults(self):
+        for max_results in None, 0, 2:
+            task = Task(self.wq, max_results)
+            self.assertEqual(list(task.results()), [])
+            for n in range(5):
+                job        = Thread(n, object, 'foo%d' % n, None)
+                job.result = n
+                task.add_job_id(job.id)
+                self.wq.job_succeeded_event(job)
+            results = task.results()
+            self.assertEqual(results.next(), ('foo0', 0))
+
+            # Results that arrive while iterating are not included.
+            job        = Thread(5, object, 'foo5', None)
+            job.result = 5
+            task.add_job_id(job.id)
+            self.wq.job_succeeded_event(job)
+            expected = [('foo%d' % n, n) for n in range(1, 5)]
+            self.assertEqual(list(results), expected)
+            self.assertEqual(len(list(task.results())), 6)
+
+        # Unknown and aborted jobs have no result.
+        self.wq.job_succeeded_event(Thread(6, object, 'foo6', None))
+        job = Thread(7, object, 'foo7', None)
+        task.add_job_id(job.id)
+        self.wq.job_aborted_event(job)
+        self.assertEqual(len(list(task.results())), 6)
+
+        # Results that can not be pickled are kept in memory, in order.
+        task = Task(self.wq, 0)
+        lock = threading.Lock()
+        for n, result in enumerate((0, lock, 2)):
+            job        = Thread(n, object, 'foo%d' % n, None)
+            job.result = result
+            task.add_job_id(job.id)
+            self.wq.job_succeeded_event(job)
+        self.assertEqual(list(task.results()),
+                         [('foo0', 0), ('foo1', lock), ('foo2', 2)])
+
     def testAddJobId(self):
         self.testWait()
 
@@ -19,16 +19,32 @@ def burn_time(job):
 
 nop = lambda x: None
 
+done = []
+
+def remember(job):
+    done.append(job.name)
+
+def fail(job):
+    raise Exception('intentional error')
+
 class WorkQueueTest(unittest.TestCase):
     CORRELATE = WorkQueue
+    mode      = 'threading'
 
     def setUp(self):
-        self.wq = WorkQueue()
+        self.wq = WorkQueue(mode = self.mode)
 
     def testConstructor(self):
         self.assertEqual(1, self.wq.get_max_threads())
         self.assertEqual(0, self.wq.debug)
 
+        # The stack size is only supported by pools of threads.
+        if self.mode not in ('threadpool', 'hybrid', 'async'):
+            self.assertRaises(TypeError,
+                              WorkQueue,
+                              mode       = self.mode,
+                              stack_size = 256 * 1024)
+
     def testSetDebug(self):
         self.assertEqual(0, self.wq.debug)
         self.wq.set_debug(2)
@@ -42,15 +58,125 @@ class WorkQueueTest(unittest.TestCase):
     def testSetMaxThreads(self):
         self.testGetMaxThreads()
 
+    def testEnableAutotune(self):
+        self.wq.enable_autotune(3, 5)
+        self.assertEqual(3, self.wq.get_max_threads())
+        for i in range(3):
+            self.wq.job_succeeded_event(None)
+        self.assertEqual(4, self.wq.get_max_threads())
+
+        self.wq.disable_autotune()
+        for i in range(10):
+            self.wq.job_succeeded_event(None)
+        self.assertEqual(4, self.wq.get_max_threads())
+
+    def testDisableAutotune(self):
+        self.testEnableAutotune()
+
+    def testSetGroupFunction(self):
+        self.testSetGroupLimit()
+
+    def testSetGroupLimit(self):
+        running = Value('i', 0)
+        maximum = Value('i', 0)
+        def record(job):
+            with lock:
+                running.value += 1
+                maximum.value  = max(maximum.value, running.value)
+            time.sleep(.05)
+            with lock:
+                running.value -= 1
+        self.wq.set_max_threads(10)
+        self.wq.set_group_function(lambda job: [job.name[0]])
+        self.wq.set_group_limit('a', 2)
+        self.wq.pause()
+        self.wq.enqueue_many(record, [('a%d' % n, None) for n in range(10)])
+        self.wq.unpause()
+        self.wq.wait_until_done()
+        self.assertEqual(maximum.value, 2)
+
+    def testSetFlowFunction(self):
+        order = []
+        def record(job):
+            with lock:
+                order.append(job.name)
+        self.wq.set_flow_function(lambda job: job.name[0])
+        self.wq.pause()
+        self.wq.enqueue_many(record, [('a%d' % n, None) for n in range(4)])
+        self.wq.enqueue_many(record, [('b%d' % n, None) for n in range(2)])
+        self.wq.unpause()
+        self.wq.wait_until_done()
+        self.assertEqual(order, ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+
+    def testSetFlowWeight(self):
+        order = []
+        def record(job):
+            with lock:
+                order.append(job.name)
+        self.wq.set_flow_function(lambda job: job.name[0])
+        self.wq.set_flow_weight('b', 2)
+        self.wq.pause()
+        self.wq.enqueue_many(record, [('a%d' % n, None) for n in range(2)])
+        self.wq.enqueue_many(record, [('b%d' % n, None) for n in range(4)])
+        self.wq.unpause()
+        self.wq.wait_until_done()
+        self.assertEqual(order, ['b0', 'a0', 'b1', 'b2', 'a1', 'b3'])
+
+    def testSetReserveFunction(self):
+        free    = Value('i', 1)
+        running = Value('i', 0)
+        maximum = Value('i', 0)
+        def reserve(job):
+            with lock:
+                if free.value == 0:
+                    return 'token'
+                free.value -= 1
+        def use_token(job):
+            with lock:
+                running.value += 1
+                maximum.value  = max(maximum.value, running.value)
+            time.sleep(.05)
+            with lock:
+                running.value -= 1
+                free.value    += 1
+            self.wq.unblock('token')
+        self.wq.set_max_threads(10)
+        self.wq.set_reserve_function(reserve)
+        self.wq.enqueue_many(use_token, [('t%d' % n, None) for n in range(5)])
+        self.wq.wait_until_done()
+        self.assertEqual(maximum.value, 1)
+        self.assertEqual(free.value, 1)
+
+        # Jobs that are retried right away are reserved again.
+        reserved = []
+        self.wq.set_reserve_function(reserved.append)
+        self.wq.enqueue(fail, times = 3)
+        self.wq.wait_until_done()
+        self.assertEqual(len(reserved), 3)
+
+    def testUnblock(self):
+        self.wq.set_reserve_function(lambda job: 'token')
+        self.wq.pause()
+        self.wq.enqueue(nop)
+        self.assertEqual(self.wq.unblock('token'), 0)
+        self.wq.unpause()
+        time.sleep(.2)
+        self.assertEqual(self.wq.get_length(), 1)
+        self.assertEqual(self.wq.unblock('token', 0), 1)
+        self.wq.set_reserve_function(None)
+        self.assertEqual(self.wq.unblock('token'), 0)
+        self.wq.wait_until_done()
+        self.assertEqual(self.wq.get_length(), 0)
+
     def testEnqueue(self):
         self.wq.pause()
         self.assertEqual(0, self.wq.get_length())
         id = self.wq.enqueue(nop)
         self.assertEqual(1, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.enqueue(nop)
         self.assertEqual(2, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         self.wq.shutdown(True)
         self.assertEqual(0, self.wq.get_length())
 
@@ -72,15 +198,91 @@ class WorkQueueTest(unittest.TestCase):
         self.wq.shutdown(True)
         self.assertEqual(0, self.wq.get_length())
 
+        # Jobs with a higher priority are started first.
+        self.wq.set_max_threads(1)
+        self.wq.pause()
+        started = []
+        def record(job):
+            started.append(job.name)
+        self.wq.enqueue(record, 'low')
+        self.wq.enqueue(record, 'high', priority = 10)
+        self.wq.enqueue(record, 'medium', priority = 5)
+        self.wq.unpause()
+        self.wq.wait_until_done()
+        self.assertEqual(started, ['high', 'medium', 'low'])
+
+        # A job that is retried after a delay releases its thread.
+        started = []
+        def fail_once(job):
+            started.append(job.name)
+            if job.failures == 0:
+                raise Exception('intentional error')
+        self.wq.enqueue(fail_once, 'retry', times = 2, retry_delay = .3)
+        self.wq.enqueue(record, 'other')
+        self.wq.wait_until_done()
+        self.assertEqual(started, ['retry', 'other', 'retry'])
+
+        # A job that exceeds its deadline is cancelled, reported as an
+        # error, and releases its thread.
+        started = []
+        errors  = []
+        def on_error(job, exc_info):
+            errors.append(exc_info[0].__name__)
+        def hang(job):
+            cancelled = threading.Event()
+            job.cancel_event.connect(cancelled.set)
+            cancelled.wait(10)
+        self.wq.job_error_event.connect(on_error)
+        self.wq.enqueue(hang, 'hang', deadline = .2)
+        self.wq.enqueue(record, 'other')
+        self.wq.wait_until_done()
+        self.assertEqual(errors, ['JobTimeoutException'])
+        self.assertEqual(started, ['other'])
+
+        # A thread that does not stop keeps its slot until it returns.
+        stopped = []
+        def linger(job):
+            time.sleep(.5)
+            stopped.append(job.name)
+        def check(job):
+            started.append(list(stopped))
+        started = []
+        self.wq.enqueue(linger, 'linger', deadline = .1)
+        self.wq.enqueue(check, 'check')
+        self.wq.wait_until_done()
+        self.assertEqual(errors[-1], 'JobTimeoutException')
+        self.assertEqual(started, [['linger']])
+
+    def testEnqueueMany(self):
+        self.wq.pause()
+        self.assertEqual(0, self.wq.get_length())
+        ids = self.wq.enqueue_many(nop, [('one', None), ('two', None)])
+        self.assertEqual(2, self.wq.get_length())
+        self.assertEqual(len(ids), 2)
+        for id in ids:
+            self.assert_(isinstance(id, int))
+        self.wq.shutdown(True)
+        self.assertEqual(0, self.wq.get_length())
+
+        # Run a larger batch.
+        data = Value('i', 0)
+        self.wq.enqueue_many(burn_time, [(None, data)] * 222)
+        self.assertEqual(222, self.wq.get_length())
+        self.wq.set_max_threads(50)
+        self.wq.unpause()
+        self.wq.wait_until_done()
+        self.assertEqual(0,   self.wq.get_length())
+        self.assertEqual(222, data.value)
+
     def testEnqueueOrIgnore(self):
         self.wq.pause()
         self.assertEqual(0, self.wq.get_length())
         id = self.wq.enqueue_or_ignore(nop, 'one')
         self.assertEqual(1, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.enqueue_or_ignore(nop, 'two')
         self.assertEqual(2, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.enqueue_or_ignore(nop, 'one')
         self.assertEqual(2, self.wq.get_length())
         self.assertEqual(id, None)
@@ -89,16 +291,79 @@ class WorkQueueTest(unittest.TestCase):
 
         # Stress testing from testEnqueue() not repeated here.
 
+    def testEnqueueManyOrIgnore(self):
+        self.wq.pause()
+        self.assertEqual(0, self.wq.get_length())
+        self.wq.enqueue_or_ignore(nop, 'one')
+        ids = self.wq.enqueue_many_or_ignore(nop, [('one', None),
+                                                   ('two', None),
+                                                   ('two', None),
+                                                   ('three', None)])
+        self.assertEqual(3, self.wq.get_length())
+        self.assertEqual(ids[0], None)
+        self.assert_(isinstance(ids[1], int))
+        self.assertEqual(ids[2], None)
+        self.assert_(isinstance(ids[3], int))
+
+    def testEnqueueManyOrMerge(self):
+        merged = []
+        def merge(job, function):
+            merged.append(job.name)
+            return job.func is nop
+
+        self.wq.pause()
+        self.wq.enqueue_or_ignore(nop, 'one')
+        self.wq.enqueue_or_ignore(burn_time, 'two')
+        ids = self.wq.enqueue_many_or_merge(nop,
+                                            [('one',   None),
+                                             ('two',   None),
+                                             ('three', None),
+                                             ('three', None)],
+                                            merge)
+        self.assertEqual(merged, ['one', 'two', 'three'])
+        self.assertEqual(4, self.wq.get_length())
+        self.assertEqual(ids[0], self.wq.collection.get_from_name('one').id)
+        self.assertNotEqual(ids[1], self.wq.collection.get_from_name('two').id)
+        self.assertEqual(ids[2], ids[3])
+
+        # Jobs that were already started are never merged.
+        self.wq.shutdown(True)
+        merged  = []
+        started = threading.Event()
+        release = threading.Event()
+        def block(job):
+            started.set()
+            release.wait(5)
+        self.wq.unpause()
+        self.wq.enqueue_or_ignore(block, 'one')
+        started.wait(5)
+        ids = self.wq.enqueue_many_or_merge(nop, [('one', None)], merge)
+        self.assertEqual(merged, [])
+        self.assertEqual(2, self.wq.get_length())
+        release.set()
+        self.wq.wait_until_done()
+
     def testPriorityEnqueue(self):
         # Well, this test sucks.
         self.wq.pause()
         self.assertEqual(0, self.wq.get_length())
         id = self.wq.priority_enqueue(nop)
         self.assertEqual(1, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.priority_enqueue(nop)
         self.assertEqual(2, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
+
+    def testPriorityEnqueueMany(self):
+        self.wq.pause()
+        self.assertEqual(0, self.wq.get_length())
+        self.wq.enqueue(nop)
+        ids = self.wq.priority_enqueue_many(nop, [('one', None),
+                                                  ('two', None)])
+        self.assertEqual(3, self.wq.get_length())
+        self.assertEqual(len(ids), 2)
+        for id in ids:
+            self.assert_(isinstance(id, int))
 
     def testPriorityEnqueueOrRaise(self):
         self.assertEqual(0, self.wq.get_length())
@@ -106,10 +371,10 @@ class WorkQueueTest(unittest.TestCase):
         self.wq.pause()
         id = self.wq.priority_enqueue_or_raise(nop, 'foo')
         self.assertEqual(1, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.priority_enqueue_or_raise(nop, 'bar')
         self.assertEqual(2, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.priority_enqueue_or_raise(nop, 'foo')
         self.assertEqual(2, self.wq.get_length())
         self.assertEqual(id, None)
@@ -128,11 +393,49 @@ class WorkQueueTest(unittest.TestCase):
             self.wq.wait_for(id)
         self.assertEqual(0, self.wq.get_length())
 
+    def testRecover(self):
+        from tempfile import NamedTemporaryFile
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import NullPool
+        from Exscript.workqueue.DBPipeline import DBPipeline
+        dbfile = NamedTemporaryFile()
+        engine = create_engine('sqlite:///' + dbfile.name,
+                               poolclass = NullPool)
+        DBPipeline(engine).install()
+
+        # Queue two jobs, and stop before they are started.
+        wq = WorkQueue(collection = DBPipeline(engine), mode = self.mode)
+        self.assertEqual(wq.recover(), [])
+        wq.pause()
+        ids = [wq.enqueue(remember, name) for name in ('one', 'two')]
+        wq.destroy()
+
+        # A new queue on the same database resumes them.
+        del done[:]
+        wq = WorkQueue(collection = DBPipeline(engine), mode = self.mode)
+        self.assertEqual(wq.recover(), ids)
+        wq.wait_until_done()
+        self.assertEqual(done, ['one', 'two'])
+        wq.destroy()
+
+        wq = WorkQueue(collection = DBPipeline(engine), mode = self.mode)
+        self.assertEqual(wq.recover(), [])
+        wq.destroy()
+        dbfile.close()
+
     def testUnpause(self):
         pass # See testEnqueue()
 
     def testWaitUntilDone(self):
-        pass # See testEnqueue()
+        # A listener that raises does not keep the queue from draining.
+        def fail(job):
+            raise Exception('listener failed')
+        self.wq.job_succeeded_event.connect(fail)
+        for n in range(3):
+            self.wq.enqueue(nop)
+        self.wq.wait_until_done()
+        self.assertEqual(0, self.wq.get_length())
+        self.wq.shutdown(True)
 
     def testShutdown(self):
         pass # See testEnqueue()
@@ -142,10 +445,10 @@ class WorkQueueTest(unittest.TestCase):
         self.assertEqual(0, self.wq.get_length())
         id = self.wq.enqueue(nop)
         self.assertEqual(1, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         id = self.wq.enqueue(nop)
         self.assertEqual(2, self.wq.get_length())
-        self.assert_(isinstance(id, str))
+        self.assert_(isinstance(id, int))
         self.wq.destroy()
         self.assertEqual(0, self.wq.get_length())
 
@@ -169,7 +472,17 @@ class WorkQueueTest(unittest.TestCase):
     def testGetLength(self):
         pass # See testEnqueue()
 
+class WorkQueueThreadPoolTest(WorkQueueTest):
+    mode = 'threadpool'
+
+class WorkQueueAsyncTest(WorkQueueTest):
+    mode = 'async'
+
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(WorkQueueTest)
+    loader = unittest.TestLoader()
+    suite1 = loader.loadTestsFromTestCase(WorkQueueTest)
+    suite2 = loader.loadTestsFromTestCase(WorkQueueThreadPoolTest)
+    suite3 = loader.loadTestsFromTestCase(WorkQueueAsyncTest)
+    return unittest.TestSuite((suite1, suite2, suite3))
 if __name__ == '__main__':
     unittest.TextTestRunner(verbosity = 2).run(suite())
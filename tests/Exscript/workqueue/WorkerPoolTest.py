@@ -0,0 +1,226 @@
+import sys, unittest, re, os.path, threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import os
+import time
+import multiprocessing
+from Exscript.workqueue.Job import Job
+from Exscript.workqueue.WorkerPool import WorkerPool
+from Exscript.workqueue.Reactor import Reactor
+
+def do_nothing(job):
+    pass
+
+def get_foo(job):
+    return job.data['foo']
+
+def get_lock(job):
+    return threading.Lock()
+
+def fail(job):
+    raise Exception('intentional error')
+
+def die(job):
+    os._exit(1)
+
+def get_pid(job):
+    time.sleep(.5)
+    return os.getpid()
+
+started = multiprocessing.Event()
+
+def wait_for_cancel(job):
+    cancelled = threading.Event()
+    job.cancel_event.connect(cancelled.set)
+    started.set()
+    cancelled.wait(10)
+    assert cancelled.is_set()
+
+def check_context(job):
+    assert job.data['foo'] == 'bar'
+    assert job.data['worker'] == 'yes'
+
+class WorkerPoolTest(unittest.TestCase):
+    CORRELATE = WorkerPool
+    mode      = 'threading'
+    size      = 2
+    threads   = 1
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.reactor.start()
+        self.pool    = WorkerPool(self.mode,
+                                  self.size,
+                                  self.reactor,
+                                  threads = self.threads)
+
+    def tearDown(self):
+        self.pool.stop()
+        self.reactor.stop()
+
+    def runJob(self, function, name = 'myjob'):
+        done   = threading.Event()
+        result = []
+        def on_complete(job, exc_info):
+            result.append((job, exc_info))
+            done.set()
+        job    = Job(function, name, 1, {'foo': 'bar'})
+        job.id = name
+        self.last_job = job
+        self.pool.start(job, on_complete)
+        done.wait(10)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], job)
+        return result[0][1]
+
+    def testConstructor(self):
+        self.assertEqual(self.pool.get_size(), self.size)
+        self.assertEqual(len(self.pool.workers), 0)
+        self.assertRaises(TypeError, WorkerPool, 'foo')
+        self.assertRaises(TypeError, WorkerPool, 'multiprocessing')
+        self.assertRaises(TypeError, WorkerPool, 'hybrid')
+
+    def testStart(self):
+        # The first job starts the full set of workers.
+        self.assertEqual(self.runJob(do_nothing), None)
+        self.assertEqual(len(self.pool.workers), 2)
+        workers = set(self.pool.workers)
+
+        # Errors are reported, and the workers are re-used.
+        exc_info = self.runJob(fail)
+        self.assertEqual(exc_info[0], Exception)
+        self.assertEqual(str(exc_info[1]), 'intentional error')
+        for n in range(5):
+            self.assertEqual(self.runJob(do_nothing), None)
+        self.assertEqual(set(self.pool.workers), workers)
+
+        # The return value is stored in the job.
+        self.assertEqual(self.runJob(get_foo), None)
+        self.assertEqual(self.last_job.result, 'bar')
+
+    def testCancel(self):
+        done   = threading.Event()
+        result = []
+        def on_complete(job, exc_info):
+            result.append(exc_info)
+            done.set()
+        started.clear()
+        job    = Job(wait_for_cancel, 'myjob', 1, None)
+        job.id = 'myjob'
+        self.pool.start(job, on_complete)
+        started.wait(5)
+
+        # Jobs that are not running are ignored.
+        self.assert_(self.pool.cancel(Job(do_nothing, 'other', 1, None)))
+
+        # So are other attempts of the same job.
+        job.failures += 1
+        self.pool.cancel(job)
+        job.failures -= 1
+        self.assertEqual(done.wait(.2), False)
+
+        stopped = self.pool.cancel(job)
+        self.assertEqual(stopped, self.mode == 'multiprocessing')
+        done.wait(5)
+        self.assertEqual(len(result), 1)
+        if self.mode == 'threading':
+            self.assertEqual(result, [None])
+
+        # A terminated worker process is replaced.
+        self.assertEqual(self.runJob(do_nothing), None)
+
+    def testStackSize(self):
+        self.pool.stop()
+        if self.mode == 'multiprocessing':
+            self.assertRaises(TypeError, WorkerPool,
+                              self.mode, 2, self.reactor, 256 * 1024)
+            self.pool = WorkerPool(self.mode, 2, self.reactor)
+            return
+        self.pool = WorkerPool(self.mode, 2, self.reactor, 256 * 1024)
+        self.assertEqual(self.runJob(do_nothing), None)
+        self.assertEqual(threading.stack_size(), 0)
+
+    def testWorkerInitEvent(self):
+        def on_worker_init(worker):
+            worker.context['worker'] = 'yes'
+        self.pool.worker_init_event.connect(on_worker_init)
+        self.assertEqual(self.runJob(check_context), None)
+
+    def testSetSize(self):
+        self.runJob(do_nothing)
+        self.assertEqual(len(self.pool.workers), 2)
+        self.pool.set_size(1)
+        self.assertEqual(self.pool.get_size(), 1)
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertEqual(self.runJob(do_nothing), None)
+        self.pool.set_size(3)
+        self.assertEqual(len(self.pool.workers), 1)
+
+    def testGetSize(self):
+        self.testSetSize()
+
+    def testStop(self):
+        self.runJob(do_nothing)
+        workers = self.pool.workers.keys()
+        self.pool.stop()
+        self.assertEqual(len(self.pool.workers), 0)
+        for worker in workers:
+            self.failIf(worker.is_alive())
+
+        # The pool may be restarted.
+        self.assertEqual(self.runJob(do_nothing), None)
+
+class ProcessWorkerPoolTest(WorkerPoolTest):
+    mode = 'multiprocessing'
+
+    def testWorkerDied(self):
+        exc_info = self.runJob(die)
+        self.assertEqual(exc_info[0], Exception)
+        self.assertEqual(self.runJob(do_nothing), None)
+
+    def testUnpicklableResult(self):
+        exc_info = self.runJob(get_lock)
+        self.assert_(exc_info is not None)
+        self.assertEqual(self.runJob(do_nothing), None)
+
+    def testUnpicklableJob(self):
+        exc_info = self.runJob(lambda job: None)
+        self.assert_(exc_info is not None)
+        self.assertEqual(self.runJob(do_nothing), None)
+
+class HybridWorkerPoolTest(ProcessWorkerPoolTest):
+    mode    = 'hybrid'
+    size    = 4
+    threads = 2
+
+    def testThreads(self):
+        lock   = threading.Lock()
+        done   = threading.Event()
+        result = []
+        def on_complete(job, exc_info):
+            with lock:
+                result.append((exc_info, job.result))
+                if len(result) == 4:
+                    done.set()
+        for n in range(4):
+            job    = Job(get_pid, 'job%d' % n, 1, None)
+            job.id = n
+            self.pool.start(job, on_complete)
+        done.wait(10)
+
+        # Every process runs two of the jobs at the same time.
+        self.assertEqual(len(self.pool.workers), 2)
+        pids = [pid for exc_info, pid in result if exc_info is None]
+        self.assertEqual(len(pids), 4)
+        self.assertEqual(len(set(pids)), 2)
+        for pid in set(pids):
+            self.assertEqual(pids.count(pid), 2)
+
+def suite():
+    loader = unittest.TestLoader()
+    suite1 = loader.loadTestsFromTestCase(WorkerPoolTest)
+    suite2 = loader.loadTestsFromTestCase(ProcessWorkerPoolTest)
+    suite3 = loader.loadTestsFromTestCase(HybridWorkerPoolTest)
+    return unittest.TestSuite((suite1, suite2, suite3))
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -200,6 +200,26 @@ class OrderDBTest(unittest.TestCase):
         order = self.db.get_orders()[0]
         self.failIfEqual(order.get_closed_timestamp(), None)
 
+        # Orders with running jobs are kept open.
+        order1 = Order('fooservice')
+        order2 = Order('fooservice')
+        self.db.add_order([order1, order2])
+        task1 = Task(order1.id, 'running task')
+        task2 = Task(order2.id, 'lost task')
+        task1.set_job_id(1)
+        task2.set_job_id(2)
+        self.db.save_task(task1)
+        self.db.save_task(task2)
+        self.db.close_open_orders([1])
+        order1 = self.db.get_order(id = order1.id)
+        order2 = self.db.get_order(id = order2.id)
+        self.assertEqual(order1.get_closed_timestamp(), None)
+        self.failIfEqual(order2.get_closed_timestamp(), None)
+        task1 = self.db.get_task(id = task1.id)
+        task2 = self.db.get_task(id = task2.id)
+        self.assertEqual(task1.get_closed_timestamp(), None)
+        self.failIfEqual(task2.get_closed_timestamp(), None)
+
     def testSaveTask(self):
         self.testInstall()
 
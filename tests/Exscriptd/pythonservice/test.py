@@ -18,3 +18,11 @@ def enter(order):
     __service__.enqueue_hosts(order, order.get_hosts(), callback)
     __service__.set_order_status(order, 'queued')
     return True
+
+def recover(order):
+    """
+    Called after a restart for every order that still has jobs in a
+    queue that keeps its jobs in a database. Returns the function that
+    the restored jobs are run with.
+    """
+    return bind(run, order)